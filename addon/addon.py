@@ -8,167 +8,339 @@ hopefully...
 
 from __future__ import annotations
 from dataclasses import dataclass, field
-from typing import Callable, Dict, Optional, TypedDict, cast
-from copy import copy
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple, cast
+import io
+import unittest
 
-from addon.blender_util import isinstance_bpy_prop_array
+from addon.blender_util import float_array, isinstance_bpy_prop_array, node_tree_hash
 from . import ast
-from .types import blender_material_node_to_operation, blender_material_type_to_primitive
+from .parser import ParseContext
+from .snapshot import NodeSnapshot, snapshot_tree
+from .types import blender_material_node_to_operation, blender_material_type_to_primitive, from_named
 from .bpy_wrap import bpy, in_blender
 from .util import Ansi
 
-class Referrer(TypedDict):
-  node: bpy.types.ShaderNode
-  # link: bpy.types.NodeLink # old less adaptable attempt
-  name: str
+# nodes whose value is inlined into the expression reading it, unless more than one input reads it
+inlined_node_types = {'MATH', 'VALUE', 'RGB'}
 
+Decl = ast.ConstDecl | ast.FnDecl
 
-@dataclass(slots=True)
-class ProcessedNodesCollection:
-  namespace: ast.Namespace
-  # maybe calling them nodes and codes is an interesting idea
-  node_to_code: Dict[bpy.types.ShaderNode, ast.Node] = field(default_factory=dict)
-
-  # TODO: maybe just inherit from dict
-  def get(self, k: bpy.types.ShaderNode):
-    return self.node_to_code.get(k)
-
-  def __getitem__(self, k: bpy.types.ShaderNode):
-    return self.node_to_code[k]
-
-  # TODO: deprecate, require consumers use add_node
-  def __setitem__(self, k: bpy.types.ShaderNode, v: ast.Node):
-    self.node_to_code[k] = v
-
-  def ref_node_and_get(self, node: bpy.types.ShaderNode, referrer: Referrer):
-    """get a node if it exists, if it exists, promote it if necessary"""
-    if node in self.node_to_code:
-      self._promote(node, referrer)
-    return self.node_to_code.get(node)
-
-  def _promote(self, node: bpy.types.ShaderNode, referrer: Referrer) -> None:
-    """promote an ast node within the namespace, usually to a variable"""
-    code = self.node_to_code[node]
-    match code:
-      case ast.VarRef() | ast.ConstDecl():
-        pass
-      # case ast.NamedArg():
-      case ast.Literal() | ast.BinOp():
-        name = ast.Ident(referrer["name"])
-        value = copy(code)
-        decl = ast.ConstDecl(name, value)
-        self.inplace_become(code, ast.VarRef(name))
-        # FIXME: determine if the target ever exists at all
-        referring_code = self.node_to_code.get(referrer["node"])
-        self.namespace.prepend_decl(decl, cast(ast.ConstDecl, referring_code))
-      case _:
-        raise RuntimeError(f"unhandled promotion case, {code.__class__.__name__}")
 
-  @staticmethod
-  def inplace_become(node: ast.Node, replacement: ast.Node) -> None:
-    """must become a compatible syntactical construct"""
-    node.__class__ = replacement.__class__
-    node.__dict__ = replacement.__dict__  # could clear+update but this should be safe
-
-
-def analyze_output_node(node_to_code: ProcessedNodesCollection, output_node: bpy.types.ShaderNode) -> ast.Module:
-
-  def get_code_for_input(node: bpy.types.ShaderNode, referrer: Optional[Referrer] = None) -> ast.VarRef | ast.Literal:
-    if referrer is not None:
-      maybe_already_visited = node_to_code.ref_node_and_get(node, referrer)
-      if maybe_already_visited is not None: return maybe_already_visited
-
-
-    ## handle primitives
-    # TODO: use a mapping (or a match) for all node types
-    if isinstance(node, bpy.types.ShaderNodeValue):
-      node_to_code[node] = node.color
-
-    ## handle compounds (currently a vardecl is created for every non-trivial node... this will be removed)
-    # TODO: use pyenv to force python version to match that in blender
-    @dataclass(slots=True)
-    class Input:
-      # the node which this input comes from
-      value: bpy.types.ShaderNode | ast.Expr
-      link: bpy.types.NodeLink
-      # DEPRECATED
-      # from_name: str
-      # from_type: str # TODO: make this an enum
-      # to_name: str
-      # to_type: str
-
-    # TODO: move to some module for dealing with blender nodes
-    def get_default_value(i: bpy.types.NodeSocket) -> ast.Literal | None:
-      # if hasattr(i, 'default_value'):
-      if isinstance(i, (bpy.types.NodeSocketFloat, bpy.types.NodeSocketBool, bpy.types.NodeSocketColor)):
-        if isinstance_bpy_prop_array(i.default_value):
-          return ast.Literal.from_value(list(i.default_value))
-        return ast.Literal.from_value(i.default_value)
+@dataclass(slots=True)
+class GroupFunctions:
+  """
+  node groups lowered into fn decls, memoized by group datablock and by content so that a
+  group's body is only analyzed once no matter how many materials (or copies of it) use it
+  """
+  # where the fn decls are emitted, nested groups before the groups using them
+  namespace: ast.Namespace = field(default_factory=ast.Namespace)
+  by_group: Dict[bpy.types.NodeTree, ast.FnDecl] = field(default_factory=dict)
+  by_hash: Dict[str, ast.FnDecl] = field(default_factory=dict)
+  hash_memo: Dict[bpy.types.NodeTree, str] = field(default_factory=dict)
+  analyzed_count: int = 0
+
+  def get(self, group: bpy.types.NodeTree) -> ast.FnDecl:
+    fn = self.by_group.get(group)
+    if fn is not None: return fn
+    content_hash = node_tree_hash(group, self.hash_memo)
+    fn = self.by_hash.get(content_hash)
+    if fn is None:
+      fn = self.by_hash[content_hash] = analyze_group(self, group)
+      self.analyzed_count += 1
+      self.namespace.append_decl(fn)
+    self.by_group[group] = fn
+    return fn
+
+
+def _linked_from(node: bpy.types.Node) -> Iterator[bpy.types.Node]:
+  # if not enabled it doesn't show up in the UI (e.g. math node args) so ignore
+  return (i.links[0].from_node for i in node.inputs if i.enabled and i.is_linked)
+
+def plan_nodes(end_nodes: Iterable[bpy.types.Node], is_external: Optional[Callable[[bpy.types.Node], bool]] = None
+               ) -> Tuple[List[bpy.types.Node], Dict[bpy.types.Node, int]]:
+  """
+  the pre-pass of the analysis. Returns the nodes the end nodes depend on in topological order
+  (a node's inputs before it), and each node's fan-out, i.e. how many of their inputs read it.
+  Linear in the links, and without recursion since math chains can be very deep.
+  Nodes for which `is_external` is true are left out, along with what only they depend on
+  """
+  order: List[bpy.types.Node] = []
+  fan_out: Dict[bpy.types.Node, int] = {}
+  visited: Set[bpy.types.Node] = set()
+  for end_node in end_nodes:
+    if end_node in visited: continue
+    visited.add(end_node)
+    stack = [(end_node, _linked_from(end_node))]
+    while stack:
+      node, inputs = stack[-1]
+      for from_node in inputs:
+        if is_external is not None and is_external(from_node): continue
+        fan_out[from_node] = fan_out.get(from_node, 0) + 1
+        if from_node not in visited:
+          visited.add(from_node)
+          stack.append((from_node, _linked_from(from_node)))
+          break
+      else:
+        stack.pop()
+        order.append(node)
+  return order, fan_out
+
+def is_inlined(node: bpy.types.Node, fan_out: Dict[bpy.types.Node, int]) -> bool:
+  """whether a node's value is inlined into the expression reading it rather than becoming a decl"""
+  return node.type in inlined_node_types and fan_out.get(node) == 1
+
+def _read_decl(name: ast.Ident, link: bpy.types.NodeLink) -> ast.VarRef:
+  # inlined node types only have one output, so there's no member to access
+  return ast.VarRef(name, [] if link.from_node.type in inlined_node_types else [link.from_socket.name])
+
+# TODO: move to some module for dealing with blender nodes
+def get_default_value(i: bpy.types.NodeSocket) -> ast.Literal | None:
+  # compared by type rather than class so that snapshots (see `snapshot`) are analyzed the same
+  if i.type in ('VALUE', 'BOOLEAN', 'RGBA'):
+    if isinstance_bpy_prop_array(i.default_value):
+      return ast.Literal(float_array(i.default_value))
+    return ast.Literal.from_value(i.default_value)
+  return None
+
+def iter_node_decls(end_nodes: Iterable[bpy.types.Node], groups: GroupFunctions, emit_groups: bool = False,
+                    progress: Optional[Callable[[int, int], None]] = None,
+                    fan_out: Optional[Dict[bpy.types.Node, int]] = None,
+                    is_external: Optional[Callable[[bpy.types.Node], bool]] = None) -> Iterator[Decl]:
+  """
+  convert the nodes the end nodes depend on, generating decls in topological order as they are made.
+  Which nodes become decls is decided up front from their fan-out (see `plan_nodes`), so emitted
+  decls are never changed afterwards. With `emit_groups`, the fn decls of groups are generated
+  right before their first use.
+  `progress` is called with the (processed, total) count of nodes.
+  To convert only part of a graph (see `parallel`), `is_external` marks the decl nodes converted
+  elsewhere, which are read by name, and `fan_out` is the one of the whole graph
+  """
+  order, reads_left = plan_nodes(end_nodes, is_external)
+  if fan_out is None: fan_out = dict(reads_left)
+  # what reading a node's output becomes, an inlined expression or the name of its decl.
+  # It is dropped after the last read so that memory is bounded by the graph's frontier
+  code: Dict[bpy.types.Node, ast.Expr | ast.Ident] = {}
+
+  def read(link: bpy.types.NodeLink) -> ast.Expr:
+    from_node = link.from_node
+    # the group inputs are the parameters of the fn the group is lowered into
+    if from_node.type == 'GROUP_INPUT':
+      return ast.VarRef(ast.Ident(link.from_socket.name))
+    if is_external is not None and is_external(from_node):
+      return _read_decl(ast.Ident(from_node.name), link)
+    value = code[from_node]
+    reads_left[from_node] -= 1
+    if reads_left[from_node] == 0: del code[from_node]
+    return _read_decl(value, link) if isinstance(value, ast.Ident) else value
+
+  for done, node in enumerate(order, 1):
+    if progress is not None: progress(done, len(order))
+    if node.type == 'GROUP_INPUT': continue
 
     # TODO: might need to check properties of node against its base class to see if any extra properties are acting as dropdowns...
     # or just figure out how to get the dropdown properties
-    def get_input(i: bpy.types.NodeSocketShader) -> Input | None:
+    args: List[Tuple[str, ast.Node]] = []
+    for i in node.inputs:
+      if not i.enabled: continue
       if i.is_linked:
         assert len(i.links) == 1, "there can only be one input link if it is linked"
-        return Input(
-          value=i.links[0].from_socket.node,
-          link=i.links[0],
-          # TODO: analyze cast if the types aren't the same
-          # DEPRECATE
-          # from_name=i.links[0].from_socket.name,
-          # from_type=i.links[0].from_socket.name,
-          # to_name=i.links[0].to_socket.name,
-          # to_type=i.type,
-        )
+        # TODO: analyze cast if the types aren't the same
+        args.append((i.name, read(i.links[0])))
       else:
-        return get_default_value(i)
-
-    inputs = [(cast(str, i.name), get_input(i)) for i in node.inputs if i.enabled] # if not enabled it doesn't show up in the UI (e.g. math node args) so ignore
-    # TODO: this could be cleaned up
-    args = [(name, get_code_for_input(i.value, {'node': node, 'name': i.link.from_socket.name}))
-            if isinstance(i, Input)
-            else (name, i)
-            for name, i in inputs
-            if i is not None] # is None if get_default_value didn't extract a default value, i.e. wasn't a float
-    compound = blender_material_node_to_operation(node)(args)
+        default = get_default_value(i)
+        # is None if it wasn't a value, e.g. an unlinked shader input
+        if default is not None: args.append((i.name, default))
+
+    compound: ast.Node
+    match node.type:
+      case 'VALUE' | 'RGB':
+        compound = cast(ast.Literal, get_default_value(node.outputs[0]))
+      case 'GROUP':
+        known = len(groups.namespace.decls)
+        # the group's body is emitted once as a fn, here it is only called
+        compound = ast.Call(groups.get(node.node_tree).name, from_named(args))
+        if emit_groups:
+          yield from cast(List[ast.FnDecl], groups.namespace.decls[known:])
+      case _:
+        compound = blender_material_node_to_operation(node)(args)
 
+    if is_inlined(node, fan_out):
+      code[node] = cast(ast.Expr, compound)
+      continue
     type_ = blender_material_type_to_primitive(node.outputs[0].type) if node.outputs else None
+    # TODO: consolidate with ast.StructAssignment?
+    decl = ast.ConstDecl(name=ast.Ident(node.name), comment=node.label, type=type_, value=compound)
+    if node in reads_left: code[node] = decl.name
+    yield decl
+
+
+def analyze_group(groups: GroupFunctions, group: bpy.types.NodeTree) -> ast.FnDecl:
+  """lower a node group into a fn, its interface inputs become parameters and its group output the result"""
+  body = ast.Namespace()
+  params = [ast.Param(ast.Ident(s.name), blender_material_type_to_primitive(s.type) or None) for s in group.inputs]
+  fn = ast.FnDecl(ast.Ident(group.name), params, body)
+  output_node = next((n for n in group.nodes if n.type == 'GROUP_OUTPUT' and n.is_active_output), None)
+  if output_node is None: return fn
+
+  decls = list(iter_node_decls([output_node], groups))
+  # the group output is last in topological order
+  output_decl = cast(ast.ConstDecl, decls.pop())
+  for decl in decls:
+    body.append_decl(decl)
+  fn.result = output_decl.value
+  return fn
+
+
+def material_end_nodes(tree: bpy.types.NodeTree) -> List[bpy.types.Node]:
+  """the nodes nothing reads from, i.e. the outputs and dangling nodes. Frames only group nodes in the UI"""
+  return [n for n in tree.nodes if n.type != 'FRAME' and all(not o.links for o in n.outputs)]
+
+def iter_material_decls(material: bpy.types.Material, groups: Optional[GroupFunctions] = None,
+                        progress: Optional[Callable[[int, int], None]] = None) -> Iterator[Decl]:
+  """
+  the decls of a material in topological order, generated as they are converted so that they can
+  be serialized without ever holding the whole module. The fn decls of the node groups it uses
+  are included unless they are collected by a `groups` shared between materials
+  """
+  return iter_node_decls(material_end_nodes(material.node_tree), groups or GroupFunctions(), emit_groups=groups is None, progress=progress)
+
+def analyze_material(material: bpy.types.Material, groups: Optional[GroupFunctions] = None,
+                     progress: Optional[Callable[[int, int], None]] = None) -> ast.Module:
+  """convert a material into a module, see `iter_material_decls`"""
+  module = ast.Module()
+  for decl in iter_material_decls(material, groups, progress):
+    module.append_decl(decl)
+  return module
 
-    if isinstance(node, bpy.types.ShaderNodeMath):
-      node_to_code[node] = compound
-      return compound
-    else:
-      # TODO: consolidate with ast.StructAssignment?
-      decl = ast.ConstDecl(name=ast.Ident(node.name), comment=node.label, type=type_, value=compound)
-      node_to_code.namespace.append_decl(decl)
-      node_to_code[node] = decl
-      subfields = []
-      if referrer:
-        subfields = [referrer["name"]]
-      return ast.VarRef(decl.name, subfields)
-
-  get_code_for_input(output_node)
-
-  return node_to_code
+def write_material(material: bpy.types.Material, out: TextIO, groups: Optional[GroupFunctions] = None) -> None:
+  """convert and serialize a material decl by decl, like `analyze_material(material).serialize()`"""
+  for i, decl in enumerate(iter_material_decls(material, groups)):
+    if i > 0: out.write('\n')
+    out.write(decl.serialize())
 
 
-def analyze_material(material: bpy.types.Material) -> ast.Module:
-  module = ast.Module()
-  tree = material.node_tree
-  no_output_links: Callable[[bpy.types.Node], bool] = lambda n: all(not o.links for o in n.outputs)
-  end_nodes = [n for n in tree.nodes if no_output_links(n)]
+def analyze_library(materials: Iterable[bpy.types.Material]) -> Tuple[ast.Module, Dict[str, ast.Module]]:
+  """convert many materials, returning a module of the fn decls of all groups they share, and each material's module"""
+  groups = GroupFunctions()
+  modules = {m.name: analyze_material(m, groups) for m in materials}
+  return groups.namespace, modules
 
-  node_to_code = ProcessedNodesCollection(module)
-
-  for end_node in end_nodes:
-    analyze_output_node(node_to_code, end_node)
+class _TestAnalysis(unittest.TestCase):
+  @staticmethod
+  def make_material(chain: int = 0) -> bpy.types.Material:
+    material = bpy.types.Material('M')
+    tree = material.node_tree
+    value = tree.nodes.new('ShaderNodeValue')
+    shared = tree.nodes.new('ShaderNodeMath', operation='ADD')
+    once = tree.nodes.new('ShaderNodeMath', operation='MULTIPLY')
+    tree.links.new(value.outputs[0], shared.inputs[0])
+    # read twice, so it's a decl
+    tree.links.new(shared.outputs[0], once.inputs[0])
+    tree.links.new(shared.outputs[0], once.inputs[1])
+    prev = once
+    for _ in range(chain):
+      math = tree.nodes.new('ShaderNodeMath', operation='SUB')
+      tree.links.new(prev.outputs[0], math.inputs[0])
+      prev = math
+    bsdf = tree.nodes.new('ShaderNodeBsdfPrincipled')
+    out = tree.nodes.new('ShaderNodeOutputMaterial')
+    tree.links.new(prev.outputs[0], bsdf.inputs['Roughness'])
+    tree.links.new(bsdf.outputs[0], out.inputs['Surface'])
+    return material
+
+  def test_promotion(self):
+    self.assertEqual(analyze_material(self.make_material()).serialize().split('\n'), [
+      'const Math: f32 = (0.5 + 0.5)',
+      "const BsdfPrincipled: bsdf = pbr_shader(.'Base Color'=[0.8, 0.8, 0.8, 1.0], .Metallic=0.0, .Roughness=(Math * Math))",
+      'const OutputMaterial = output(.Surface=BsdfPrincipled.BSDF)',
+    ])
+
+  def test_stream(self):
+    material = self.make_material(chain=50)
+    out = io.StringIO()
+    write_material(material, out)
+    self.assertEqual(analyze_material(material).serialize(), out.getvalue())
+    # decls are generated as soon as they're converted
+    processed = []
+    decls = iter_material_decls(material, progress=lambda done, total: processed.append(done))
+    next(decls)
+    self.assertLess(processed[-1], len(material.node_tree.nodes))
+
+  def test_deep(self):
+    # the analysis doesn't recurse per node
+    material = self.make_material(chain=5000)
+    decls = list(iter_material_decls(material))
+    self.assertEqual(['Math', 'BsdfPrincipled', 'OutputMaterial'], [d.name.name for d in decls])
+    # and neither do serializing the chain, inlined into a single expression, and parsing it back
+    out = io.StringIO()
+    write_material(material, out)
+    reparsed = ast.Namespace.parse(ParseContext(out.getvalue()))
+    assert isinstance(reparsed, ast.Namespace)
+    self.assertEqual(out.getvalue(), reparsed.serialize())
+    self.assertEqual([type(n) for d in decls for n in ast.walk(d)],
+                     [type(n) for d in reparsed.decls for n in ast.walk(d) if not isinstance(n, ast.ParenGroup)])
+
+class _TestGroupFunctions(unittest.TestCase):
+  @staticmethod
+  def make_group(name: str) -> bpy.types.NodeTree:
+    group = bpy.types.ShaderNodeTree(name)
+    group.inputs.new('NodeSocketFloat', 'Fac').default_value = 0.5
+    group.outputs.new('NodeSocketFloat', 'Result')
+    group_in = group.nodes.new('NodeGroupInput')
+    group_out = group.nodes.new('NodeGroupOutput')
+    double = group.nodes.new('ShaderNodeMath', operation='MULTIPLY')
+    group.links.new(group_in.outputs['Fac'], double.inputs[0])
+    group.links.new(double.outputs[0], group_out.inputs['Result'])
+    return group
 
-  return module
+  @staticmethod
+  def make_material(name: str, group: bpy.types.NodeTree) -> bpy.types.Material:
+    material = bpy.types.Material(name)
+    tree = material.node_tree
+    first = tree.nodes.new('ShaderNodeGroup', node_tree=group)
+    second = tree.nodes.new('ShaderNodeGroup', node_tree=group)
+    bsdf = tree.nodes.new('ShaderNodeBsdfPrincipled')
+    out = tree.nodes.new('ShaderNodeOutputMaterial')
+    tree.links.new(first.outputs['Result'], second.inputs['Fac'])
+    tree.links.new(second.outputs['Result'], bsdf.inputs['Roughness'])
+    tree.links.new(bsdf.outputs[0], out.inputs['Surface'])
+    return material
+
+  def test_material(self):
+    module = analyze_material(self.make_material('M', self.make_group('Double')))
+    self.assertEqual(module.serialize().split('\n'), [
+      'fn Double(Fac: f32) {',
+      '  return output(.Result=(Fac * 0.5))',
+      '}',
+      'const Group: f32 = Double(.Fac=0.5)',
+      "const 'Group.001': f32 = Double(.Fac=Group.Result)",
+      "const BsdfPrincipled: bsdf = pbr_shader(.'Base Color'=[0.8, 0.8, 0.8, 1.0], .Metallic=0.0, .Roughness='Group.001'.Result)",
+      'const OutputMaterial = output(.Surface=BsdfPrincipled.BSDF)',
+    ])
+
+  def test_hash(self):
+    group, copy = self.make_group('Double'), self.make_group('Double.001')
+    # node names aren't hashed, so groups that only differ in them are still shared
+    copy.nodes['Math'].name = 'Renamed'
+    self.assertEqual(node_tree_hash(group), node_tree_hash(copy))
+    # every setting is, not only the ones of math and mix nodes
+    snapshots = [snapshot_tree(group), snapshot_tree(copy)]
+    for snapshot, interpolation in zip(snapshots, ('LINEAR', 'STEPPED')):
+      snapshot.nodes.append(NodeSnapshot('Map Range', 'MAP_RANGE', 'ShaderNodeMapRange',
+                                         props={'data_type': 'FLOAT', 'interpolation_type': interpolation}))
+    self.assertNotEqual(node_tree_hash(snapshots[0]), node_tree_hash(snapshots[1]))
+
+  def test_library(self):
+    group = self.make_group('Double')
+    # an identical copy, like appending the same group from another file
+    copy = self.make_group('Double.001')
+    materials = [self.make_material(f'M{i}', group if i % 2 else copy) for i in range(50)]
+    library, modules = analyze_library(materials)
+    self.assertEqual(['Double.001'], [fn.name.name for fn in library.decls])
+    self.assertEqual(50, len(modules))
+    self.assertIn("const Group: f32 = 'Double.001'(.Fac=0.5)", modules['M1'].serialize())
 
-# TEMP: for prettier output in tests
-print("test")
 if in_blender:
-  print("test2")
   out_ast = analyze_material(bpy.data.materials["Test"])
   print(Ansi.Colors.yellow)
   print(out_ast.serialize())
@@ -3,14 +3,16 @@ Ast of nodelang for use in blender (and prototype)
 """
 
 from abc import ABC, abstractmethod
+from array import array
+import dataclasses
 from dataclasses import dataclass, field
 import typing
-from typing import Any, Mapping, cast, Dict, List, Optional, ClassVar, Union, Sequence
+from typing import Any, Iterator, Mapping, Tuple, TypeVar, cast, Dict, List, Optional, ClassVar, Union, Sequence
 from .bpy_wrap import bpy
 import re
 import unittest
 
-from .parser import MaybeParsed, ParseContext, ParseError, ParseNonLexError, TokenizeErr
+from .parser import ErrUnion, MaybeParsed, ParseContext, ParseError, ParseNonLexError, TokenizeErr
 from . import token
 
 # FIXME: in python3.11 add a primitive_types_raw list and unpack it into the Literal type below
@@ -41,9 +43,10 @@ class Node(ABC):
   For performance might want to use slots and include a higher level referencing node that
   can have its type changed.
   """
-  start: int
-  end: int
-  src: str
+  # the source the node was parsed from, see `spanned`. Nodes that weren't parsed have a start of -1
+  start: int = -1
+  end: int = -1
+  src: str = ''
 
   def slice(self) -> str:
     return self.src[self.start:self.end]
@@ -52,6 +55,10 @@ class Node(ABC):
   def serialize(self, c: SerializeCtx = SerializeCtx()) -> str:
     pass
 
+  def serialize_parts(self, c: SerializeCtx) -> Sequence[Union[str, "Node"]]:
+    """the text of the node with its children left as nodes, see `serialize_tree`"""
+    return [self.serialize(c)]
+
   @staticmethod
   def hardFinishParse(pctx: ParseContext, **ctx: Any) -> Union[ParseError, "Node"]:
     """
@@ -63,6 +70,64 @@ class Node(ABC):
   def to_blender_node_args(self) -> Optional[Sequence[Mapping[str, Any]]]:
     raise TypeError(f'{type(self).__name__} does not coerce to a blender node')
 
+N = TypeVar('N', bound=Node)
+
+def spanned(node: N, pctx: ParseContext, start: int) -> N:
+  """record that a node was parsed from `start` up to where the parser is now"""
+  node.start, node.end, node.src = start, pctx.index, pctx.source
+  return node
+
+# nodes without children keep the default, their text is their `serialize`
+_leaf_parts = Node.serialize_parts
+
+def serialize_tree(root: Node, c: SerializeCtx = SerializeCtx()) -> str:
+  """serialize a node through `serialize_parts` with an explicit stack, since expressions can be very deep"""
+  out: List[str] = []
+  stack: List[Union[str, Node]] = [root]
+  while stack:
+    item = stack.pop()
+    if type(item) is str:
+      out.append(item)
+      continue
+    if type(item).serialize_parts is _leaf_parts:
+      out.append(item.serialize(c))
+      continue
+    parts = item.serialize_parts(c)
+    # text and leaves are written right away, the stack only holds what follows a node with children
+    for i, part in enumerate(parts):
+      if type(part) is str: out.append(part)
+      elif type(part).serialize_parts is _leaf_parts: out.append(part.serialize(c))
+      else:
+        stack += reversed(parts[i:])
+        break
+  return ''.join(out)
+
+# field names by node type, `dataclasses.fields` is slow for how often trees are walked
+_field_names: Dict[type, Tuple[str, ...]] = {}
+
+def children(node: Node) -> List[Node]:
+  """the nodes directly in a node, in the order of its fields (which is their order in the source)"""
+  names = _field_names.get(type(node))
+  if names is None:
+    names = _field_names[type(node)] = (tuple(f.name for f in dataclasses.fields(node))
+                                        if dataclasses.is_dataclass(node) else ())
+  result: List[Node] = []
+  for name in names:
+    value = getattr(node, name)
+    if isinstance(value, Node):
+      result.append(value)
+    elif isinstance(value, list):
+      result.extend(v for v in value if isinstance(v, Node))
+  return result
+
+def walk(node: Node) -> Iterator[Node]:
+  """every node of a tree in pre-order, without recursing (trees can be very deep)"""
+  stack: List[Node] = [node]
+  while stack:
+    cur = stack.pop()
+    yield cur
+    stack.extend(reversed(children(cur)))
+
 @dataclass(unsafe_hash=True)
 class Ident(Node):
   name: str
@@ -80,7 +145,7 @@ class Ident(Node):
     # TODO: create a zig-like _try function
     if tok is None or isinstance(tok, ParseError):
       return tok
-    return Ident(cast(token.Ident, tok.tok).name)
+    return spanned(Ident(cast(token.Ident, tok.tok).name), pctx, pctx.index - len(tok.slice))
 
 class _TestIdent(unittest.TestCase):
   def test_parse(self):
@@ -104,22 +169,94 @@ class Struct(Named):
 
 Type = PrimitiveType | Struct
 
-# including None for now since not yet sure how to represent an empty optional shader
-PrimitiveValue = str | int | float | bool | None | List["PrimitiveValue"]
+def serialize_type(type_: Optional[Type], c: SerializeCtx) -> str:
+  if not type_: return ''
+  elif isinstance(type_, Struct): return type_.name.serialize(c)
+  else: return type_
+
+def serialize_doc_comment(comment: Optional[str]) -> str:
+  """the `///` lines of a decl's doc comment, which spans several lines if it was parsed from several"""
+  if not comment: return ''
+  return ''.join(f'/// {line}'.rstrip() + '\n' for line in comment.split('\n'))
+
+# including None for now since not yet sure how to represent an empty optional shader.
+# Lists of only floats or only ints are typed arrays (see `typed_array`), e.g. colors and ramp points
+PrimitiveValue = str | int | float | bool | None | array | List["PrimitiveValue"]
+
+def typed_array(vals: Sequence[Any]) -> Optional[array]:
+  """the values as an array of doubles ('d') or 64 bit ints ('q') if they're all of that type"""
+  types = set(map(type, vals))
+  try:
+    if types == {float}: return array('d', vals)
+    if types == {int}: return array('q', vals)
+  except OverflowError:
+    pass
+  return None
+
+# arrays of 4 or fewer elements have GLSL-like swizzle members, e.g. `.x`, `.gb`, `.xxyy`
+swizzle_sets = ('xyzw', 'rgba')
+max_swizzle_size = 4
+
+def swizzle_indices(deref: str) -> Optional[List[int]]:
+  """the elements a swizzle member selects, None if it isn't one"""
+  components = next((s for s in swizzle_sets if all(c in s for c in deref)), None)
+  return None if components is None else [components.index(c) for c in deref]
 
 @dataclass
 class Literal(Node):
   val: PrimitiveValue
 
+  # lists of only floats or only ints, which are parsed in one pass
+  float_list_pattern: ClassVar[re.Pattern[str]] = re.compile(r'\s*([0-9]+\.[0-9]+(?:\s*,\s*[0-9]+\.[0-9]+)*)\s*,?\s*\]')
+  int_list_pattern: ClassVar[re.Pattern[str]] = re.compile(r'\s*([0-9]+(?:\s*,\s*[0-9]+)*)\s*,?\s*\]')
+
   def serialize(self, c: SerializeCtx = SerializeCtx()) -> str:
+    if isinstance(self.val, array):
+      return f"[{', '.join(map(str, self.val))}]"
     if isinstance(self.val, list):
       return f"[{', '.join(Literal.from_value(l).serialize(c) for l in self.val)}]"
     return str(self.val)
 
+  def swizzle(self, deref: str) -> "Literal":
+    """a swizzle member of an array literal, e.g. `.x` or `.rgb`"""
+    indices = swizzle_indices(deref)
+    if (indices is None or not isinstance(self.val, (array, list)) or len(self.val) > max_swizzle_size
+        or max(indices) >= len(self.val)):
+      raise TypeError(f"literal {self.serialize()} has no member '.{deref}'")
+    if len(indices) == 1: return Literal(self.val[indices[0]])
+    return Literal.from_value([self.val[i] for i in indices])
+
+  @staticmethod
+  def hardFinishParseList(pctx: ParseContext) -> Union[ParseError, "Literal"]:
+    """assumes the left bracket has been parsed, only literal elements are supported"""
+    for pattern, typecode, convert in ((Literal.float_list_pattern, 'd', float), (Literal.int_list_pattern, 'q', int)):
+      match = pattern.match(pctx.source, pctx.index)
+      if match is None: continue
+      try:
+        vals = array(typecode, map(convert, match.group(1).split(',')))
+      except OverflowError:
+        break
+      pctx.reset(match.end())
+      return Literal(vals)
+
+    elems: List[PrimitiveValue] = []
+    while True:
+      end = pctx.try_consume_tok_type(token.Type.rBrack)
+      if isinstance(end, TokenizeErr): return end
+      if end is not None: return Literal.from_value(elems)
+      elem = PrimaryExpr.parse(pctx)
+      if isinstance(elem, ParseError): return elem
+      if elem is None: return ParseNonLexError.UnexpectedEof
+      if not isinstance(elem, Literal): return ParseNonLexError.UnexpectedToken
+      elems.append(elem.val)
+      comma = pctx.try_consume_tok_type(token.Type.comma)
+      if isinstance(comma, TokenizeErr): return comma
+
   @staticmethod
   def from_value(val: PrimitiveValue) -> "Literal":
-    if not isinstance(val, (str, float, int, bool, list, type(None))):
+    if not isinstance(val, (str, float, int, bool, list, array, type(None))):
       raise RuntimeError(f"unknown value '{val}' with type '{type(val)}' attempted to be used as a literal")
+    if isinstance(val, list): return Literal(typed_array(val) or val)
     return Literal(val)
 
   def to_blender_node_args(self):
@@ -138,6 +275,27 @@ class Literal(Node):
       case _:
         raise TypeError(f'Literal with value "{self.val}" had unhandled type when converting to node')
 
+class _TestLiteral(unittest.TestCase):
+  def test_typed_arrays(self):
+    for src, typecode in (('[0.25, 1.0, 0.5]', 'd'), ('[1, 2, 3]', 'q')):
+      parsed = Expr.parse(ParseContext(src))
+      self.assertIsInstance(parsed.val, array)
+      self.assertEqual(typecode, parsed.val.typecode)
+      self.assertEqual(src, parsed.serialize())
+    # elements of different types, or split by comments, are parsed one by one
+    self.assertEqual([1, 0.5, 2], Expr.parse(ParseContext('[1, 0.5, 2]')).val)
+    commented = Expr.parse(ParseContext('[0.5, // half\n 1.5,]'))
+    self.assertEqual(array('d', [0.5, 1.5]), commented.val)
+    # too big for 64 bits
+    self.assertEqual([2**70], Expr.parse(ParseContext(f'[{2**70}]')).val)
+
+  def test_swizzle(self):
+    color = Literal.from_value([0.1, 0.2, 0.3, 1.0])
+    self.assertEqual(Literal(0.3), color.swizzle('z'))
+    self.assertEqual('[0.3, 0.2, 0.1]', color.swizzle('bgr').serialize())
+    with self.assertRaises(TypeError): Literal.from_value([0.5] * 5).swizzle('x')
+    with self.assertRaises(TypeError): Literal.from_value([0.5, 0.5]).swizzle('z')
+
 @dataclass
 class VarRef(Node, Named):
   derefs: List[str] = field(default_factory=list) # maybe convert this to binary dot operators
@@ -151,15 +309,125 @@ class VarRef(Node, Named):
 
 
 
+@dataclass
+class _ExprFrame:
+  """an expression being parsed at one level of nesting, see `Expr.parse`"""
+  # where the parentheses or call around the expression start, -1 at the top level
+  start: int = -1
+  # the called function if the expression is a call argument, with the previous arguments
+  call: Optional["Ident"] = None
+  args: List[Union["NamedArg", "Expr"]] = field(default_factory=list)
+  # the name and start of a named argument
+  arg_name: Optional["Ident"] = None
+  arg_start: int = -1
+  # operands and the operators between them that are still waiting for tighter binding ones
+  operands: List[Node] = field(default_factory=list)
+  ops: List["BinOp.Types"] = field(default_factory=list)
+
+  def reduce(self, min_prec: int) -> None:
+    """combine the pending operators binding at least as tight as `min_prec`, left to right"""
+    while self.ops and BinOp.precedences[self.ops[-1]] >= min_prec:
+      right, left = self.operands.pop(), self.operands.pop()
+      binop = BinOp(self.ops.pop(), cast(Expr, left), cast(Expr, right))
+      binop.start, binop.end, binop.src = left.start, right.end, right.src
+      self.operands.append(binop)
+
+  def parse_arg_name(self, pctx: ParseContext) -> Optional[ParseError]:
+    """the optional `.name=` before a call argument"""
+    self.arg_name = None
+    dot = pctx.try_consume_tok_type(token.Type.dot)
+    if isinstance(dot, TokenizeErr): return dot
+    if dot is None: return None
+    self.arg_start = pctx.index - len(dot.slice)
+    name = Ident.parse(pctx)
+    if isinstance(name, ParseError): return name
+    if name is None: return ParseNonLexError.UnexpectedToken
+    eq = pctx.try_consume_tok_type(token.Type.eq)
+    if isinstance(eq, TokenizeErr): return eq
+    if eq is None: return ParseNonLexError.UnexpectedToken
+    self.arg_name = name
+    return None
+
 class Expr(Node):
   """non-instantiable static method class"""
   # TODO: Expr = Literal | VarRef # | Call | BinOp
   # TODO: maybe don't allow None return?
   @staticmethod
   def parse(pctx: ParseContext) -> MaybeParsed["Expr"]:
-    left = PrimaryExpr.parse(pctx)
-    if left is None or isinstance(left, ParseError): return left
-    return BinOp.hardFinishParse(pctx) or left
+    """
+    parse operands and binary operators by precedence, with a frame per open parenthesis or call
+    instead of recursing, since converted math chains nest deeply
+    """
+    frames: List[_ExprFrame] = [_ExprFrame()]
+    while True:
+      frame = frames[-1]
+      tok = pctx.consume_tok()
+      if isinstance(tok, TokenizeErr): return tok
+      if tok is None:
+        if frame.ops or frame.call is not None: return ParseNonLexError.UnexpectedEof
+        return None if len(frames) == 1 else ParseNonLexError.UnexpectedToken
+      start = pctx.index - len(tok.slice)
+
+      operand: MaybeParsed[Node]
+      if tok.tok is token.Type.lPar:
+        frames.append(_ExprFrame(start))
+        continue
+      if isinstance(tok.tok, token.Ident):
+        before_next = pctx.index
+        l_par = pctx.try_consume_tok_type(token.Type.lPar)
+        if isinstance(l_par, TokenizeErr): return l_par
+        pctx.reset(before_next)
+        if l_par is not None:
+          ident = spanned(Ident(tok.tok.name), pctx, start)
+          pctx.consume_tok()
+          r_par = pctx.try_consume_tok_type(token.Type.rPar)
+          if isinstance(r_par, TokenizeErr): return r_par
+          if r_par is None:
+            frames.append(_ExprFrame(start, call=ident))
+            error = frames[-1].parse_arg_name(pctx)
+            if error is not None: return error
+            continue
+          operand = spanned(Call(ident, []), pctx, start)
+        else:
+          operand = PrimaryExpr.finishParse(pctx, tok, start)
+      else:
+        operand = PrimaryExpr.finishParse(pctx, tok, start)
+      if operand is None: return ParseNonLexError.UnexpectedToken
+      if isinstance(operand, ParseError): return operand
+
+      # after an operand, either an operator or the end of the frame's expression
+      while True:
+        frame.operands.append(operand)
+        op = BinOp._peek_op(pctx)
+        if isinstance(op, TokenizeErr): return op
+        if op is not None:
+          frame.reduce(BinOp.precedences[op])
+          frame.ops.append(op)
+          pctx.consume_tok()
+          break
+        frame.reduce(0)
+        expr = cast(Expr, frame.operands.pop())
+        if len(frames) == 1: return expr
+
+        if frame.call is None:
+          r_par = pctx.try_consume_tok_type(token.Type.rPar)
+          if isinstance(r_par, TokenizeErr): return r_par
+          if r_par is None: return ParseNonLexError.UnexpectedToken
+          frames.pop()
+          operand = spanned(ParenGroup(expr), pctx, frame.start)
+        else:
+          frame.args.append(spanned(NamedArg(frame.arg_name, expr), pctx, frame.arg_start)
+                            if frame.arg_name is not None else expr)
+          end = pctx.try_consume_tok_type(token.Type.rPar, token.Type.comma)
+          if isinstance(end, TokenizeErr): return end
+          if end is None: return ParseNonLexError.UnexpectedEof
+          if not token.Type.isinstance(end, token.Type.rPar):
+            error = frame.parse_arg_name(pctx)
+            if error is not None: return error
+            break
+          frames.pop()
+          operand = spanned(Call(frame.call, frame.args), pctx, frame.start)
+        frame = frames[-1]
 
 
 @dataclass
@@ -167,21 +435,27 @@ class NamedArg(Node, Named):
   val: Expr
 
   def serialize(self, c: SerializeCtx = SerializeCtx()):
-    return f".{self.name.serialize(c)}={self.val.serialize(c)}"
+    return serialize_tree(self, c)
+
+  def serialize_parts(self, c: SerializeCtx) -> Sequence[Union[str, Node]]:
+    return [f".{self.name.serialize(c)}=", self.val]
 
 @dataclass
 class Call(Node, Named):
   args: List[NamedArg | Expr]
 
   def serialize(self, c: SerializeCtx = SerializeCtx()):
+    return serialize_tree(self, c)
+
+  def serialize_parts(self, c: SerializeCtx) -> Sequence[Union[str, Node]]:
     arg_per_line = len(self.args) > 4
-    nl = '\n'
     indent = '  ' # TODO: do real tree formatting
-    return f'''{self.name.serialize(c)}({
-      nl+indent if arg_per_line else ''
-    }{(','+nl+indent if arg_per_line else ', ').join(a.serialize(c) for a in self.args)}{
-      nl if arg_per_line else ''
-    })'''
+    parts: List[Union[str, Node]] = [f'{self.name.serialize(c)}(' + ('\n' + indent if arg_per_line else '')]
+    for i, arg in enumerate(self.args):
+      if i > 0: parts.append(',\n' + indent if arg_per_line else ', ')
+      parts.append(arg)
+    parts.append(('\n' if arg_per_line else '') + ')')
+    return parts
 
 
 @dataclass
@@ -221,66 +495,49 @@ class BinOp(Node):
     '^/': 9,
   }
 
+  operations: ClassVar[Mapping[Types, str]] = {
+    '|': 'BITWISEOR',
+    '||': 'OR',
+    '&&': 'AND',
+    '&': 'BITWISEAND',
+    '+': 'ADD',
+    '-': 'SUB',
+    '*': 'MUL',
+    '/': 'DIV',
+    '^': 'BITWISEXOR',
+    '**': 'EXP',
+    '^^': 'POW',
+    '^/': 'ROOT',
+  }
+
   op: Types
   left: "Expr"
   right: "Expr"
 
+  def serialize(self, c: SerializeCtx = SerializeCtx()):
+    return serialize_tree(self, c)
+
   # TODO: instead of always wrapping in `()` that should be a part of the AST not of the serialization
   # TODO: print print using serialization context
-  def serialize(self, c: SerializeCtx = SerializeCtx()):
-    return f'({self.left.serialize(c)} {self.op} {self.right.serialize(c)})'
+  def serialize_parts(self, c: SerializeCtx) -> Sequence[Union[str, Node]]:
+    return ['(', self.left, f' {self.op} ', self.right, ')']
 
-  # FIXME: this is not really a hardFinishParse since it can return just the left expr...
   @staticmethod
-  def hardFinishParse(pctx: ParseContext, **ctx: Node) -> Union[ParseError, "Expr"]:
-    """expects that the parser has already consumed the left expression"""
-    left = ctx.get("left")
-    if left is None: raise RuntimeError("BinOp.hardFinishParse called without a `left: Node` kwarg")
-
-    cur_prec = 0
-    while True:
-      tok = pctx.consume_tok()
-      if tok is None: return ParseNonLexError.UnexpectedEof
-      if isinstance(tok, TokenizeErr): return tok
-      # this looks wrong:
-      if not token.Type.isinstance(tok, BinOp._tokenList): return ParseNonLexError.UnexpectedToken
-      prec = BinOp.precedences[cast(BinOp.Types, tok.slice)]
-      if prec < cur_prec:
-        return cast(Expr, left)
-      right = PrimaryExpr.parse(pctx)
-
-      before_next_op = pctx.index
-      maybe_next_op = pctx.consume_tok()
-      if maybe_next_op is None: return ParseNonLexError.UnexpectedEof
-      if isinstance(maybe_next_op, TokenizeErr): return maybe_next_op
-      # this looks wrong:
-      if not token.Type.isinstance(maybe_next_op, BinOp._tokenList): return ParseNonLexError.UnexpectedToken
-      next_op = maybe_next_op
-      next_op_prec = BinOp.precedences[cast(BinOp.Types, next_op.slice)]
-      pctx.reset(before_next_op)
-
-      if prec < next_op_prec:
-        right = BinOp.hardFinishParse(pctx, left=right)
+  def _peek_op(pctx: ParseContext) -> ErrUnion[TokenizeErr, Optional["BinOp.Types"]]:
+    """look at the next token without consuming it, returning it if it is a binary operator"""
+    before = pctx.index
+    tok = pctx.consume_tok()
+    pctx.reset(before)
+    if isinstance(tok, TokenizeErr): return tok
+    if tok is None or not token.Type.isinstance(tok, BinOp._tokenList): return None
+    return cast(BinOp.Types, tok.slice)
 
   def to_blender_node_args(self):
     return {
       'type': "ShaderNodeMath",
       'value': self.left,
       'value': self.right,
-      operation: {
-        '|': 'BITWISEOR',
-        '||': 'OR',
-        '&&': 'AND',
-        '&': 'BITWISEAND',
-        '+': 'ADD',
-        '-': 'SUB',
-        '*': 'MUL',
-        '/': 'DIV',
-        '^': 'BITWISEXOR',
-        '**': 'EXP',
-        '^^': 'POW',
-        '^/': 'ROOT',
-      }[self.op]
+      'operation': BinOp.operations[self.op],
     }
 
 
@@ -292,47 +549,77 @@ class ConstDecl(Node):
   type: Optional[Type] = None
   
   def serialize_type(self, c: SerializeCtx) -> str:
-    if not self.type: return ''
-    elif isinstance(self.type, Struct): return self.type.name.serialize(c)
-    else: return self.type
+    return serialize_type(self.type, c)
 
   def serialize(self, c: SerializeCtx = SerializeCtx()):
-    return (
-      (f'/// {self.comment}' + '\n' if self.comment else '')
+    return serialize_tree(self, c)
+
+  def serialize_parts(self, c: SerializeCtx) -> Sequence[Union[str, Node]]:
+    return [
+      serialize_doc_comment(self.comment)
       + f'const {self.name.serialize(c)}'
       + (f': {self.serialize_type(c)}' if self.type else '')
-      + f' = {self.value.serialize(c)}'
-    )
+      + ' = ',
+      self.value,
+    ]
+
+  @staticmethod
+  def parse_type(pctx: ParseContext) -> MaybeParsed[Type]:
+    """parse a type expression like `f32[4]` or `MyStruct`, assumes the colon was consumed"""
+    name_tok = pctx.try_consume_tok_type(token.Type.ident)
+    if name_tok is None or isinstance(name_tok, TokenizeErr): return name_tok
+    name = cast(token.Ident, name_tok.tok).name
+
+    lBrack = pctx.try_consume_tok_type(token.Type.lBrack)
+    if isinstance(lBrack, TokenizeErr): return lBrack
+    if lBrack is not None:
+      size = pctx.try_consume_tok_type(token.Type.int)
+      if size is None or isinstance(size, TokenizeErr): return size or ParseNonLexError.UnexpectedToken
+      rBrack = pctx.try_consume_tok_type(token.Type.rBrack)
+      if rBrack is None or isinstance(rBrack, TokenizeErr): return rBrack or ParseNonLexError.UnexpectedToken
+      name = f'{name}[{size.tok}]'
+
+    if name.partition('[')[0] in typing.get_args(PrimitiveType):
+      return cast(PrimitiveType, name)
+    return Struct(Ident(name))
 
   @staticmethod
   def parse(pctx: ParseContext) -> MaybeParsed["ConstDecl"]:
+    """parse `const name[: type] = expr[;]`, returns None without consuming if there is no `const`"""
     start = pctx.index
-    results: list[token.Token] = []
-
-    # TODO: support Node types with parse methods, and parse any expression not just int
-    for nodeOrTokType in (token.Type.const,
-                          token.Type.ident,
-                          token.Type.colon,
-                          token.Type.ident,
-                          token.Type.eq,
-                          token.Type.int):
-      parsed = pctx.try_consume_tok_type(nodeOrTokType)
-      # TODO: create a zig-like _try function
-      if parsed is None or isinstance(parsed, TokenizeErr):
-        pctx.reset(start)
-        return
-      results.append(parsed)
-
-    _, ident, _, _type_expr, _, val = results
-
-    ident = Ident(cast(token.Ident, ident.tok).name)
-
-    return ConstDecl(
-      ident,
-      Literal(cast(int, val)),
-      None,
-      # _type_expr # need to check the name against known types? (and parse full expressions)
-    )
+    const = pctx.try_consume_tok_type(token.Type.const)
+    if const is None or isinstance(const, TokenizeErr):
+      pctx.reset(start)
+      return const
+    start = pctx.index - len(const.slice)
+
+    # TODO: create a zig-like _try function
+    ident = pctx.try_consume_tok_type(token.Type.ident)
+    if isinstance(ident, TokenizeErr): return ident
+    if ident is None: return ParseNonLexError.UnexpectedToken
+    name = spanned(Ident(cast(token.Ident, ident.tok).name), pctx, pctx.index - len(ident.slice))
+
+    type_: Optional[Type] = None
+    colon = pctx.try_consume_tok_type(token.Type.colon)
+    if isinstance(colon, TokenizeErr): return colon
+    if colon is not None:
+      parsed_type = ConstDecl.parse_type(pctx)
+      if isinstance(parsed_type, ParseError): return parsed_type
+      if parsed_type is None: return ParseNonLexError.UnexpectedToken
+      type_ = parsed_type
+
+    eq = pctx.try_consume_tok_type(token.Type.eq)
+    if isinstance(eq, TokenizeErr): return eq
+    if eq is None: return ParseNonLexError.UnexpectedToken
+
+    value = Expr.parse(pctx)
+    if isinstance(value, ParseError): return value
+    if value is None: return ParseNonLexError.UnexpectedEof
+
+    semicolon = pctx.try_consume_tok_type(token.Type.semicolon)
+    if isinstance(semicolon, TokenizeErr): return semicolon
+
+    return spanned(ConstDecl(name, cast(Literal | VarRef | BinOp, value), None, type_), pctx, start)
 
 class _TestConstDecl(unittest.TestCase):
   def test_parse(self):
@@ -340,6 +627,35 @@ class _TestConstDecl(unittest.TestCase):
     parsed = ConstDecl.parse(pctx)
     self.assertIsNotNone(parsed)
     self.assertEqual("x", parsed.name.name)
+    self.assertEqual(Struct(Ident("Test")), parsed.type)
+    self.assertEqual("const x: Test = 5", parsed.serialize())
+
+  def test_parse_expr(self):
+    pctx = ParseContext("const 'my var': f32[4] = a * (2 + b.x); const y = sin(1)")
+    parsed = ConstDecl.parse(pctx)
+    self.assertEqual("const 'my var': f32[4] = (a * (2 + b.x))", parsed.serialize())
+    self.assertEqual("const y = sin(1)", ConstDecl.parse(pctx).serialize())
+
+  def test_spans(self):
+    src = "  const a = (b + 1) * f(.x=c.y);"
+    parsed = ConstDecl.parse(ParseContext(src))
+    self.assertEqual(src.strip(), parsed.slice())
+    self.assertEqual(["a", "(b + 1) * f(.x=c.y)", "(b + 1)", "b + 1", "b", "b", "1", "f(.x=c.y)", "f", ".x=c.y", "x", "c.y", "c"],
+                     [n.slice() for n in list(walk(parsed))[1:]])
+    self.assertEqual(-1, ConstDecl(Ident("a"), Literal(1)).start)
+
+class _TestBinOp(unittest.TestCase):
+  def test_precedence(self):
+    parsed = Expr.parse(ParseContext("1 + 2 * 3 ^^ 4 + 5"))
+    self.assertEqual("((1 + (2 * (3 ^^ 4))) + 5)", parsed.serialize())
+
+  def test_deep(self):
+    # neither parsing nor serializing recurses per nesting level
+    src = "(" * 5000 + "1" + " + 2)" * 5000
+    parsed = Expr.parse(ParseContext(src))
+    self.assertIsInstance(parsed, ParenGroup)
+    self.assertEqual(src, parsed.serialize())
+    self.assertEqual("f(" * 3000 + "x" + ")" * 3000, Expr.parse(ParseContext("f(" * 3000 + "x" + ")" * 3000)).serialize())
 
 @dataclass
 class StructAssignment(Node):
@@ -354,33 +670,183 @@ class Namespace(Node):
   decls: List[Node] = field(default_factory=list)
   decl_by_name: Dict[Ident, Node] = field(default_factory=dict)
 
-  def append_decl(self, decl: ConstDecl) -> None:
+  def append_decl(self, decl: Union[ConstDecl, "FnDecl"]) -> None:
     self.decls.append(decl)
     self.decl_by_name[decl.name] = decl
   
-  def prepend_decl(self, new_decl: ConstDecl, target: Optional[ConstDecl] = None) -> None:
+  def prepend_decl(self, new_decl: Union[ConstDecl, "FnDecl"], target: Optional[ConstDecl] = None) -> None:
     index = 0 if target is None else self.decls.index(target)
     self.decls.insert(index, new_decl)
     self.decl_by_name[new_decl.name] = new_decl
 
   def serialize(self, c: SerializeCtx = SerializeCtx()):
-    return '\n'.join(d.serialize(c) for d in self.decls)
+    return serialize_tree(self, c)
+
+  def serialize_parts(self, c: SerializeCtx) -> Sequence[Union[str, Node]]:
+    parts: List[Union[str, Node]] = []
+    for i, decl in enumerate(self.decls):
+      if i > 0: parts.append('\n')
+      parts.append(decl)
+    return parts
+
+  @staticmethod
+  def parse(pctx: ParseContext) -> Union[ParseError, "Namespace"]:
+    """parse declarations until the end of the source"""
+    namespace = Namespace()
+    while True:
+      comment = pctx.try_consume_doc_comment()
+      if not pctx.skipAvailable(): return namespace
+      decl = ConstDecl.parse(pctx) or FnDecl.parse(pctx)
+      if decl is None: return ParseNonLexError.UnexpectedToken
+      if isinstance(decl, ParseError): return decl
+      decl.comment = comment
+      namespace.append_decl(decl)
 
   def to_blender_node_args(self):
       return [d.to_blender_node_args for d in self.decls]
 
+class _TestNamespace(unittest.TestCase):
+  def test_parse(self):
+    src = "/// the answer\nconst a = 42;\n// not a doc comment\nconst b = a + 1;"
+    parsed = Namespace.parse(ParseContext(src))
+    self.assertEqual(["a", "b"], [d.name.name for d in parsed.decls])
+    self.assertEqual("the answer", parsed.decls[0].comment)
+    self.assertIsNone(parsed.decls[1].comment)
+    self.assertEqual(parsed.serialize(), Namespace.parse(ParseContext(parsed.serialize())).serialize())
+
+  def test_multiline_comment(self):
+    src = "/// line one\n/// line two\nconst a = 1\n/// fn doc\n///\n/// more\nfn f(x) {\n  /// inner\n  /// doc\n  const y = x\n}"
+    parsed = Namespace.parse(ParseContext(src))
+    self.assertEqual(["line one\nline two", "fn doc\n\nmore"], [d.comment for d in parsed.decls])
+    self.assertEqual("inner\ndoc", parsed.decls[1].body.decls[0].comment)
+    reparsed = Namespace.parse(ParseContext(parsed.serialize()))
+    self.assertIsInstance(reparsed, Namespace)
+    self.assertEqual(parsed.decls, reparsed.decls)
+
 # A group of declarationS
 Group = Namespace
 
 # The top level of the AST for a file
 Module = Namespace
 
+@dataclass
+class Param(Node):
+  name: Ident
+  type: Optional[Type] = None
+
+  def serialize(self, c: SerializeCtx = SerializeCtx()) -> str:
+    return self.name.serialize(c) + (f': {serialize_type(self.type, c)}' if self.type else '')
+
+@dataclass
+class FnDecl(Node):
+  """a function, e.g. a node group, whose body is a namespace of decls followed by a result"""
+  name: Ident
+  params: List[Param] = field(default_factory=list)
+  body: Namespace = field(default_factory=Namespace)
+  result: Optional[Expr] = None
+  comment: Optional[str] = None
+  type: Optional[Type] = None
+
+  def serialize(self, c: SerializeCtx = SerializeCtx()) -> str:
+    lines = [d.serialize(c) for d in self.body.decls]
+    if self.result is not None:
+      lines.append(f'return {self.result.serialize(c)}')
+    # TODO: do real tree formatting with the indent level of the SerializeCtx
+    body = ''.join(f'\n  {line}' for decl_lines in lines for line in decl_lines.split('\n'))
+    return (
+      serialize_doc_comment(self.comment)
+      + f'fn {self.name.serialize(c)}({", ".join(p.serialize(c) for p in self.params)})'
+      + (f' {serialize_type(self.type, c)}' if self.type else '')
+      + f' {{{body}\n}}'
+    )
+
+  @staticmethod
+  def parse(pctx: ParseContext) -> MaybeParsed["FnDecl"]:
+    """parse `fn name(params) [type] { decls [return expr] }`, returns None without consuming if there is no `fn`"""
+    start = pctx.index
+    fn = pctx.try_consume_tok_type(token.Type.fn)
+    if fn is None or isinstance(fn, TokenizeErr):
+      pctx.reset(start)
+      return fn
+    start = pctx.index - len(fn.slice)
+
+    name = Ident.parse(pctx)
+    if isinstance(name, ParseError): return name
+    if name is None: return ParseNonLexError.UnexpectedToken
+    lPar = pctx.try_consume_tok_type(token.Type.lPar)
+    if isinstance(lPar, TokenizeErr): return lPar
+    if lPar is None: return ParseNonLexError.UnexpectedToken
+
+    params: List[Param] = []
+    while True:
+      tok = pctx.try_consume_tok_type(token.Type.rPar)
+      if isinstance(tok, TokenizeErr): return tok
+      if tok is not None: break
+      param_name = Ident.parse(pctx)
+      if isinstance(param_name, ParseError): return param_name
+      if param_name is None: return ParseNonLexError.UnexpectedToken
+      param = Param(param_name)
+      colon = pctx.try_consume_tok_type(token.Type.colon)
+      if isinstance(colon, TokenizeErr): return colon
+      if colon is not None:
+        param_type = ConstDecl.parse_type(pctx)
+        if isinstance(param_type, ParseError): return param_type
+        if param_type is None: return ParseNonLexError.UnexpectedToken
+        param.type = param_type
+      params.append(spanned(param, pctx, param_name.start))
+      comma = pctx.try_consume_tok_type(token.Type.comma)
+      if isinstance(comma, TokenizeErr): return comma
+
+    result_type = ConstDecl.parse_type(pctx)
+    if isinstance(result_type, ParseError): return result_type
+    lBrace = pctx.try_consume_tok_type(token.Type.lBrace)
+    if isinstance(lBrace, TokenizeErr): return lBrace
+    if lBrace is None: return ParseNonLexError.UnexpectedToken
+
+    decl = FnDecl(name, params, type=result_type)
+    while True:
+      comment = pctx.try_consume_doc_comment()
+      tok = pctx.try_consume_tok_type(token.Type.rBrace, token.Type.return_)
+      if isinstance(tok, TokenizeErr): return tok
+      if tok is not None and token.Type.isinstance(tok, token.Type.rBrace): return spanned(decl, pctx, start)
+      if tok is not None:
+        result = Expr.parse(pctx)
+        if isinstance(result, ParseError): return result
+        if result is None: return ParseNonLexError.UnexpectedEof
+        decl.result = result
+        semicolon = pctx.try_consume_tok_type(token.Type.semicolon)
+        if isinstance(semicolon, TokenizeErr): return semicolon
+        rBrace = pctx.try_consume_tok_type(token.Type.rBrace)
+        if isinstance(rBrace, TokenizeErr): return rBrace
+        if rBrace is None: return ParseNonLexError.UnexpectedToken
+        return spanned(decl, pctx, start)
+      body_decl = ConstDecl.parse(pctx)
+      if isinstance(body_decl, ParseError): return body_decl
+      if body_decl is None: return ParseNonLexError.UnexpectedToken
+      body_decl.comment = comment
+      decl.body.append_decl(body_decl)
+
+class _TestFnDecl(unittest.TestCase):
+  def test_parse(self):
+    src = "fn SubGraph(a: i32[4], b) f32 {\n  /// doc\n  const x = a * 2;\n  return sin(x, b);\n}\nconst y = SubGraph(1, 2)"
+    parsed = Namespace.parse(ParseContext(src))
+    self.assertEqual(["SubGraph", "y"], [d.name.name for d in parsed.decls])
+    fn = parsed.decls[0]
+    self.assertEqual(["a", "b"], [p.name.name for p in fn.params])
+    self.assertEqual("fn SubGraph(a: i32[4], b) f32 {\n  /// doc\n  const x = (a * 2)\n  return sin(x, b)\n}", fn.serialize())
+    self.assertEqual(parsed.serialize(), Namespace.parse(ParseContext(parsed.serialize())).serialize())
+
 @dataclass
 class ParenGroup(Node):
   inner: Node
 
   def serialize(self, c: SerializeCtx = SerializeCtx()) -> str:
-    return f"({self.inner.serialize(c)})"
+    return serialize_tree(self, c)
+
+  def serialize_parts(self, c: SerializeCtx) -> Sequence[Union[str, Node]]:
+    # binary operators currently always serialize their own parentheses
+    if isinstance(self.inner, BinOp): return [self.inner]
+    return ['(', self.inner, ')']
 
   @staticmethod
   def hardFinishParse(pctx: ParseContext) -> Union[ParseError, "ParenGroup"]:
@@ -401,7 +867,14 @@ class ArgExprList(Node):
   exprs: list[NamedArg | Expr]
 
   def serialize(self, c: SerializeCtx = SerializeCtx()) -> str:
-    return ", ".join(e.serialize(c) for e in self.exprs)
+    return serialize_tree(self, c)
+
+  def serialize_parts(self, c: SerializeCtx) -> Sequence[Union[str, Node]]:
+    parts: List[Union[str, Node]] = []
+    for i, expr in enumerate(self.exprs):
+      if i > 0: parts.append(', ')
+      parts.append(expr)
+    return parts
 
   @staticmethod
   def hardFinishParse(pctx: ParseContext) -> Union[ParseError, "ArgExprList"]:
@@ -413,12 +886,22 @@ class ArgExprList(Node):
 
     exprs: list[NamedArg | Expr] = []
     while True:
-      # TODO: lookahead for named arg here
+      name: Optional[Ident] = None
+      dot = pctx.try_consume_tok_type(token.Type.dot)
+      if isinstance(dot, TokenizeErr): return dot
+      if dot is not None:
+        start = pctx.index - len(dot.slice)
+        name = Ident.parse(pctx)
+        if isinstance(name, ParseError): return name
+        if name is None: return ParseNonLexError.UnexpectedToken
+        eq = pctx.try_consume_tok_type(token.Type.eq)
+        if isinstance(eq, TokenizeErr): return eq
+        if eq is None: return ParseNonLexError.UnexpectedToken
+
       expr = Expr.parse(pctx)
-      if expr is None: return ParseNonLexError.UnexpectedToken
-      if isinstance(expr, ParseError): return expr
       if expr is None: return ParseNonLexError.UnexpectedEof
-      exprs.append(expr)
+      if isinstance(expr, ParseError): return expr
+      exprs.append(spanned(NamedArg(name, expr), pctx, start) if name is not None else expr)
 
       tok = pctx.try_consume_tok_type(token.Type.rPar, token.Type.comma)
       if isinstance(tok, TokenizeErr): return tok
@@ -435,30 +918,44 @@ class PrimaryExpr(Node): # TODO: should exclude binop
   def parse(pctx: ParseContext) -> MaybeParsed["PrimaryExpr"]:
     tok = pctx.consume_tok()
     if tok is None or isinstance(tok, TokenizeErr): return tok
+    return PrimaryExpr.finishParse(pctx, tok, pctx.index - len(tok.slice))
 
+  @staticmethod
+  def finishParse(pctx: ParseContext, tok: token.Token, start: int) -> MaybeParsed["PrimaryExpr"]:
+    """parse the rest of a primary expression starting with the already consumed `tok`"""
     result = None
     match tok.tok:
       # looks like with a match expr I don't even really need Ident.parse
       case token.Ident(name):
-        result = Ident(name)
         before_next = pctx.index
+        ident = spanned(Ident(name), pctx, start)
         next_tok = pctx.try_consume_tok_type(token.Type.lPar)
         if isinstance(next_tok, TokenizeErr): return next_tok
         elif next_tok is None:
           pctx.reset(before_next)
+          result = VarRef(ident)
+          while True:
+            dot = pctx.try_consume_tok_type(token.Type.dot)
+            if isinstance(dot, TokenizeErr): return dot
+            if dot is None: break
+            deref = pctx.try_consume_tok_type(token.Type.ident)
+            if isinstance(deref, TokenizeErr): return deref
+            if deref is None: return ParseNonLexError.UnexpectedToken
+            result.derefs.append(cast(token.Ident, deref.tok).name)
         else: # is lPar
           args = ArgExprList.hardFinishParse(pctx)
           if isinstance(args, ParseError):
             return args
-          result = Call(result, args.exprs)
+          result = Call(ident, args.exprs)
       case int(v) | float(v) | str(v) | bool(v):
         result = Literal(v)
       case token.Type.lPar:
-        ParenGroup.hardFinishParse(pctx)
+        result = ParenGroup.hardFinishParse(pctx)
+      case token.Type.lBrack:
+        result = Literal.hardFinishParseList(pctx)
       case _:
         # would be better to raise an error here...
         return ParseNonLexError.UnexpectedToken
 
-    return result
-
-
+    if isinstance(result, ParseError): return result
+    return spanned(result, pctx, start)
@@ -0,0 +1,522 @@
+"""
+a compact binary on-disk cache of parsed modules, so sources don't need reparsing every session
+
+A cache file (`<source>.nlangc`, next to the source) is keyed by the source's hash and the parser
+version, and is read through mmap. Only the header and decl index are read when opening it,
+decl bodies are decoded when first accessed.
+
+layout, all little endian:
+- header (see `_header`)
+- string table: (offset, length) u32 pairs, then the utf-8 bytes of every string
+- decl index: (name string, root node, source order) u32 triples, sorted by name bytes
+- nodes: fixed size records (see `_record`), children are referenced by record index
+- children: u32 record (or string) indices for nodes with a variable number of children
+
+typed array literals keep their elements in the string table as raw little endian bytes
+"""
+
+from __future__ import annotations
+from array import array
+from dataclasses import dataclass, field
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import typing
+from typing import Dict, Iterator, List, Optional, Tuple, cast
+import unittest
+
+from . import ast
+from .parser import ParseContext, parser_version
+
+magic = b'NLAC'
+format_version = 3
+cache_ext = 'c'
+
+# magic, format version, parser version, source sha256, string count, decl count, node count, child count
+_header = struct.Struct('<4sHI32sIIII')
+# kind, flags, aux, a, b, c, d
+_record = struct.Struct('<BBHIIII')
+_u32 = struct.Struct('<I')
+_u32_pair = struct.Struct('<II')
+_decl_entry = struct.Struct('<III')
+_i64 = struct.Struct('<q')
+_f64 = struct.Struct('<d')
+
+none = 0xFFFFFFFF
+
+class Kind:
+  Ident = 0
+  Literal = 1
+  VarRef = 2
+  Call = 3
+  NamedArg = 4
+  BinOp = 5
+  ParenGroup = 6
+  ConstDecl = 7
+  FnDecl = 8
+  Param = 9
+
+class LiteralTag:
+  none = 0
+  bool = 1
+  int = 2
+  float = 3
+  str = 4
+  list = 5
+  big_int = 6
+  float_array = 7
+  int_array = 8
+
+_array_tags = {'d': LiteralTag.float_array, 'q': LiteralTag.int_array}
+
+class TypeTag:
+  none = 0
+  primitive = 1
+  struct = 2
+
+_binops: Tuple[str, ...] = typing.get_args(ast.BinOp.Types)
+
+
+def cache_path(source_path: str) -> str:
+  return source_path + cache_ext
+
+def source_hash(src: str) -> bytes:
+  return hashlib.sha256(src.encode()).digest()
+
+
+@dataclass
+class _Encoder:
+  strings: List[bytes] = field(default_factory=list)
+  string_ids: Dict[str, int] = field(default_factory=dict)
+  records: List[bytes] = field(default_factory=list)
+  children: List[int] = field(default_factory=list)
+
+  def string(self, s: Optional[str]) -> int:
+    if s is None: return none
+    sid = self.string_ids.get(s)
+    if sid is None:
+      sid = self.string_ids[s] = len(self.strings)
+      self.strings.append(s.encode())
+    return sid
+
+  def blob(self, data: bytes) -> int:
+    self.strings.append(data)
+    return len(self.strings) - 1
+
+  def record(self, kind: int, flags: int = 0, aux: int = 0, a: int = 0, b: int = 0, c: int = 0, d: int = 0) -> int:
+    self.records.append(_record.pack(kind, flags, aux, a, b, c, d))
+    return len(self.records) - 1
+
+  def child_list(self, items: List[int]) -> int:
+    start = len(self.children)
+    self.children.extend(items)
+    return start
+
+  def type(self, type_: Optional[ast.Type]) -> Tuple[int, Optional[str]]:
+    """the (type tag, type name) of a decl's type"""
+    if type_ is None: return TypeTag.none, None
+    if isinstance(type_, ast.Struct): return TypeTag.struct, type_.name.name
+    return TypeTag.primitive, type_
+
+  def literal(self, val: ast.PrimitiveValue) -> int:
+    match val:
+      case None:
+        return self.record(Kind.Literal, LiteralTag.none)
+      case bool(v):
+        return self.record(Kind.Literal, LiteralTag.bool, a=int(v))
+      case int(v) if -2**63 <= v < 2**63:
+        a, b = _u32_pair.unpack(_i64.pack(v))
+        return self.record(Kind.Literal, LiteralTag.int, a=a, b=b)
+      case int(v):
+        return self.record(Kind.Literal, LiteralTag.big_int, a=self.string(str(v)))
+      case float(v):
+        a, b = _u32_pair.unpack(_f64.pack(v))
+        return self.record(Kind.Literal, LiteralTag.float, a=a, b=b)
+      case str(v):
+        return self.record(Kind.Literal, LiteralTag.str, a=self.string(v))
+      case list(v):
+        items = [self.literal(item) for item in v]
+        return self.record(Kind.Literal, LiteralTag.list, a=self.child_list(items), b=len(items))
+      case array() if val.typecode in _array_tags:
+        if sys.byteorder == 'big':
+          val = array(val.typecode, val)
+          val.byteswap()
+        return self.record(Kind.Literal, _array_tags[val.typecode], a=self.blob(val.tobytes()), b=len(val))
+      case _:
+        raise TypeError(f"can't cache a literal of type {type(val).__name__}")
+
+  @staticmethod
+  def _children(node: ast.Node) -> List[ast.Node]:
+    """the nodes that are encoded before a node, in the order their records are referenced"""
+    match node:
+      case ast.Ident() | ast.Literal() | ast.VarRef() | ast.Param():
+        return []
+      case ast.Call():
+        return list(node.args)
+      case ast.NamedArg():
+        return [node.val]
+      case ast.BinOp(_, left, right):
+        return [left, right]
+      case ast.ParenGroup(inner):
+        return [inner]
+      case ast.ConstDecl():
+        return [node.value]
+      case ast.FnDecl(_, params, body, result):
+        return ([] if result is None else [result]) + list(params) + list(body.decls)
+      case _:
+        raise TypeError(f"can't cache ast node {type(node).__name__}")
+
+  def _record_of(self, node: ast.Node, children: List[int]) -> int:
+    """encode a node whose children were encoded to `children`"""
+    match node:
+      case ast.Ident(name):
+        return self.record(Kind.Ident, a=self.string(name))
+      case ast.Literal(val):
+        return self.literal(val)
+      case ast.VarRef():
+        derefs = [self.string(d) for d in node.derefs]
+        return self.record(Kind.VarRef, a=self.string(node.name.name), b=self.child_list(derefs), c=len(derefs))
+      case ast.Call():
+        return self.record(Kind.Call, a=self.string(node.name.name), b=self.child_list(children), c=len(children))
+      case ast.NamedArg():
+        return self.record(Kind.NamedArg, a=self.string(node.name.name), b=children[0])
+      case ast.BinOp(op):
+        return self.record(Kind.BinOp, aux=_binops.index(op), a=children[0], b=children[1])
+      case ast.ParenGroup():
+        return self.record(Kind.ParenGroup, a=children[0])
+      case ast.ConstDecl(name, _, comment, type_):
+        type_tag, type_name = self.type(type_)
+        return self.record(Kind.ConstDecl, type_tag, a=self.string(name.name), b=children[0],
+                           c=self.string(comment), d=self.string(type_name))
+      case ast.Param(name, type_):
+        type_tag, type_name = self.type(type_)
+        return self.record(Kind.Param, type_tag, a=self.string(name.name), d=self.string(type_name))
+      case ast.FnDecl(name, params, _, result, comment, type_):
+        # children are the result and the comment, then the params, then the body decls
+        items = ([none] if result is None else children[:1]) + [self.string(comment)]
+        items += children[0 if result is None else 1:]
+        type_tag, type_name = self.type(type_)
+        return self.record(Kind.FnDecl, type_tag, aux=len(params), a=self.string(name.name),
+                           b=self.child_list(items), c=len(items), d=self.string(type_name))
+      case _:
+        raise TypeError(f"can't cache ast node {type(node).__name__}")
+
+  def node(self, root: ast.Node) -> int:
+    """the record index of a node, its children are encoded first, without recursion since converted
+    expressions can nest thousands deep"""
+    results: List[int] = []
+    # a node is pushed twice, first to expand its children and then to encode it
+    stack: List[Tuple[ast.Node, int]] = [(root, -1)]
+    while stack:
+      node, child_count = stack.pop()
+      if child_count < 0:
+        children = self._children(node)
+        stack.append((node, len(children)))
+        stack.extend((child, -1) for child in reversed(children))
+        continue
+      start = len(results) - child_count
+      index = self._record_of(node, results[start:])
+      del results[start:]
+      results.append(index)
+    return results[0]
+
+def encode(module: ast.Namespace, src_hash: bytes) -> bytes:
+  encoder = _Encoder()
+  entries: List[Tuple[bytes, int, int, int]] = []
+  for order, decl in enumerate(module.decls):
+    if not isinstance(decl, (ast.ConstDecl, ast.FnDecl)):
+      raise TypeError(f"can't cache top level {type(decl).__name__}")
+    name_id = encoder.string(decl.name.name)
+    entries.append((encoder.strings[name_id], name_id, encoder.node(decl), order))
+  entries.sort()
+
+  out = bytearray(_header.pack(magic, format_version, parser_version, src_hash, len(encoder.strings),
+                               len(entries), len(encoder.records), len(encoder.children)))
+  offset = 0
+  for s in encoder.strings:
+    out += _u32_pair.pack(offset, len(s))
+    offset += len(s)
+  out += b''.join(encoder.strings)
+  out += b''.join(_decl_entry.pack(name_id, root, order) for _, name_id, root, order in entries)
+  out += b''.join(encoder.records)
+  out += b''.join(_u32.pack(c) for c in encoder.children)
+  return bytes(out)
+
+
+class CachedModule:
+  """a module backed by a cache file, decoding decls only when they are accessed"""
+
+  def __init__(self, buf: mmap.mmap | bytes):
+    self.buf: mmap.mmap | bytes = buf
+    (file_magic, self.format_version, self.parser_version, self.source_hash,
+     string_count, self.decl_count, node_count, _child_count) = _header.unpack_from(buf, 0)
+    if file_magic != magic: raise ValueError('not a nodelang ast cache')
+    self._string_table = _header.size
+    self._string_data = self._string_table + string_count * _u32_pair.size
+    string_data_len = 0
+    if string_count > 0:
+      last_offset, last_len = _u32_pair.unpack_from(buf, self._string_data - _u32_pair.size)
+      string_data_len = last_offset + last_len
+    self._decl_index = self._string_data + string_data_len
+    self._nodes = self._decl_index + self.decl_count * _decl_entry.size
+    self._children = self._nodes + node_count * _record.size
+    self._strings: Dict[int, str] = {}
+    self._decls: Dict[int, ast.ConstDecl | ast.FnDecl] = {}
+
+  def close(self) -> None:
+    """unmap the cache file, decls already decoded stay usable"""
+    if isinstance(self.buf, mmap.mmap): self.buf.close()
+
+  def __enter__(self) -> "CachedModule":
+    return self
+
+  def __exit__(self, *exc_info: object) -> None:
+    self.close()
+
+  def _string_bytes(self, sid: int) -> bytes:
+    offset, length = _u32_pair.unpack_from(self.buf, self._string_table + sid * _u32_pair.size)
+    start = self._string_data + offset
+    return self.buf[start:start + length]
+
+  def string(self, sid: int) -> Optional[str]:
+    if sid == none: return None
+    s = self._strings.get(sid)
+    if s is None:
+      s = self._strings[sid] = self._string_bytes(sid).decode()
+    return s
+
+  def _decl_entry(self, i: int) -> Tuple[int, int, int]:
+    return _decl_entry.unpack_from(self.buf, self._decl_index + i * _decl_entry.size)
+
+  def _child(self, i: int) -> int:
+    return _u32.unpack_from(self.buf, self._children + i * _u32.size)[0]
+
+  def _literal_val(self, flags: int, a: int, b: int) -> ast.PrimitiveValue:
+    match flags:
+      case LiteralTag.none: return None
+      case LiteralTag.bool: return bool(a)
+      case LiteralTag.int: return _i64.unpack(_u32_pair.pack(a, b))[0]
+      case LiteralTag.big_int: return int(cast(str, self.string(a)))
+      case LiteralTag.float: return _f64.unpack(_u32_pair.pack(a, b))[0]
+      case LiteralTag.str: return self.string(a)
+      case LiteralTag.float_array | LiteralTag.int_array:
+        arr = array('d' if flags == LiteralTag.float_array else 'q')
+        arr.frombytes(self._string_bytes(a))
+        if sys.byteorder == 'big': arr.byteswap()
+        return arr
+      case LiteralTag.list:
+        vals: List[ast.PrimitiveValue] = []
+        for i in range(a, a + b):
+          _, item_flags, _, item_a, item_b, _, _ = _record.unpack_from(self.buf, self._nodes + self._child(i) * _record.size)
+          vals.append(self._literal_val(item_flags, item_a, item_b))
+        return vals
+      case _:
+        raise ValueError(f'corrupt literal tag {flags}')
+
+  def _type(self, flags: int, d: int) -> Optional[ast.Type]:
+    if flags == TypeTag.none: return None
+    if flags == TypeTag.struct: return ast.Struct(ast.Ident(cast(str, self.string(d))))
+    return cast(ast.PrimitiveType, self.string(d))
+
+  def _child_records(self, kind: int, aux: int, a: int, b: int, c: int) -> List[int]:
+    """the records a record references, in the order `_node_of` takes them"""
+    match kind:
+      case Kind.Call:
+        return [self._child(i) for i in range(b, b + c)]
+      case Kind.NamedArg | Kind.ConstDecl:
+        return [b]
+      case Kind.BinOp:
+        return [a, b]
+      case Kind.ParenGroup:
+        return [a]
+      case Kind.FnDecl:
+        result_index = self._child(b)
+        return ([] if result_index == none else [result_index]) + [self._child(i) for i in range(b + 2, b + c)]
+    return []
+
+  def _node_of(self, kind: int, flags: int, aux: int, a: int, b: int, c: int, d: int,
+               children: List[ast.Node]) -> ast.Node:
+    """decode a record whose children were decoded to `children`"""
+    match kind:
+      case Kind.Ident:
+        return ast.Ident(cast(str, self.string(a)))
+      case Kind.Literal:
+        return ast.Literal(self._literal_val(flags, a, b))
+      case Kind.VarRef:
+        return ast.VarRef(ast.Ident(cast(str, self.string(a))), [cast(str, self.string(self._child(i))) for i in range(b, b + c)])
+      case Kind.Call:
+        return ast.Call(ast.Ident(cast(str, self.string(a))), cast(List[ast.NamedArg | ast.Expr], children))
+      case Kind.NamedArg:
+        return ast.NamedArg(ast.Ident(cast(str, self.string(a))), cast(ast.Expr, children[0]))
+      case Kind.BinOp:
+        return ast.BinOp(cast(ast.BinOp.Types, _binops[aux]), cast(ast.Expr, children[0]), cast(ast.Expr, children[1]))
+      case Kind.ParenGroup:
+        return ast.ParenGroup(children[0])
+      case Kind.ConstDecl:
+        return ast.ConstDecl(ast.Ident(cast(str, self.string(a))), cast(ast.Literal, children[0]), self.string(c), self._type(flags, d))
+      case Kind.Param:
+        return ast.Param(ast.Ident(cast(str, self.string(a))), self._type(flags, d))
+      case Kind.FnDecl:
+        has_result = self._child(b) != none
+        result = cast(ast.Expr, children[0]) if has_result else None
+        rest = children[1:] if has_result else children
+        body = ast.Namespace()
+        for decl in rest[aux:]:
+          body.append_decl(cast(ast.ConstDecl, decl))
+        return ast.FnDecl(ast.Ident(cast(str, self.string(a))), cast(List[ast.Param], rest[:aux]), body,
+                          result, self.string(self._child(b + 1)), self._type(flags, d))
+      case _:
+        raise ValueError(f'corrupt node kind {kind}')
+
+  def node(self, index: int) -> ast.Node:
+    """decode a record and the records it references, without recursion like `_Encoder.node`"""
+    results: List[ast.Node] = []
+    stack: List[Tuple[int, Optional[Tuple[int, ...]]]] = [(index, None)]
+    while stack:
+      i, record = stack.pop()
+      if record is None:
+        record = _record.unpack_from(self.buf, self._nodes + i * _record.size)
+        kind, _, aux, a, b, c, _ = record
+        children = self._child_records(kind, aux, a, b, c)
+        stack.append((len(children), record))
+        stack.extend((child, None) for child in reversed(children))
+        continue
+      start = len(results) - i
+      node = self._node_of(*record, results[start:])
+      del results[start:]
+      results.append(node)
+    return results[0]
+
+  def _decl_at(self, i: int) -> ast.ConstDecl | ast.FnDecl:
+    """the decl at position i of the (name sorted) decl index"""
+    decl = self._decls.get(i)
+    if decl is None:
+      _, root, _ = self._decl_entry(i)
+      decl = self._decls[i] = cast(ast.ConstDecl | ast.FnDecl, self.node(root))
+    return decl
+
+  def get_decl(self, name: str) -> Optional[ast.ConstDecl | ast.FnDecl]:
+    """binary search the decl index, decoding only the names compared against and the found decl"""
+    target = name.encode()
+    lo, hi = 0, self.decl_count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._string_bytes(self._decl_entry(mid)[0]) < target: lo = mid + 1
+      else: hi = mid
+    if lo < self.decl_count and self._string_bytes(self._decl_entry(lo)[0]) == target:
+      return self._decl_at(lo)
+    return None
+
+  def decl_names(self) -> List[str]:
+    """names in source order, without decoding any bodies"""
+    entries = sorted((order, name_id) for name_id, _, order in map(self._decl_entry, range(self.decl_count)))
+    return [cast(str, self.string(name_id)) for _, name_id in entries]
+
+  def iter_decls(self) -> Iterator[ast.ConstDecl | ast.FnDecl]:
+    """decls in source order"""
+    by_order = sorted(range(self.decl_count), key=lambda i: self._decl_entry(i)[2])
+    return (self._decl_at(i) for i in by_order)
+
+  def to_namespace(self) -> ast.Namespace:
+    namespace = ast.Namespace()
+    for decl in self.iter_decls():
+      namespace.append_decl(decl)
+    return namespace
+
+
+def write(source_path: str, module: ast.Namespace, src: str) -> None:
+  """write the cache next to the source, atomically so concurrent readers never see half a file"""
+  data = encode(module, source_hash(src))
+  path = cache_path(source_path)
+  tmp_path = f'{path}.{os.getpid()}.tmp'
+  with open(tmp_path, 'wb') as f:
+    f.write(data)
+  os.replace(tmp_path, path)
+
+def load(source_path: str, src: Optional[str] = None) -> Optional[CachedModule]:
+  """the cached module of a source, or None if there is no cache or it is stale"""
+  if src is None:
+    with open(source_path, encoding='utf-8') as f:
+      src = f.read()
+  try:
+    with open(cache_path(source_path), 'rb') as f:
+      buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  except (FileNotFoundError, ValueError):
+    return None
+  try:
+    cached = CachedModule(buf)
+  except (ValueError, struct.error):
+    buf.close()
+    return None
+  if (cached.format_version, cached.parser_version, cached.source_hash) != (format_version, parser_version, source_hash(src)):
+    cached.close()
+    return None
+  return cached
+
+def parse_file(source_path: str) -> ast.Namespace | CachedModule | None:
+  """load a source's cache, or parse it and write the cache. Returns None on a parse error."""
+  with open(source_path, encoding='utf-8') as f:
+    src = f.read()
+  cached = load(source_path, src)
+  if cached is not None: return cached
+  module = ast.Namespace.parse(ParseContext(src))
+  if not isinstance(module, ast.Namespace): return None
+  write(source_path, module, src)
+  return module
+
+
+class _TestAstCache(unittest.TestCase):
+  src = """
+  /// doc
+  const b: f32[4] = [1, 2.5, 3, 4];
+  const 'a var': MyStruct = sin(x.y, .named=(1 + 2) * 3) ^^ 99999999999999999999;
+  const c = b;
+  const ramp = [0.0, 0.25, 0.5, 1.0, 1.5];
+  const steps = [1, 2, 3];
+  fn Mix(x: f32, 'y z') f32 {
+    const t = x * 2;
+    return t + 'y z'
+  }
+  """
+
+  def test_roundtrip(self):
+    module = ast.Namespace.parse(ParseContext(self.src))
+    cached = CachedModule(encode(module, source_hash(self.src)))
+    self.assertEqual(["b", "a var", "c", "ramp", "steps", "Mix"], cached.decl_names())
+    self.assertEqual(module.serialize(), cached.to_namespace().serialize())
+    self.assertEqual(module.decls[1], cached.get_decl("a var"))
+    self.assertEqual(module.decls[5], cached.get_decl("Mix"))
+    for name in ("ramp", "steps"):
+      self.assertEqual(module.decl_by_name[ast.Ident(name)], cached.get_decl(name))
+    self.assertIsNone(cached.get_decl("missing"))
+
+  def test_lazy(self):
+    module = ast.Namespace.parse(ParseContext(" ".join(f"const v{i} = {i} + v{i+1};" for i in range(1000))))
+    cached = CachedModule(encode(module, b'\0' * 32))
+    self.assertEqual("const v500 = (500 + v501)", cached.get_decl("v500").serialize())
+    self.assertEqual(1, len(cached._decls))
+
+  def test_files(self):
+    with tempfile.TemporaryDirectory() as root:
+      path = os.path.join(root, 'a.nlang')
+      with open(path, 'w') as f: f.write(self.src)
+      self.assertIsInstance(parse_file(path), ast.Namespace)
+      with cast(CachedModule, parse_file(path)) as cached:
+        self.assertIsInstance(cached, CachedModule)
+        self.assertEqual(["b", "a var", "c", "ramp", "steps", "Mix"], cached.decl_names())
+      self.assertTrue(cached.buf.closed)
+      with open(path, 'w') as f: f.write('const changed = 1;')
+      self.assertIsNone(load(path))
+
+  def test_deep(self):
+    src = "const x = " + " + ".join(f"a{i}" for i in range(3000)) + "; fn f(y) { return sin(" + "(" * 200 + "y" + ")" * 200 + ") }"
+    module = ast.Namespace.parse(ParseContext(src))
+    cached = CachedModule(encode(cast(ast.Namespace, module), b'\0' * 32))
+    for name in ("x", "f"):
+      decoded = cached.get_decl(name)
+      self.assertEqual([type(n) for n in ast.walk(module.decl_by_name[ast.Ident(name)])], [type(n) for n in ast.walk(decoded)])
+    refs = [n.name.name for n in ast.walk(cached.get_decl("x")) if isinstance(n, ast.VarRef)]
+    self.assertEqual([f"a{i}" for i in range(3000)], refs)
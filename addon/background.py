@@ -0,0 +1,292 @@
+"""
+converting materials without blocking blender's UI
+
+The main thread only takes a snapshot of the material (see `snapshot`). Analysis and
+serialization run on a worker thread or process. Progress and results come back through a
+`bpy.app.timers` callback, so callbacks run on the main thread where bpy may be used again.
+"""
+
+from __future__ import annotations
+from concurrent.futures import CancelledError, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+import multiprocessing
+import pickle
+import queue
+import threading
+import time
+from typing import Any, Callable, List, Literal, Optional
+import unittest
+
+from .addon import analyze_material
+from .bpy_wrap import bpy
+from .snapshot import MaterialSnapshot, snapshot_material
+
+Status = Literal['done', 'cancelled', 'failed']
+
+
+@dataclass
+class Progress:
+  stage: Literal['queued', 'analyze', 'serialize', 'done']
+  done: int = 0
+  total: int = 0
+
+  @property
+  def fraction(self) -> float:
+    return self.done / self.total if self.total else 0.0
+
+
+@dataclass
+class ConversionResult:
+  name: str
+  status: Status
+  # only the text comes back, a deep module can't be pickled from a worker process (reparse it if needed)
+  source: Optional[str] = None
+  error: Optional[str] = None
+  seconds: float = 0.0
+
+
+class Cancelled(Exception):
+  """raised inside a conversion once its job has been cancelled"""
+
+
+@dataclass
+class Channel:
+  """
+  how a running conversion reports progress and learns it was cancelled. Thread or process safe
+  depending on the queue and event, reports are throttled since they can cross processes.
+  """
+  updates: Any  # queue.SimpleQueue or a multiprocessing manager's Queue
+  cancel_event: Any  # threading.Event or a multiprocessing manager's Event
+  interval: float = 0.05
+  _last: float = field(default=0.0, repr=False)
+  _last_stage: str = field(default='', repr=False)
+
+  def report(self, stage: str, done: int, total: int) -> None:
+    # before throttling, so a cancelled job stops at its next report rather than its next sent one
+    if self.cancel_event.is_set(): raise Cancelled()
+    now = time.monotonic()
+    if stage == self._last_stage and done < total and now - self._last < self.interval: return
+    self._last, self._last_stage = now, stage
+    self.updates.put(Progress(stage, done, total))  # type: ignore[arg-type]
+
+
+def convert_snapshot(snapshot: MaterialSnapshot, channel: Optional[Channel] = None) -> ConversionResult:
+  """analyze and serialize a snapshot, this is what runs on the worker"""
+  start = time.perf_counter()
+  report = channel.report if channel is not None else lambda stage, done, total: None
+  try:
+    report('analyze', 0, len(snapshot.node_tree.nodes))
+    module = analyze_material(snapshot, progress=lambda done, total: report('analyze', done, total))  # type: ignore[arg-type]
+    lines: List[str] = []
+    for i, decl in enumerate(module.decls):
+      report('serialize', i, len(module.decls))
+      lines.append(decl.serialize())
+    report('serialize', len(module.decls), len(module.decls))
+    return ConversionResult(snapshot.name, 'done', '\n'.join(lines), seconds=time.perf_counter() - start)
+  except Cancelled:
+    return ConversionResult(snapshot.name, 'cancelled', seconds=time.perf_counter() - start)
+  except Exception as e:
+    return ConversionResult(snapshot.name, 'failed', error=f'{type(e).__name__}: {e}', seconds=time.perf_counter() - start)
+
+
+@dataclass(eq=False)
+class Job:
+  name: str
+  future: Future[ConversionResult]
+  channel: Channel
+  on_done: Callable[[ConversionResult], None]
+  on_progress: Optional[Callable[[Progress], None]] = None
+  progress: Progress = field(default_factory=lambda: Progress('queued'))
+  result: Optional[ConversionResult] = None
+
+  def cancel(self) -> None:
+    """stop the job, if it was already running it stops at its next progress report"""
+    self.channel.cancel_event.set()
+    self.future.cancel()
+
+  @property
+  def cancelled(self) -> bool:
+    return self.channel.cancel_event.is_set()
+
+
+class BackgroundConverter:
+  """
+  converts materials on an executor (by default a single worker thread) and delivers progress and
+  results to callbacks on the main thread, polling from a `bpy.app.timers` timer while jobs are pending
+  """
+
+  def __init__(self, executor: Optional[Executor] = None, timers: Any = None, poll_interval: float = 0.05):
+    self.executor = executor or ThreadPoolExecutor(max_workers=1, thread_name_prefix='nodelang')
+    self._owns_executor = executor is None
+    self.timers = timers if timers is not None else bpy.app.timers
+    self.poll_interval = poll_interval
+    self.jobs: List[Job] = []
+    self._manager: Any = None
+    # blender identifies timers by the function object, so keep a single bound method
+    self._poll_callback = self._poll
+
+  def _channel(self) -> Channel:
+    if isinstance(self.executor, ProcessPoolExecutor):
+      if self._manager is None: self._manager = multiprocessing.Manager()
+      return Channel(self._manager.Queue(), self._manager.Event())
+    return Channel(queue.SimpleQueue(), threading.Event())
+
+  def submit(self, material: bpy.types.Material, on_done: Callable[[ConversionResult], None],
+             on_progress: Optional[Callable[[Progress], None]] = None, replace: bool = True) -> Job:
+    """
+    snapshot a material (the only part that reads bpy) and convert it in the background.
+    With `replace`, pending jobs of the same material are cancelled since their result would be stale
+    """
+    return self.submit_snapshot(snapshot_material(material), on_done, on_progress, replace)
+
+  def submit_snapshot(self, snapshot: MaterialSnapshot, on_done: Callable[[ConversionResult], None],
+                      on_progress: Optional[Callable[[Progress], None]] = None, replace: bool = True) -> Job:
+    if replace:
+      for job in self.jobs:
+        if job.name == snapshot.name: job.cancel()
+    channel = self._channel()
+    job = Job(snapshot.name, self.executor.submit(convert_snapshot, snapshot, channel), channel, on_done, on_progress)
+    self.jobs.append(job)
+    if not self.timers.is_registered(self._poll_callback):
+      self.timers.register(self._poll_callback, first_interval=self.poll_interval)
+    return job
+
+  def _drain(self, job: Job) -> None:
+    try:
+      while True:
+        job.progress = job.channel.updates.get_nowait()
+        if job.on_progress is not None and not job.cancelled: job.on_progress(job.progress)
+    except queue.Empty:
+      pass
+
+  def _finish(self, job: Job) -> ConversionResult:
+    try:
+      result = job.future.result()
+    except CancelledError:
+      result = ConversionResult(job.name, 'cancelled')
+    except Exception as e:
+      # e.g. a worker process died
+      result = ConversionResult(job.name, 'failed', error=f'{type(e).__name__}: {e}')
+    if job.cancelled and result.status == 'done':
+      result = ConversionResult(job.name, 'cancelled', seconds=result.seconds)
+    return result
+
+  def _poll(self) -> Optional[float]:
+    """the timer, runs on the main thread"""
+    for job in list(self.jobs):
+      self._drain(job)
+      if not job.future.done(): continue
+      self.jobs.remove(job)
+      job.result = self._finish(job)
+      if job.result.status == 'done': job.progress = Progress('done', job.progress.total, job.progress.total)
+      job.on_done(job.result)
+    # returning None unregisters the timer until the next submit
+    return self.poll_interval if self.jobs else None
+
+  def close(self) -> None:
+    """cancel everything pending and stop the workers"""
+    for job in self.jobs:
+      job.cancel()
+    self.jobs.clear()
+    if self.timers.is_registered(self._poll_callback):
+      self.timers.unregister(self._poll_callback)
+    if self._owns_executor:
+      self.executor.shutdown(wait=False, cancel_futures=True)
+    if self._manager is not None:
+      self._manager.shutdown()
+      self._manager = None
+
+
+class _TestBackground(unittest.TestCase):
+  @staticmethod
+  def make_material(name: str, length: int) -> bpy.types.Material:
+    material = bpy.types.Material(name)
+    tree = material.node_tree
+    prev = tree.nodes.new('ShaderNodeMath')
+    for i in range(length):
+      math = tree.nodes.new('ShaderNodeMath', operation='ADD' if i % 2 else 'MULTIPLY')
+      tree.links.new(prev.outputs[0], math.inputs[0])
+      prev = math
+    bsdf = tree.nodes.new('ShaderNodeBsdfPrincipled')
+    out = tree.nodes.new('ShaderNodeOutputMaterial')
+    tree.links.new(prev.outputs[0], bsdf.inputs['Roughness'])
+    tree.links.new(bsdf.outputs[0], out.inputs['Surface'])
+    return material
+
+  def setUp(self):
+    self.timers = bpy.app.timers
+    self.results: List[ConversionResult] = []
+    self.progress: List[Progress] = []
+
+  def on_done(self, result: ConversionResult) -> None:
+    self.assertIs(threading.current_thread(), threading.main_thread())
+    self.results.append(result)
+
+  def test_convert(self):
+    material = self.make_material('M', 200)
+    expected = analyze_material(material).serialize()
+    converter = BackgroundConverter(timers=self.timers, poll_interval=0.001)
+    job = converter.submit(material, self.on_done, self.progress.append)
+    # edits after the snapshot don't affect the conversion
+    material.node_tree.nodes[1].operation = 'SUB'
+    self.assertTrue(self.timers.run(until=lambda: bool(self.results)))
+    converter.close()
+    self.assertEqual(['done'], [r.status for r in self.results])
+    self.assertEqual(expected, self.results[0].source)
+    self.assertEqual('done', job.progress.stage)
+    self.assertLessEqual({'analyze', 'serialize'}, {p.stage for p in self.progress})
+    self.assertFalse(self.timers.is_registered(converter._poll_callback))
+
+  def test_cancel(self):
+    gate = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=1)
+    # occupy the only worker so the conversions stay queued
+    executor.submit(gate.wait)
+    converter = BackgroundConverter(executor, timers=self.timers, poll_interval=0.001)
+    first = converter.submit(self.make_material('M', 10), self.on_done)
+    converter.submit(self.make_material('M', 20), self.on_done)
+    self.assertTrue(first.cancelled)
+    gate.set()
+    self.assertTrue(self.timers.run(until=lambda: len(self.results) == 2))
+    executor.shutdown()
+    self.assertEqual(['cancelled', 'done'], [r.status for r in self.results])
+
+  def test_cancel_running(self):
+    channel = Channel(queue.SimpleQueue(), threading.Event(), interval=0)
+    channel.cancel_event.set()
+    result = convert_snapshot(snapshot_material(self.make_material('M', 10)), channel)
+    self.assertEqual('cancelled', result.status)
+
+  def test_cancel_throttled(self):
+    channel = Channel(queue.SimpleQueue(), threading.Event(), interval=60)
+    channel.report('analyze', 0, 10)
+    channel.cancel_event.set()
+    # within the throttle interval, where reports aren't sent
+    with self.assertRaises(Cancelled): channel.report('analyze', 1, 10)
+
+  def test_deep(self):
+    material = self.make_material('M', 5000)
+    result = convert_snapshot(snapshot_material(material))
+    self.assertEqual('done', result.status, result.error)
+    self.assertEqual(analyze_material(material).serialize(), result.source)
+
+  def test_process_pool(self):
+    # deep enough that pickling the module back from the worker would overflow
+    material = self.make_material('M', 5000)
+    expected = analyze_material(material).serialize()
+    with ProcessPoolExecutor(max_workers=1) as executor:
+      converter = BackgroundConverter(executor, timers=self.timers, poll_interval=0.001)
+      converter.submit(material, self.on_done, self.progress.append)
+      self.assertTrue(self.timers.run(until=lambda: bool(self.results), timeout=60))
+      converter.close()
+    self.assertEqual(['done'], [r.status for r in self.results])
+    self.assertEqual(expected, self.results[0].source)
+
+  def test_pickle_snapshot(self):
+    # pickling a long chain must not recurse per link
+    snapshot = snapshot_material(self.make_material('M', 5000))
+    copied = pickle.loads(pickle.dumps(snapshot))
+    nodes = copied.node_tree.nodes
+    self.assertEqual(len(snapshot.node_tree.nodes), len(nodes))
+    self.assertIs(nodes[0], nodes[1].inputs[0].links[0].from_node)
+    self.assertEqual('MULTIPLY', nodes[1].operation)
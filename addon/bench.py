@@ -0,0 +1,399 @@
+"""
+scaling benchmarks of the tokenizer, parser, analysis and serialization over synthetic inputs
+
+run with `python -m addon.bench --help`
+"""
+
+from __future__ import annotations
+import argparse
+from dataclasses import asdict, dataclass, field
+import json
+import math
+import os
+import sys
+import time
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+import unittest
+
+from . import ast
+from .addon import analyze_material
+from .bpy_wrap import bpy
+from .parser import ParseContext, TokenizeErr
+
+## synthetic inputs
+
+# the math operations that `types.generic_node_types` knows how to convert
+math_ops = ('ADD', 'SUB', 'MULTIPLY', 'DIV')
+
+def _material(name: str) -> Tuple[bpy.types.Material, bpy.types.NodeTree]:
+  material = bpy.types.Material(name)
+  return material, material.node_tree
+
+def deep_chain(n: int) -> bpy.types.Material:
+  """n math nodes each feeding the next, ending in a single bsdf"""
+  material, tree = _material(f'deep_chain_{n}')
+  prev = None
+  for i in range(n):
+    math_node = tree.nodes.new('ShaderNodeMath', operation=math_ops[i % len(math_ops)])
+    if prev is not None:
+      tree.links.new(prev.outputs[0], math_node.inputs[0])
+    prev = math_node
+  bsdf = tree.nodes.new('ShaderNodeBsdfPrincipled')
+  out = tree.nodes.new('ShaderNodeOutputMaterial')
+  if prev is not None:
+    tree.links.new(prev.outputs[0], bsdf.inputs['Roughness'])
+  tree.links.new(bsdf.outputs[0], out.inputs['Surface'])
+  return material
+
+def wide_fanout(n: int) -> bpy.types.Material:
+  """a single math node read by n bsdf nodes"""
+  material, tree = _material(f'wide_fanout_{n}')
+  source = tree.nodes.new('ShaderNodeMath', operation='ADD')
+  for _ in range(n):
+    bsdf = tree.nodes.new('ShaderNodeBsdfPrincipled')
+    tree.links.new(source.outputs[0], bsdf.inputs['Roughness'])
+  return material
+
+def heavy_reuse(n: int, depth: int = 8) -> bpy.types.Material:
+  """
+  layers of math nodes where every node reads two neighbours of the previous layer,
+  so every node is referenced twice and must be promoted to a variable
+  """
+  material, tree = _material(f'heavy_reuse_{n}')
+  width = max(2, n // depth)
+  prev = [tree.nodes.new('ShaderNodeMath', operation='ADD') for _ in range(width)]
+  for layer in range(1, depth):
+    cur = [tree.nodes.new('ShaderNodeMath', operation=math_ops[layer % len(math_ops)]) for _ in range(width)]
+    for j, math_node in enumerate(cur):
+      tree.links.new(prev[j].outputs[0], math_node.inputs[0])
+      tree.links.new(prev[(j + 1) % width].outputs[0], math_node.inputs[1])
+    prev = cur
+  for math_node in prev:
+    bsdf = tree.nodes.new('ShaderNodeBsdfPrincipled')
+    tree.links.new(math_node.outputs[0], bsdf.inputs['Roughness'])
+  return material
+
+binop_cycle: Sequence[str] = ('+', '-', '*', '/', '^^', '^/', '**')
+
+def long_binop(n: int) -> str:
+  """an expression of n operands mixing operators of every precedence"""
+  parts = []
+  for i in range(n):
+    if i > 0: parts.append(binop_cycle[i % len(binop_cycle)])
+    parts.append(f'a{i}' if i % 2 == 0 else f'{i}.5')
+  return ' '.join(parts)
+
+
+## stages
+
+@dataclass
+class Case:
+  """the prepared input of one shape at one size, stages read and fill it"""
+  size: int
+  material: Optional[bpy.types.Material] = None
+  source: Optional[str] = None
+  result: Optional[ast.Node] = None
+  # what `result` serialized to, kept apart from `source` so stages after `serialize` still read the input
+  serialized: Optional[str] = None
+
+  def text(self) -> str:
+    """the source, or for cases made from a material what it serialized to"""
+    text = self.source if self.source is not None else self.serialized
+    if text is None: raise RuntimeError('no source, an earlier stage failed')
+    return text
+
+def tokenize(case: Case) -> None:
+  text = case.text()
+  pctx = ParseContext(text)
+  while True:
+    tok = pctx.consume_tok()
+    if tok is None: break
+    if isinstance(tok, TokenizeErr): raise RuntimeError(f'tokenize error at {pctx.index}')
+  # so a tokenizer giving up early doesn't look fast
+  if pctx.index < len(text): raise RuntimeError(f'tokenizing stopped at {pctx.index} of {len(text)}')
+
+def parse(case: Case) -> None:
+  parsed = ast.Expr.parse(ParseContext(case.text()))
+  if not isinstance(parsed, ast.Node): raise RuntimeError(f'parse error: {parsed}')
+  case.result = parsed
+
+def analyze(case: Case) -> None:
+  assert case.material is not None
+  case.result = analyze_material(case.material)
+
+def serialize(case: Case) -> None:
+  if case.result is None: raise RuntimeError('nothing to serialize, an earlier stage failed')
+  case.serialized = case.result.serialize()
+
+Stage = Callable[[Case], None]
+
+stages: Mapping[str, Stage] = {
+  'tokenize': tokenize,
+  'parse': parse,
+  'analyze': analyze,
+  'serialize': serialize,
+}
+
+@dataclass
+class Shape:
+  make: Callable[[int], Case]
+  # in order, later stages consume the result of earlier ones
+  stages: Sequence[str]
+
+shapes: Mapping[str, Shape] = {
+  'deep_chain': Shape(lambda n: Case(n, material=deep_chain(n)), ('analyze', 'serialize', 'tokenize')),
+  'wide_fanout': Shape(lambda n: Case(n, material=wide_fanout(n)), ('analyze', 'serialize', 'tokenize')),
+  'heavy_reuse': Shape(lambda n: Case(n, material=heavy_reuse(n)), ('analyze', 'serialize', 'tokenize')),
+  'long_binop': Shape(lambda n: Case(n, source=long_binop(n)), ('tokenize', 'parse', 'serialize')),
+}
+
+
+## measurement
+
+@dataclass
+class Result:
+  shape: str
+  stage: str
+  size: int
+  seconds: Optional[float] = None
+  # the exception the stage raised, which fails the run
+  error: Optional[str] = None
+  # why the stage wasn't run at this size
+  skipped: Optional[str] = None
+
+  @property
+  def throughput(self) -> Optional[float]:
+    """items (nodes or operands) per second"""
+    return self.size / self.seconds if self.seconds else None
+
+def measure(stage: Stage, case: Case, min_time: float, max_repeat: int) -> float:
+  """best time of several runs, repeating only while the total stays under min_time"""
+  best = math.inf
+  total = 0.0
+  for _ in range(max_repeat):
+    start = time.perf_counter()
+    stage(case)
+    elapsed = time.perf_counter() - start
+    best = min(best, elapsed)
+    total += elapsed
+    if total >= min_time: break
+  return best
+
+def run(shape_names: Sequence[str], sizes: Sequence[int], time_limit: float = 10.0,
+        min_time: float = 0.2, max_repeat: int = 5, log: Callable[[str], None] = lambda _: None) -> List[Result]:
+  results: List[Result] = []
+  for shape_name in shape_names:
+    shape = shapes[shape_name]
+    # once a stage exceeds the time limit (or fails) larger sizes of it are skipped
+    given_up: Dict[str, str] = {}
+    for size in sizes:
+      case = shape.make(size)
+      for stage_name in shape.stages:
+        result = Result(shape_name, stage_name, size)
+        if stage_name in given_up:
+          result.skipped = given_up[stage_name]
+        else:
+          try:
+            result.seconds = measure(stages[stage_name], case, min_time, max_repeat)
+            if result.seconds > time_limit:
+              given_up[stage_name] = f'size {size} exceeded the {time_limit}s limit'
+          except Exception as e:
+            # e.g. a RecursionError, reported as a failure rather than a slow stage
+            result.error = f'{type(e).__name__}: {e}'
+            given_up[stage_name] = f'failed at size {size}'
+        results.append(result)
+        log(format_result(result))
+  return results
+
+
+## asymptotic fits
+
+complexity_models: Mapping[str, Callable[[float], float]] = {
+  'O(1)': lambda n: 1.0,
+  'O(log n)': lambda n: math.log(n),
+  'O(n)': lambda n: n,
+  'O(n log n)': lambda n: n * math.log(n),
+  'O(n^2)': lambda n: n * n,
+}
+
+@dataclass
+class Fit:
+  shape: str
+  stage: str
+  # the slope of log(seconds) against log(size)
+  exponent: float
+  model: str
+
+def fit_exponent(points: Sequence[Tuple[int, float]]) -> float:
+  xs = [math.log(n) for n, _ in points]
+  ys = [math.log(t) for _, t in points]
+  mean_x = sum(xs) / len(xs)
+  mean_y = sum(ys) / len(ys)
+  var_x = sum((x - mean_x) ** 2 for x in xs)
+  if var_x == 0: return 0.0
+  return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+
+def best_model(points: Sequence[Tuple[int, float]]) -> str:
+  """the complexity model with the smallest relative least squares error"""
+  def relative_error(f: Callable[[float], float]) -> float:
+    # minimize sum(((t - c*f(n)) / t)^2) over c
+    num = sum(f(n) / t for n, t in points)
+    den = sum((f(n) / t) ** 2 for n, t in points)
+    c = num / den if den else 0.0
+    return sum(((t - c * f(n)) / t) ** 2 for n, t in points)
+  return min(complexity_models, key=lambda name: relative_error(complexity_models[name]))
+
+def fits(results: Sequence[Result]) -> List[Fit]:
+  by_key: Dict[Tuple[str, str], List[Tuple[int, float]]] = {}
+  for r in results:
+    if r.seconds is not None and r.seconds > 0:
+      by_key.setdefault((r.shape, r.stage), []).append((r.size, r.seconds))
+  return [Fit(shape, stage, fit_exponent(points), best_model(points))
+          for (shape, stage), points in by_key.items()
+          if len(points) >= 2]
+
+
+## baseline comparison
+
+@dataclass
+class Report:
+  results: List[Result] = field(default_factory=list)
+  fits: List[Fit] = field(default_factory=list)
+
+  def to_json(self) -> Dict[str, Any]:
+    return {'results': [asdict(r) for r in self.results], 'fits': [asdict(f) for f in self.fits]}
+
+  @staticmethod
+  def from_json(data: Mapping[str, Any]) -> "Report":
+    return Report([Result(**r) for r in data['results']], [Fit(**f) for f in data['fits']])
+
+def regressions(current: Report, baseline: Report, tolerance: float = 0.5,
+                exponent_tolerance: float = 0.3) -> List[str]:
+  """
+  describe every measurement slower than the baseline by more than `tolerance` (relative),
+  every fit whose exponent grew by more than `exponent_tolerance`, and every newly failing stage
+  """
+  problems: List[str] = []
+  base_results = {(r.shape, r.stage, r.size): r for r in baseline.results}
+  for r in current.results:
+    base = base_results.get((r.shape, r.stage, r.size))
+    if base is None or base.seconds is None: continue
+    if r.seconds is None:
+      problems.append(f'{r.shape}/{r.stage} n={r.size} now fails ({r.error or r.skipped})')
+    elif r.seconds > base.seconds * (1 + tolerance):
+      problems.append(f'{r.shape}/{r.stage} n={r.size} took {r.seconds:.4g}s, baseline {base.seconds:.4g}s')
+  base_fits = {(f.shape, f.stage): f for f in baseline.fits}
+  for f in current.fits:
+    base_fit = base_fits.get((f.shape, f.stage))
+    if base_fit is not None and f.exponent > base_fit.exponent + exponent_tolerance:
+      problems.append(f'{f.shape}/{f.stage} scales as n^{f.exponent:.2f} ({f.model}), '
+                      f'baseline n^{base_fit.exponent:.2f} ({base_fit.model})')
+  return problems
+
+
+## cli
+
+# next to the other recorded baselines rather than in the working directory
+default_baseline = os.path.normpath(os.path.join(os.path.dirname(__file__), os.pardir, 'docs', 'bench', 'baseline.json'))
+
+def format_result(r: Result) -> str:
+  if r.error is not None:
+    return f'{r.shape:<12} {r.stage:<10} {r.size:>9}  FAILED {r.error}'
+  if r.seconds is None:
+    return f'{r.shape:<12} {r.stage:<10} {r.size:>9}  skipped, {r.skipped}'
+  return f'{r.shape:<12} {r.stage:<10} {r.size:>9}  {r.seconds:>10.4g}s  {r.throughput:>12.4g}/s'
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+  arg_parser = argparse.ArgumentParser(prog='python -m addon.bench', description=__doc__)
+  arg_parser.add_argument('--shapes', nargs='+', choices=list(shapes), default=list(shapes))
+  arg_parser.add_argument('--sizes', nargs='+', type=lambda s: int(float(s)), default=[100, 1_000, 10_000],
+                          help='input sizes, e.g. `--sizes 1e2 1e3 1e4 1e5 1e6`')
+  arg_parser.add_argument('--time-limit', type=float, default=10.0,
+                          help='skip larger sizes of a stage once it takes longer than this many seconds')
+  arg_parser.add_argument('--baseline', default=default_baseline)
+  arg_parser.add_argument('--save-baseline', action='store_true', help='overwrite the baseline with this run')
+  arg_parser.add_argument('--tolerance', type=float, default=0.5,
+                          help='allowed relative slowdown against the baseline')
+  arg_parser.add_argument('--output', help='also write the results as json to this path')
+  args = arg_parser.parse_args(argv)
+
+  results = run(args.shapes, sorted(args.sizes), time_limit=args.time_limit, log=print)
+  report = Report(results, fits(results))
+  print()
+  for f in report.fits:
+    print(f'{f.shape:<12} {f.stage:<10} ~n^{f.exponent:.2f}  best fit {f.model}')
+  failures = [r for r in results if r.error is not None]
+  if failures: print()
+  for r in failures:
+    print(f'FAILED: {r.shape}/{r.stage} n={r.size} {r.error}')
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report.to_json(), f, indent=2)
+
+  if args.save_baseline:
+    with open(args.baseline, 'w') as f:
+      json.dump(report.to_json(), f, indent=2)
+    print(f'\nsaved baseline to {args.baseline}')
+    return 1 if failures else 0
+
+  try:
+    with open(args.baseline) as f:
+      baseline = Report.from_json(json.load(f))
+  except FileNotFoundError:
+    print(f'\nno baseline at {args.baseline}, run with --save-baseline to create one')
+    return 1 if failures else 0
+
+  problems = regressions(report, baseline, args.tolerance)
+  print()
+  for problem in problems:
+    print(f'REGRESSION: {problem}')
+  print(f'{len(problems)} regressions against {args.baseline}')
+  return 1 if problems or failures else 0
+
+
+class _TestBench(unittest.TestCase):
+  def test_shapes(self):
+    self.assertEqual(len(deep_chain(10).node_tree.nodes), 12)
+    self.assertEqual(len(wide_fanout(10).node_tree.nodes), 11)
+    parsed = ast.Expr.parse(ParseContext(long_binop(10)))
+    self.assertIsInstance(parsed, ast.BinOp)
+
+  def test_stages(self):
+    case = Case(10, source=long_binop(10))
+    for stage in shapes['long_binop'].stages: stages[stage](case)
+    # serializing doesn't replace the input of the stages before it
+    self.assertEqual(long_binop(10), case.source)
+    self.assertNotEqual(case.source, case.serialized)
+    material_case = Case(10, material=deep_chain(10))
+    for stage in shapes['deep_chain'].stages: stages[stage](material_case)
+    self.assertEqual(material_case.serialized, material_case.text())
+
+  def test_fits(self):
+    linear = [(n, 2e-6 * n) for n in (100, 1_000, 10_000)]
+    quadratic = [(n, 1e-9 * n * n) for n in (100, 1_000, 10_000)]
+    self.assertAlmostEqual(fit_exponent(linear), 1.0)
+    self.assertEqual(best_model(linear), 'O(n)')
+    self.assertEqual(best_model(quadratic), 'O(n^2)')
+
+  def test_regressions(self):
+    baseline = Report([Result('s', 'x', 100, 1.0), Result('s', 'x', 1000, 10.0)], [Fit('s', 'x', 1.0, 'O(n)')])
+    same = Report([Result('s', 'x', 100, 1.1), Result('s', 'x', 1000, 10.5)], [Fit('s', 'x', 1.0, 'O(n)')])
+    slower = Report([Result('s', 'x', 100, 1.0), Result('s', 'x', 1000, 100.0)], [Fit('s', 'x', 2.0, 'O(n^2)')])
+    self.assertEqual(regressions(same, baseline), [])
+    self.assertEqual(len(regressions(slower, baseline)), 2)
+
+  def test_failure(self):
+    from unittest import mock
+    def overflow(case: Case) -> None:
+      raise RecursionError('maximum recursion depth exceeded')
+    with mock.patch.dict(stages, {'tokenize': overflow}):
+      results = run(['long_binop'], [10, 20], min_time=0, max_repeat=1)
+    tokenize = [r for r in results if r.stage == 'tokenize']
+    self.assertEqual('RecursionError: maximum recursion depth exceeded', tokenize[0].error)
+    self.assertEqual((None, 'failed at size 10'), (tokenize[1].error, tokenize[1].skipped))
+    self.assertIn('FAILED', format_result(tokenize[0]))
+
+
+if __name__ == '__main__':
+  sys.exit(main())
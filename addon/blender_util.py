@@ -2,9 +2,92 @@
 Utilities specific to blender
 """
 
-from typing import Any
+from array import array
+from dataclasses import fields
+import hashlib
+from typing import Any, Dict, Optional, Tuple
+
+from .fake_bpy import bpy_prop_array
+from . import fake_bpy
 
 
 # TODO: figure out how to do this better
 def isinstance_bpy_prop_array(x: Any) -> bool:
   return type(x).__name__ == 'bpy_prop_array'
+
+def float_array(value: Any) -> array:
+  """
+  a copy of a float array property as doubles. Blender copies it out in one go through
+  `foreach_get` (into single precision, which is how it stores them)
+  """
+  foreach_get = getattr(value, 'foreach_get', None)
+  if foreach_get is None: return array('d', value)
+  buffer = array('f', bytes(4 * len(value)))
+  foreach_get(buffer)
+  return array('d', buffer)
+
+# properties every node has, that aren't settings of what the node computes
+_base_node_props = {f.name for f in fields(fake_bpy.Node)} | {
+  'node_tree', 'bl_idname', 'bl_label', 'bl_description', 'bl_icon', 'bl_static_type', 'bl_width_default',
+  'bl_width_min', 'bl_width_max', 'bl_height_default', 'bl_height_min', 'bl_height_max', 'type', 'width',
+  'height', 'width_hidden', 'dimensions', 'hide', 'mute', 'select', 'show_options', 'show_preview',
+  'show_texture', 'use_custom_color', 'internal_links', 'rna_type', 'is_active_output',
+}
+
+def plain_value(value: Any) -> Any:
+  """a picklable copy of a property value"""
+  if isinstance_bpy_prop_array(value) or isinstance(value, (list, tuple)):
+    return bpy_prop_array(plain_value(v) for v in value)
+  if value is None or isinstance(value, (bool, int, float, str)):
+    return value
+  return getattr(value, 'name', None)
+
+def node_props(node: Any) -> Dict[str, Any]:
+  """the settings of a node, i.e. its editable properties that aren't common to all nodes"""
+  # a `snapshot.NodeSnapshot`, which copied them already
+  props = getattr(node, 'props', None)
+  if isinstance(props, dict): return props
+  rna = getattr(node, 'bl_rna', None)
+  if rna is not None:
+    names = [p.identifier for p in rna.properties
+             if not p.is_readonly and p.type in ('BOOLEAN', 'INT', 'FLOAT', 'STRING', 'ENUM', 'POINTER')
+             and p.identifier not in _base_node_props]
+  else:
+    names = [f.name for f in fields(node) if f.name not in _base_node_props]
+  return {name: plain_value(getattr(node, name)) for name in names}
+
+def node_tree_hash(tree: Any, memo: Optional[Dict[Any, str]] = None) -> str:
+  """
+  a hash of a node tree's interface, nodes, their settings (see `node_props`) and unlinked defaults,
+  and links, independent of the tree's own name and its nodes' names. Nested groups are hashed by
+  content too, memoized in `memo`.
+  """
+  if memo is not None and tree in memo: return memo[tree]
+  h = hashlib.sha256()
+  def update(*parts: Any) -> None:
+    h.update(repr(parts).encode())
+
+  for interface in (tree.inputs, tree.outputs):
+    for socket in interface:
+      update('socket', socket.name, socket.type)
+    update('end interface')
+
+  contents: Dict[Any, Tuple[Any, ...]] = {}
+  for node in tree.nodes:
+    group = node_tree_hash(node.node_tree, memo) if node.type == 'GROUP' and node.node_tree is not None else None
+    defaults = tuple((s.identifier, plain_value(getattr(s, 'default_value', None)))
+                     for s in node.inputs if not s.is_linked)
+    contents[node] = (node.bl_idname, sorted(node_props(node).items()), group, defaults)
+  # links refer to nodes by position, ordered by content so that renaming nodes doesn't change
+  # the hash. Names only break ties between nodes with the same content
+  nodes = sorted(tree.nodes, key=lambda n: (repr(contents[n]), n.name))
+  position = {node: i for i, node in enumerate(nodes)}
+  for node in nodes:
+    update('node', *contents[node])
+  for link in sorted((position[l.from_node], l.from_socket.identifier, position[l.to_node], l.to_socket.identifier)
+                     for l in tree.links):
+    update('link', *link)
+
+  digest = h.hexdigest()
+  if memo is not None: memo[tree] = digest
+  return digest
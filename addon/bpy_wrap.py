@@ -2,9 +2,6 @@
 this module re-exports bpy with some wrapping for some environments
 """
 
-from addon.util import IgnoreDerefs
-
-
 try:
   in_blender = True
   import bpy
@@ -15,8 +12,8 @@ try:
 
 except ModuleNotFoundError:
   # raise Exception("not running in blender")
-  # TODO: throw error when not testing
   in_blender = False
-  bpy = IgnoreDerefs()
+  # a headless stand-in, enough to run the analysis on synthetic node trees
+  from addon import fake_bpy as bpy
 
 __all__ = ['bpy', 'bpy_types']
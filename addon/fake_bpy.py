@@ -0,0 +1,389 @@
+"""
+a small headless stand-in for the parts of bpy that nodelang reads, so that the analysis
+can be run (tested, benchmarked) outside of blender
+
+`bpy_wrap` re-exports this module as `bpy` when blender's own isn't importable
+"""
+
+from __future__ import annotations
+from dataclasses import dataclass, field
+import time
+from typing import Any, Callable, ClassVar, Dict, List, MutableSequence, Optional, Sequence, Tuple, Type, TypeVar
+
+from .util import IgnoreDerefs
+
+T = TypeVar('T')
+
+
+class bpy_prop_array(list):
+  """blender's array property, `blender_util.isinstance_bpy_prop_array` detects it by type name"""
+
+
+class bpy_prop_collection(List[T]):
+  """a list that can also be indexed by the `name` of its elements, like blender's collections"""
+
+  def __getitem__(self, k: Any) -> Any:
+    if isinstance(k, str):
+      for item in self:
+        if getattr(item, 'name', None) == k: return item
+      raise KeyError(k)
+    return super().__getitem__(k)
+
+  def get(self, k: str, default: Any = None) -> Any:
+    try: return self[k]
+    except KeyError: return default
+
+  def foreach_get(self, attr: str, seq: MutableSequence[Any]) -> None:
+    """like blender's, `attr` of every element (flattened if it's an array) copied into `seq`"""
+    i = 0
+    for item in self:
+      value = getattr(item, attr)
+      for v in value if isinstance(value, (list, tuple)) else (value,):
+        if i >= len(seq): raise TypeError(f"foreach_get('{attr}') needs a longer sequence than {len(seq)}")
+        seq[i] = v
+        i += 1
+    if i != len(seq): raise TypeError(f"foreach_get('{attr}') needs a sequence of {i}, not {len(seq)}")
+
+
+@dataclass(eq=False)
+class NodeLink:
+  from_node: "Node"
+  from_socket: "NodeSocket"
+  to_node: "Node"
+  to_socket: "NodeSocket"
+  is_valid: bool = True
+
+
+@dataclass(eq=False)
+class NodeSocket:
+  name: str
+  node: "Node"
+  identifier: str = ''
+  is_output: bool = False
+  enabled: bool = True
+  default_value: Any = None
+  links: List[NodeLink] = field(default_factory=list)
+  type: ClassVar[str] = 'CUSTOM'
+
+  @property
+  def is_linked(self) -> bool:
+    return bool(self.links)
+
+  def __setattr__(self, name: str, value: Any) -> None:
+    # like blender, assigning a sequence to an array property keeps it an array property
+    if name == 'default_value' and isinstance(value, (list, tuple)):
+      value = bpy_prop_array(value)
+    super().__setattr__(name, value)
+
+class NodeSocketFloat(NodeSocket):
+  type = 'VALUE'
+
+class NodeSocketBool(NodeSocket):
+  type = 'BOOLEAN'
+
+class NodeSocketColor(NodeSocket):
+  type = 'RGBA'
+
+class NodeSocketVector(NodeSocket):
+  type = 'VECTOR'
+
+class NodeSocketShader(NodeSocket):
+  type = 'SHADER'
+
+# (name, socket type, default value)
+SocketSpec = Tuple[str, Type[NodeSocket], Any]
+
+
+@dataclass(eq=False)
+class NodeSocketInterface:
+  """a socket of a node group's interface"""
+  name: str
+  socket_type: Type[NodeSocket]
+  default_value: Any = None
+
+  @property
+  def type(self) -> str:
+    return self.socket_type.type
+
+class NodeTreeInterface(bpy_prop_collection[NodeSocketInterface]):
+  def new(self, type: str, name: str) -> NodeSocketInterface:
+    socket = NodeSocketInterface(name, getattr(types, type))
+    self.append(socket)
+    return socket
+
+
+@dataclass(eq=False)
+class Node:
+  name: str = ''
+  label: str = ''
+  location: Tuple[float, float] = (0.0, 0.0)
+  parent: Optional["Node"] = None
+  # the tree this node is in
+  id_data: Optional["NodeTree"] = None
+  color: Tuple[float, float, float] = (0.6, 0.6, 0.6)
+  inputs: bpy_prop_collection[NodeSocket] = field(default_factory=bpy_prop_collection)
+  outputs: bpy_prop_collection[NodeSocket] = field(default_factory=bpy_prop_collection)
+
+  type: ClassVar[str] = 'CUSTOM'
+  input_specs: ClassVar[Sequence[SocketSpec]] = ()
+  output_specs: ClassVar[Sequence[SocketSpec]] = ()
+
+  def socket_specs(self) -> Tuple[Sequence[SocketSpec], Sequence[SocketSpec]]:
+    """the (input, output) sockets to create"""
+    return self.input_specs, self.output_specs
+
+  def __post_init__(self) -> None:
+    input_specs, output_specs = self.socket_specs()
+    for specs, sockets, is_output in ((input_specs, self.inputs, False),
+                                      (output_specs, self.outputs, True)):
+      seen: Dict[str, int] = {}
+      for name, socket_type, default in specs:
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        identifier = name if count == 0 else f'{name}_{count:03}'
+        if isinstance(default, (list, tuple)):
+          default = bpy_prop_array(default)
+        sockets.append(socket_type(name, self, identifier, is_output, default_value=default))
+
+  @property
+  def bl_idname(self) -> str:
+    return type(self).__name__
+
+class ShaderNode(Node):
+  pass
+
+@dataclass(eq=False)
+class ShaderNodeMath(ShaderNode):
+  operation: str = 'ADD'
+  use_clamp: bool = False
+
+  type = 'MATH'
+  input_specs = (('Value', NodeSocketFloat, 0.5),
+                 ('Value', NodeSocketFloat, 0.5),
+                 ('Value', NodeSocketFloat, 0.5))
+  output_specs = (('Value', NodeSocketFloat, 0.0),)
+
+  def __post_init__(self) -> None:
+    super().__post_init__()
+    # like blender, the third operand only shows up for ternary operations
+    self.inputs[2].enabled = False
+
+class ShaderNodeValue(ShaderNode):
+  type = 'VALUE'
+  output_specs = (('Value', NodeSocketFloat, 0.5),)
+
+class ShaderNodeRGB(ShaderNode):
+  type = 'RGB'
+  output_specs = (('Color', NodeSocketColor, (0.5, 0.5, 0.5, 1.0)),)
+
+class ShaderNodeBsdfPrincipled(ShaderNode):
+  type = 'BSDF_PRINCIPLED'
+  input_specs = (('Base Color', NodeSocketColor, (0.8, 0.8, 0.8, 1.0)),
+                 ('Metallic', NodeSocketFloat, 0.0),
+                 ('Roughness', NodeSocketFloat, 0.5))
+  output_specs = (('BSDF', NodeSocketShader, None),)
+
+class ShaderNodeOutputMaterial(ShaderNode):
+  type = 'OUTPUT_MATERIAL'
+  input_specs = (('Surface', NodeSocketShader, None),
+                 ('Volume', NodeSocketShader, None),
+                 ('Displacement', NodeSocketVector, (0.0, 0.0, 0.0)))
+
+def _interface_specs(interface: Sequence[NodeSocketInterface]) -> Sequence[SocketSpec]:
+  return [(s.name, s.socket_type, s.default_value) for s in interface]
+
+@dataclass(eq=False)
+class ShaderNodeGroup(ShaderNode):
+  node_tree: Optional["NodeTree"] = None
+  type = 'GROUP'
+
+  def socket_specs(self) -> Tuple[Sequence[SocketSpec], Sequence[SocketSpec]]:
+    if self.node_tree is None: return (), ()
+    return _interface_specs(self.node_tree.inputs), _interface_specs(self.node_tree.outputs)
+
+class NodeGroupInput(Node):
+  type = 'GROUP_INPUT'
+
+  def socket_specs(self) -> Tuple[Sequence[SocketSpec], Sequence[SocketSpec]]:
+    assert self.id_data is not None, 'group input nodes must be created with nodes.new'
+    return (), _interface_specs(self.id_data.inputs)
+
+class NodeGroupOutput(Node):
+  type = 'GROUP_OUTPUT'
+  is_active_output = True
+
+  def socket_specs(self) -> Tuple[Sequence[SocketSpec], Sequence[SocketSpec]]:
+    assert self.id_data is not None, 'group output nodes must be created with nodes.new'
+    return _interface_specs(self.id_data.outputs), ()
+
+class NodeFrame(Node):
+  type = 'FRAME'
+
+class NodeReroute(Node):
+  type = 'REROUTE'
+
+
+class Nodes(bpy_prop_collection[Node]):
+  def __init__(self) -> None:
+    super().__init__()
+    self._name_counts: Dict[str, int] = {}
+    self.tree: Optional[NodeTree] = None
+
+  def new(self, type: str, **props: Any) -> Node:
+    """create a node by its bl_idname, naming it like blender would ("Math", "Math.001", ...)"""
+    node_class: Type[Node] = getattr(types, type)
+    node = node_class(id_data=self.tree, **props)
+    base_name = node.name or type.removeprefix('ShaderNode').removeprefix('Node')
+    count = self._name_counts.get(base_name, 0)
+    self._name_counts[base_name] = count + 1
+    node.name = base_name if count == 0 else f'{base_name}.{count:03}'
+    self.append(node)
+    return node
+
+  def remove(self, node: Node) -> None:  # type: ignore[override]
+    """remove a node and its links"""
+    if self.tree is not None:
+      for socket in (*node.inputs, *node.outputs):
+        for link in list(socket.links):
+          self.tree.links.remove(link)
+    super().remove(node)
+
+class NodeLinks(bpy_prop_collection[NodeLink]):
+  def new(self, output: NodeSocket, input: NodeSocket) -> NodeLink:
+    """link an output socket to an input socket, replacing any link the input already had"""
+    for old in list(input.links):
+      self.remove(old)
+    link = NodeLink(output.node, output, input.node, input)
+    output.links.append(link)
+    input.links.append(link)
+    self.append(link)
+    return link
+
+  def remove(self, link: NodeLink) -> None:  # type: ignore[override]
+    link.from_socket.links.remove(link)
+    link.to_socket.links.remove(link)
+    super().remove(link)
+
+  def clear(self) -> None:
+    for link in list(self):
+      self.remove(link)
+
+@dataclass(eq=False)
+class NodeTree:
+  name: str = 'NodeTree'
+  nodes: Nodes = field(default_factory=Nodes)
+  links: NodeLinks = field(default_factory=NodeLinks)
+  # the group interface
+  inputs: NodeTreeInterface = field(default_factory=NodeTreeInterface)
+  outputs: NodeTreeInterface = field(default_factory=NodeTreeInterface)
+
+  def __post_init__(self) -> None:
+    self.nodes.tree = self
+
+class ShaderNodeTree(NodeTree):
+  pass
+
+@dataclass(eq=False)
+class Material:
+  name: str = 'Material'
+  node_tree: NodeTree = field(default_factory=ShaderNodeTree)
+  use_nodes: bool = True
+
+
+class _Types:
+  """`bpy.types`, unknown types are created on demand so annotations and isinstance checks still work"""
+  bpy_prop_array = bpy_prop_array
+  bpy_prop_collection = bpy_prop_collection
+  NodeLink = NodeLink
+  NodeSocket = NodeSocket
+  NodeSocketFloat = NodeSocketFloat
+  NodeSocketBool = NodeSocketBool
+  NodeSocketColor = NodeSocketColor
+  NodeSocketVector = NodeSocketVector
+  NodeSocketShader = NodeSocketShader
+  Node = Node
+  ShaderNode = ShaderNode
+  ShaderNodeMath = ShaderNodeMath
+  ShaderNodeValue = ShaderNodeValue
+  ShaderNodeRGB = ShaderNodeRGB
+  ShaderNodeBsdfPrincipled = ShaderNodeBsdfPrincipled
+  ShaderNodeOutputMaterial = ShaderNodeOutputMaterial
+  ShaderNodeGroup = ShaderNodeGroup
+  NodeGroupInput = NodeGroupInput
+  NodeGroupOutput = NodeGroupOutput
+  NodeSocketInterface = NodeSocketInterface
+  NodeFrame = NodeFrame
+  NodeReroute = NodeReroute
+  NodeTree = NodeTree
+  ShaderNodeTree = ShaderNodeTree
+  Material = Material
+
+  def __getattr__(self, name: str) -> type:
+    new_type = type(name, (), {})
+    setattr(self, name, new_type)
+    return new_type
+
+types = _Types()
+
+
+@dataclass
+class _Data:
+  materials: bpy_prop_collection[Material] = field(default_factory=bpy_prop_collection)
+  node_groups: bpy_prop_collection[NodeTree] = field(default_factory=bpy_prop_collection)
+
+data = _Data()
+
+
+class _Timers:
+  """
+  `bpy.app.timers`, blender calls the registered functions from its main loop. Headlessly nothing
+  does, so whoever stands in for the main loop calls `step` (or `run`) on the main thread.
+  """
+
+  def __init__(self) -> None:
+    # function -> when it's next due, in `time.monotonic` seconds
+    self._due: Dict[Callable[[], Optional[float]], float] = {}
+
+  def register(self, function: Callable[[], Optional[float]], first_interval: float = 0.0, persistent: bool = False) -> None:
+    self._due[function] = time.monotonic() + first_interval
+
+  def unregister(self, function: Callable[[], Optional[float]]) -> None:
+    if function not in self._due: raise ValueError(f'{function!r} is not registered')
+    del self._due[function]
+
+  def is_registered(self, function: Callable[[], Optional[float]]) -> bool:
+    return function in self._due
+
+  def step(self) -> int:
+    """call the timers that are due, like blender's main loop does. Returns how many were called."""
+    now = time.monotonic()
+    due = [f for f, t in self._due.items() if t <= now]
+    for function in due:
+      # like blender, returning None unregisters and a number is the delay until the next call
+      interval = function()
+      if function not in self._due: continue
+      if interval is None: del self._due[function]
+      else: self._due[function] = time.monotonic() + interval
+    return len(due)
+
+  def run(self, until: Callable[[], bool] = lambda: False, timeout: float = 10.0) -> bool:
+    """step until `until()` or no timers are left, returns False if `timeout` seconds passed first"""
+    deadline = time.monotonic() + timeout
+    while self._due and not until():
+      if time.monotonic() > deadline: return False
+      self.step()
+      if self._due: time.sleep(max(0.0, min(min(self._due.values()) - time.monotonic(), 0.01)))
+    return True
+
+class _App:
+  timers = _Timers()
+
+  def __getattr__(self, name: str) -> Any:
+    return IgnoreDerefs()
+
+app = _App()
+
+
+def __getattr__(name: str) -> Any:
+  # everything else (ops, context, ...) is silently ignored like it was before this stand-in existed
+  return IgnoreDerefs()
@@ -0,0 +1,480 @@
+"""
+exports node graphs to graphviz DOT (see `docs/samples/base.dot`) or an equivalent JSON edge list,
+to inspect or diff the structure of huge materials outside of blender
+
+A graph is either a node tree snapshot (see `snapshot`), whose frames become clusters, or a module,
+whose fn decls (node groups) become clusters of their params and locals. Output is written line by
+line as the graph is walked, nothing but the cluster membership is collected first. Graphs can be
+truncated to the nodes nearest to their outputs, the rest is summarized by a single node.
+
+run with `python -m addon.graph_export --help`
+"""
+
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+from dataclasses import dataclass
+import argparse
+import io
+import json
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Set, TextIO, Tuple
+import unittest
+
+from . import ast
+from .addon import material_end_nodes
+from .parser import ParseContext
+from .snapshot import MaterialSnapshot, NodeSnapshot, TreeSnapshot, snapshot_material
+from .bpy_wrap import bpy
+
+# the id of the node standing in for the nodes left out of a truncated graph
+truncated_id = '...'
+
+
+@dataclass
+class Cluster:
+  id: str
+  label: str
+  parent: Optional[str] = None
+
+@dataclass
+class GraphNode:
+  id: str
+  label: str
+  cluster: Optional[str] = None
+  shape: Optional[str] = None
+
+@dataclass
+class Edge:
+  tail: str
+  head: str
+  # the sockets, i.e. the member read and the named arg it is read into for modules
+  tail_label: str = ''
+  head_label: str = ''
+  # the cluster the tail stands for, e.g. the fn of a call
+  ltail: Optional[str] = None
+
+
+class Graph(ABC):
+  """what the exporters read of a graph, every method may be called more than once"""
+  name: str = ''
+
+  @abstractmethod
+  def clusters(self, parent: Optional[str]) -> Iterable[Cluster]:
+    """the clusters directly in `parent`, or at the top level if None"""
+
+  @abstractmethod
+  def members(self, cluster: Optional[str]) -> Iterable[GraphNode]:
+    """the nodes directly in a cluster, or at the top level if None"""
+
+  @abstractmethod
+  def edges(self) -> Iterable[Edge]: ...
+
+  @abstractmethod
+  def roots(self) -> Iterable[str]:
+    """the nodes nothing reads from, where truncation starts"""
+
+  @abstractmethod
+  def inputs(self, node: str) -> Iterable[str]:
+    """the nodes a node reads from"""
+
+  @abstractmethod
+  def cluster_of(self, node: str) -> Optional[str]: ...
+
+  @abstractmethod
+  def parent_of(self, cluster: str) -> Optional[str]: ...
+
+
+class TreeGraph(Graph):
+  def __init__(self, tree: TreeSnapshot, name: Optional[str] = None):
+    self.tree = tree
+    self.name = tree.name if name is None else name
+    self.nodes: Dict[str, NodeSnapshot] = {}
+    self._members: Dict[Optional[str], List[NodeSnapshot]] = defaultdict(list)
+    self._clusters: Dict[Optional[str], List[NodeSnapshot]] = defaultdict(list)
+    for node in tree.nodes:
+      self.nodes[node.name] = node
+      parent = None if node.parent is None else self._cluster_id(node.parent)
+      (self._clusters if node.type == 'FRAME' else self._members)[parent].append(node)
+
+  @staticmethod
+  def _cluster_id(frame: NodeSnapshot) -> str:
+    # graphviz only treats subgraphs named like this as clusters
+    return f'cluster_{frame.name}'
+
+  def clusters(self, parent: Optional[str]) -> Iterable[Cluster]:
+    for frame in self._clusters.get(parent, ()):
+      yield Cluster(self._cluster_id(frame), frame.label or frame.name, parent)
+
+  def members(self, cluster: Optional[str]) -> Iterable[GraphNode]:
+    for node in self._members.get(cluster, ()):
+      label = node.label or node.name
+      if node.node_tree is not None: label += f'\n({node.node_tree.name})'
+      yield GraphNode(node.name, label, cluster, 'point' if node.type == 'REROUTE' else None)
+
+  def edges(self) -> Iterable[Edge]:
+    for link in self.tree.links:
+      yield Edge(link.from_node.name, link.to_node.name, link.from_socket.name, link.to_socket.name)
+
+  def roots(self) -> Iterable[str]:
+    return (node.name for node in material_end_nodes(self.tree))
+
+  def inputs(self, node: str) -> Iterable[str]:
+    return (s.links[0].from_node.name for s in self.nodes[node].inputs if s.links)
+
+  def cluster_of(self, node: str) -> Optional[str]:
+    parent = self.nodes[node].parent
+    return None if parent is None else self._cluster_id(parent)
+
+  def parent_of(self, cluster: str) -> Optional[str]:
+    return self.cluster_of(cluster.removeprefix('cluster_'))
+
+
+class ModuleGraph(Graph):
+  """
+  the decls of a module, read by the decls whose values reference them. Fns are clusters of their
+  params, locals and a node for their result, which has the fn's name and stands for its calls
+  """
+
+  def __init__(self, module: ast.Namespace, name: str = ''):
+    self.module = module
+    self.name = name
+    self.decls: Dict[str, ast.Node] = {}
+    for decl in module.decls:
+      if isinstance(decl, (ast.ConstDecl, ast.FnDecl)): self.decls[decl.name.name] = decl
+    self._inputs: Optional[Dict[str, List[str]]] = None
+    self._edges: Optional[List[Edge]] = None
+
+  @staticmethod
+  def _local_id(fn: ast.FnDecl, name: str) -> str:
+    return f'{fn.name.name}/{name}'
+
+  def clusters(self, parent: Optional[str]) -> Iterable[Cluster]:
+    if parent is not None: return
+    for decl in self.decls.values():
+      if isinstance(decl, ast.FnDecl): yield Cluster(f'cluster_{decl.name.name}', decl.name.name)
+
+  def members(self, cluster: Optional[str]) -> Iterable[GraphNode]:
+    if cluster is None:
+      for name, decl in self.decls.items():
+        if isinstance(decl, ast.ConstDecl): yield GraphNode(name, name)
+      return
+    fn = self.decls[cluster.removeprefix('cluster_')]
+    assert isinstance(fn, ast.FnDecl)
+    for param in fn.params:
+      yield GraphNode(self._local_id(fn, param.name.name), param.name.name, cluster, 'invhouse')
+    for local in fn.body.decls:
+      yield GraphNode(self._local_id(fn, local.name.name), local.name.name, cluster)
+    yield GraphNode(fn.name.name, 'return', cluster, 'house')
+
+  def _expr_edges(self, expr: ast.Node, head: str, scope: Dict[str, str]) -> Iterator[Edge]:
+    # expressions of converted materials nest deeply, so walk them without recursion
+    stack: List[Tuple[ast.Node, str]] = [(expr, '')]
+    while stack:
+      node, arg = stack.pop()
+      match node:
+        case ast.NamedArg(name, val):
+          stack.append((val, name.name))
+          continue
+        case ast.VarRef(name, derefs):
+          if name.name in scope or isinstance(self.decls.get(name.name), ast.ConstDecl):
+            yield Edge(scope.get(name.name, name.name), head, derefs[0] if derefs else '', arg)
+        case ast.Call(name):
+          fn = self.decls.get(name.name)
+          if isinstance(fn, ast.FnDecl): yield Edge(fn.name.name, head, '', arg, f'cluster_{fn.name.name}')
+      stack.extend((child, arg) for child in reversed(ast.children(node)))
+
+  def edges(self) -> Iterable[Edge]:
+    if self._edges is not None:
+      yield from self._edges
+      return
+    for name, decl in self.decls.items():
+      if isinstance(decl, ast.ConstDecl):
+        yield from self._expr_edges(decl.value, name, {})
+        continue
+      assert isinstance(decl, ast.FnDecl)
+      scope = {p.name.name: self._local_id(decl, p.name.name) for p in decl.params}
+      for local in decl.body.decls:
+        local_id = self._local_id(decl, local.name.name)
+        yield from self._expr_edges(local.value, local_id, scope)
+        scope[local.name.name] = local_id
+      if decl.result is not None: yield from self._expr_edges(decl.result, name, scope)
+
+  def _input_map(self) -> Dict[str, List[str]]:
+    if self._inputs is None:
+      # truncating needs all of them anyway, so they're kept rather than found again to be written
+      self._edges = list(self.edges())
+      self._inputs = defaultdict(list)
+      for edge in self._edges: self._inputs[edge.head].append(edge.tail)
+    return self._inputs
+
+  def roots(self) -> Iterable[str]:
+    read = {tail for tails in self._input_map().values() for tail in tails}
+    return (name for name in reversed(self.decls) if name not in read)
+
+  def inputs(self, node: str) -> Iterable[str]:
+    return self._input_map().get(node, ())
+
+  def cluster_of(self, node: str) -> Optional[str]:
+    fn, sep, _ = node.partition('/')
+    if sep or isinstance(self.decls.get(node), ast.FnDecl): return f'cluster_{fn}'
+    return None
+
+  def parent_of(self, cluster: str) -> Optional[str]:
+    return None
+
+
+def graph_of(source: Graph | TreeSnapshot | MaterialSnapshot | ast.Namespace | bpy.types.Material) -> Graph:
+  if isinstance(source, Graph): return source
+  if isinstance(source, ast.Namespace): return ModuleGraph(source)
+  if not isinstance(source, (TreeSnapshot, MaterialSnapshot)): source = snapshot_material(source)
+  if isinstance(source, MaterialSnapshot): return TreeGraph(source.node_tree, source.name)
+  return TreeGraph(source)
+
+
+@dataclass
+class _Truncation:
+  kept: Set[str]
+  # clusters with kept nodes, or clusters with kept nodes in them
+  clusters: Set[Optional[str]]
+  dropped: int
+
+def _truncate(graph: Graph, max_nodes: Optional[int]) -> Optional[_Truncation]:
+  """the `max_nodes` nodes nearest to the roots, breadth first, None if there aren't more"""
+  if max_nodes is None: return None
+  count = 0
+  pending: deque[Optional[str]] = deque([None])
+  while pending:
+    cluster = pending.popleft()
+    count += sum(1 for _ in graph.members(cluster))
+    pending.extend(c.id for c in graph.clusters(cluster))
+  if count <= max_nodes: return None
+
+  kept: Set[str] = set()
+  queue = deque(graph.roots())
+  while queue and len(kept) < max_nodes:
+    node = queue.popleft()
+    if node in kept: continue
+    kept.add(node)
+    queue.extend(graph.inputs(node))
+  clusters: Set[Optional[str]] = {None}
+  for node in kept:
+    cluster = graph.cluster_of(node)
+    while cluster not in clusters:
+      clusters.add(cluster)
+      cluster = graph.parent_of(cluster) if cluster is not None else None
+  return _Truncation(kept, clusters, count - len(kept))
+
+def _truncated_edges(graph: Graph, truncation: Optional[_Truncation]) -> Iterator[Edge]:
+  if truncation is None:
+    yield from graph.edges()
+    return
+  summarized: Set[str] = set()
+  for edge in graph.edges():
+    if edge.head not in truncation.kept: continue
+    if edge.tail in truncation.kept:
+      yield edge
+    elif edge.head not in summarized:
+      summarized.add(edge.head)
+      yield Edge(truncated_id, edge.head)
+
+
+def dot_id(text: str) -> str:
+  return '"' + text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+def _dot_attrs(**attrs: Optional[str]) -> str:
+  set_attrs = [f'{k}={dot_id(v)}' for k, v in attrs.items() if v]
+  return f' [{" ".join(set_attrs)}]' if set_attrs else ''
+
+def _dot_clusters(graph: Graph, truncation: Optional[_Truncation], cluster: Optional[str], indent: str) -> Iterator[str]:
+  # frames only nest a few levels deep, unlike the links
+  for node in graph.members(cluster):
+    if truncation is not None and node.id not in truncation.kept: continue
+    yield f'{indent}{dot_id(node.id)}{_dot_attrs(label=node.label if node.label != node.id else None, shape=node.shape)}\n'
+  for child in graph.clusters(cluster):
+    if truncation is not None and child.id not in truncation.clusters: continue
+    yield f'{indent}subgraph {dot_id(child.id)} {{\n'
+    yield f'{indent}  label={dot_id(child.label)}\n'
+    yield from _dot_clusters(graph, truncation, child.id, indent + '  ')
+    yield f'{indent}}}\n'
+
+def iter_dot(source: Graph | TreeSnapshot | MaterialSnapshot | ast.Namespace, max_nodes: Optional[int] = None) -> Iterator[str]:
+  """the lines of the DOT of a graph, see `write_dot`"""
+  graph = graph_of(source)
+  truncation = _truncate(graph, max_nodes)
+  yield f'digraph {dot_id(graph.name)} {{\n' if graph.name else 'digraph {\n'
+  yield '  compound=true\n'
+  yield '  packmode="clust"\n'
+  yield from _dot_clusters(graph, truncation, None, '  ')
+  if truncation is not None:
+    yield f'  {dot_id(truncated_id)}{_dot_attrs(label=f"{truncation.dropped} more nodes", shape="note")}\n'
+  for edge in _truncated_edges(graph, truncation):
+    attrs = _dot_attrs(taillabel=edge.tail_label, headlabel=edge.head_label, ltail=edge.ltail)
+    yield f'  {dot_id(edge.tail)} -> {dot_id(edge.head)}{attrs}\n'
+  yield '}\n'
+
+def iter_json(source: Graph | TreeSnapshot | MaterialSnapshot | ast.Namespace, max_nodes: Optional[int] = None) -> Iterator[str]:
+  """
+  the lines of a JSON object with the same clusters, nodes and edges as `iter_dot`, one per line:
+  `{"name", "clusters": [{"id", "label", "parent"}], "nodes": [{"id", "label", "cluster"}],
+  "edges": [{"from", "to", "from_socket", "to_socket"}], "truncated"}`
+  """
+  graph = graph_of(source)
+  truncation = _truncate(graph, max_nodes)
+  def items(key: str, values: Iterable[Dict[str, object]], last: bool = False) -> Iterator[str]:
+    yield f'  "{key}": ['
+    sep = '\n'
+    for value in values:
+      yield f'{sep}    {json.dumps(value)}'
+      sep = ',\n'
+    yield '\n  ]\n' if last else '\n  ],\n'
+
+  def walk(parent: Optional[str]) -> Iterator[Cluster]:
+    for cluster in graph.clusters(parent):
+      if truncation is not None and cluster.id not in truncation.clusters: continue
+      yield cluster
+      yield from walk(cluster.id)
+  def nodes() -> Iterator[GraphNode]:
+    yield from graph.members(None)
+    for cluster in walk(None): yield from graph.members(cluster.id)
+
+  yield '{\n'
+  yield f'  "name": {json.dumps(graph.name)},\n'
+  yield from items('clusters', ({'id': c.id, 'label': c.label, 'parent': c.parent} for c in walk(None)))
+  kept_nodes = (n for n in nodes() if truncation is None or n.id in truncation.kept)
+  yield from items('nodes', ({'id': n.id, 'label': n.label, 'cluster': n.cluster} for n in kept_nodes))
+  yield from items('edges', ({'from': e.tail, 'to': e.head, 'from_socket': e.tail_label, 'to_socket': e.head_label}
+                             for e in _truncated_edges(graph, truncation)))
+  yield f'  "truncated": {0 if truncation is None else truncation.dropped}\n'
+  yield '}\n'
+
+def _write(lines: Iterator[str], out: str | TextIO) -> None:
+  if not isinstance(out, str):
+    out.writelines(lines)
+    return
+  with open(out, 'w', encoding='utf-8') as f:
+    f.writelines(lines)
+
+def write_dot(source: Graph | TreeSnapshot | MaterialSnapshot | ast.Namespace, out: str | TextIO,
+              max_nodes: Optional[int] = None) -> None:
+  """
+  write a graph as DOT to a path or file as it is walked. With `max_nodes`, only the nodes
+  nearest to the outputs are kept and the rest are summarized by one node reading into them
+  """
+  _write(iter_dot(source, max_nodes), out)
+
+def write_json(source: Graph | TreeSnapshot | MaterialSnapshot | ast.Namespace, out: str | TextIO,
+               max_nodes: Optional[int] = None) -> None:
+  """write a graph as a JSON edge list, see `iter_json` and `write_dot`"""
+  _write(iter_json(source, max_nodes), out)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+  parser = argparse.ArgumentParser(description='export the decls of a .nlang file as a DOT or JSON graph')
+  parser.add_argument('source', help='.nlang file')
+  parser.add_argument('out', nargs='?', help='.dot or .json file, DOT on stdout if left out')
+  parser.add_argument('--max-nodes', type=int, default=None, help='keep only the nodes nearest to the outputs')
+  args = parser.parse_args(argv)
+  with open(args.source, encoding='utf-8') as f:
+    pctx = ParseContext(f.read())
+  module = ast.Namespace.parse(pctx)
+  if not isinstance(module, ast.Namespace):
+    print(f'{args.source}: parse error {module} at {pctx.index}', file=sys.stderr)
+    return 1
+  graph = ModuleGraph(module, args.source)
+  if args.out is None: write_dot(graph, sys.stdout, args.max_nodes)
+  elif args.out.endswith('.json'): write_json(graph, args.out, args.max_nodes)
+  else: write_dot(graph, args.out, args.max_nodes)
+  return 0
+
+
+class _TestGraphExport(unittest.TestCase):
+  @staticmethod
+  def make_material() -> bpy.types.Material:
+    """like `docs/samples/base.dot`"""
+    material = bpy.types.Material('Base')
+    tree = material.node_tree
+    frame = tree.nodes.new('NodeFrame', label='my frame')
+    value = tree.nodes.new('ShaderNodeValue', parent=frame)
+    math = tree.nodes.new('ShaderNodeMath', operation='MULTIPLY', parent=frame)
+    bsdf = tree.nodes.new('ShaderNodeBsdfPrincipled', name='Principled BSDF')
+    out = tree.nodes.new('ShaderNodeOutputMaterial', name='Material Output')
+    tree.links.new(value.outputs[0], math.inputs[0])
+    tree.links.new(math.outputs[0], bsdf.inputs['Base Color'])
+    tree.links.new(bsdf.outputs[0], out.inputs['Surface'])
+    return material
+
+  def test_tree(self):
+    snapshot = snapshot_material(self.make_material())
+    out = io.StringIO()
+    write_dot(snapshot, out)
+    self.assertEqual([
+      'digraph "Base" {',
+      '  compound=true',
+      '  packmode="clust"',
+      '  "Principled BSDF"',
+      '  "Material Output"',
+      '  subgraph "cluster_Frame" {',
+      '    label="my frame"',
+      '    "Value"',
+      '    "Math"',
+      '  }',
+      '  "Value" -> "Math" [taillabel="Value" headlabel="Value"]',
+      '  "Math" -> "Principled BSDF" [taillabel="Value" headlabel="Base Color"]',
+      '  "Principled BSDF" -> "Material Output" [taillabel="BSDF" headlabel="Surface"]',
+      '}',
+    ], out.getvalue().splitlines())
+
+    out = io.StringIO()
+    write_json(snapshot, out)
+    exported = json.loads(out.getvalue())
+    self.assertEqual([{'id': 'cluster_Frame', 'label': 'my frame', 'parent': None}], exported['clusters'])
+    self.assertEqual(['Principled BSDF', 'Material Output', 'Value', 'Math'], [n['id'] for n in exported['nodes']])
+    self.assertEqual({'from': 'Math', 'to': 'Principled BSDF', 'from_socket': 'Value', 'to_socket': 'Base Color'},
+                     exported['edges'][1])
+
+  def test_module(self):
+    module = ast.Namespace.parse(ParseContext("""
+      fn Mask(x: f32, by) { const k = by * 2.0; return x * k; }
+      const v = 0.5;
+      const m: f32 = Mask(.x=v, .by=1.0);
+      const out = output(.Surface=pbr_shader(.Roughness=m.Result));
+    """))
+    lines = list(iter_dot(module))
+    self.assertEqual([
+      '  "v"',
+      '  "m"',
+      '  "out"',
+      '  subgraph "cluster_Mask" {',
+      '    label="Mask"',
+      '    "Mask/x" [label="x" shape="invhouse"]',
+      '    "Mask/by" [label="by" shape="invhouse"]',
+      '    "Mask/k" [label="k"]',
+      '    "Mask" [label="return" shape="house"]',
+      '  }',
+      '  "Mask/by" -> "Mask/k"',
+      '  "Mask/x" -> "Mask"',
+      '  "Mask/k" -> "Mask"',
+      '  "Mask" -> "m" [ltail="cluster_Mask"]',
+      '  "v" -> "m" [headlabel="x"]',
+      '  "m" -> "out" [taillabel="Result" headlabel="Roughness"]',
+      '}',
+    ], [line.rstrip('\n') for line in lines[3:]])
+
+  def test_truncate(self):
+    material = bpy.types.Material('Chain')
+    prev = material.node_tree.nodes.new('ShaderNodeValue')
+    for _ in range(100):
+      node = material.node_tree.nodes.new('ShaderNodeMath', operation='ADD')
+      material.node_tree.links.new(prev.outputs[0], node.inputs[0])
+      prev = node
+    exported = json.loads(''.join(iter_json(snapshot_material(material), max_nodes=3)))
+    # the nearest to the output, reading the rest through one node
+    self.assertEqual(['Math.097', 'Math.098', 'Math.099'], [n['id'] for n in exported['nodes']])
+    self.assertEqual([('...', 'Math.097'), ('Math.097', 'Math.098'), ('Math.098', 'Math.099')],
+                     [(e['from'], e['to']) for e in exported['edges']])
+    self.assertEqual(98, exported['truncated'])
+    self.assertIn('  "..." [label="98 more nodes" shape="note"]\n', list(iter_dot(snapshot_material(material), max_nodes=3)))
+
+if __name__ == '__main__':
+  sys.exit(main())
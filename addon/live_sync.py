@@ -0,0 +1,415 @@
+"""
+live sync of .nlang files into node trees, for a "code drives nodes" workflow
+
+A watcher thread polls the files and waits until a file has stopped changing for `debounce`
+seconds, so rapid saves are coalesced into one sync. It then reparses only the decls whose text
+changed and diffs their nodes against the last synced version (see `to_nodes`). The resulting
+ops are applied on the main thread from a `bpy.app.timers` timer. Each call applies at most
+`frame_budget` seconds of ops, so the UI keeps drawing.
+
+Each file drives the node tree of the material named like the file, e.g. `Wood.nlang` drives `Wood`.
+"""
+
+from __future__ import annotations
+from collections import Counter, deque
+from dataclasses import dataclass, field
+import os
+import queue
+import re
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple
+import unittest
+
+from . import ast
+from .bpy_wrap import bpy
+from .parser import ParseContext, ParseError
+from .to_nodes import ApplyContext, Graph, LinkSpec, Op, apply_ops, diff, plan, sync_ops
+
+source_ext = '.nlang'
+
+# what ends a top level decl, skipping quoted names and comments that could contain `;`. Decls
+# without `;`, like the serializer writes them, end where a line starts with the next one (like
+# `source_index._decl_keyword`)
+_chunk_boundary = re.compile(r"'[^'\n]*'|//[^\n]*|[;{}]|^[ \t]*(?=(?:const|fn)\b)", re.MULTILINE)
+
+def _comments_start(src: str, start: int, line_start: int) -> int:
+  """where the comment and blank lines right before the line at `line_start` begin, `start` if there's no code"""
+  pos = line_start
+  while pos > start:
+    prev = max(src.rfind('\n', start, pos - 1) + 1, start)
+    line = src[prev:pos].strip()
+    if line and not line.startswith('//'):
+      # the newline goes with the next chunk, like after a `;`
+      return pos - 1
+    pos = prev
+  return start
+
+def split_chunks(src: str) -> List[str]:
+  """split a source into the text of each top level decl, including the comments before it"""
+  chunks: List[str] = []
+  start = depth = 0
+  for m in _chunk_boundary.finditer(src):
+    tok = m.group().strip()
+    if tok == '{':
+      depth += 1
+    elif tok == '}' or (tok == ';' and depth == 0):
+      if tok == '}':
+        depth -= 1
+        if depth != 0: continue
+      chunks.append(src[start:m.end()])
+      start = m.end()
+    elif not tok and depth == 0:
+      end = _comments_start(src, start, m.start())
+      if end > start:
+        chunks.append(src[start:end])
+        start = end
+  if src[start:].strip():
+    chunks.append(src[start:])
+  return chunks
+
+def material_tree(target: str) -> Any:
+  material = bpy.data.materials.get(target)
+  return None if material is None else material.node_tree
+
+
+@dataclass
+class Update:
+  path: str
+  target: str
+  ops: List[Op] = field(default_factory=list)
+  error: Optional[str] = None
+  # decls that were skipped, see `to_nodes.Graph.diagnostics`
+  diagnostics: List[str] = field(default_factory=list)
+  # `time.perf_counter` when the update was parsed and diffed, to measure the latency until it's applied
+  parsed_at: float = 0.0
+
+@dataclass
+class _FileState:
+  stat: Tuple[int, int] = (0, 0)
+  # `time.monotonic` of the last change that hasn't been synced yet
+  changed_at: Optional[float] = None
+  # the chunks of the last synced version, and their nodes
+  chunks: List[str] = field(default_factory=list)
+  graphs: Dict[str, Graph] = field(default_factory=dict)
+  synced: bool = False
+  # counts `Watcher.request_resync` calls, so a sync running meanwhile doesn't mark the file synced
+  resyncs: int = 0
+
+
+class Watcher:
+  """polls files on a thread, putting an `Update` for each debounced change into `updates`"""
+
+  def __init__(self, paths: Iterable[str], debounce: float = 0.05, poll_interval: float = 0.02):
+    self.paths = list(paths)
+    self.debounce = debounce
+    self.poll_interval = poll_interval
+    self.updates: queue.SimpleQueue[Update] = queue.SimpleQueue()
+    self.files: Dict[str, _FileState] = {}
+    # count of (re)parsed chunks, for checking that unchanged decls aren't reparsed
+    self.parsed_chunks = 0
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self._thread: Optional[threading.Thread] = None
+
+  @staticmethod
+  def target(path: str) -> str:
+    return os.path.splitext(os.path.basename(path))[0]
+
+  def sources(self) -> List[str]:
+    sources: List[str] = []
+    for path in self.paths:
+      if not os.path.isdir(path):
+        sources.append(path)
+        continue
+      for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        sources += [os.path.join(dirpath, f) for f in filenames if f.endswith(source_ext)]
+    return sources
+
+  def request_resync(self, path: str) -> None:
+    """sync the whole file again, e.g. after applying an update to its tree failed"""
+    with self._lock:
+      state = self.files.get(path)
+      if state is not None:
+        state.synced = False
+        state.resyncs += 1
+        state.changed_at = time.monotonic()
+
+  def scan(self) -> None:
+    """one poll, syncing files that have stopped changing"""
+    now = time.monotonic()
+    for path in self.sources():
+      try:
+        st = os.stat(path)
+      except FileNotFoundError:
+        # TODO: clear the tree of deleted files?
+        continue
+      with self._lock:
+        state = self.files.setdefault(path, _FileState())
+        if state.stat != (st.st_mtime_ns, st.st_size):
+          state.stat = (st.st_mtime_ns, st.st_size)
+          state.changed_at = now
+    with self._lock:
+      due = [(p, s) for p, s in self.files.items() if s.changed_at is not None and now - s.changed_at >= self.debounce]
+      for _, state in due:
+        state.changed_at = None
+    for path, state in due:
+      update = self.sync(path, state)
+      if update is not None: self.updates.put(update)
+
+  def sync(self, path: str, state: _FileState) -> Optional[Update]:
+    target = self.target(path)
+    try:
+      with open(path, encoding='utf-8') as f:
+        src = f.read()
+    except OSError as e:
+      return Update(path, target, error=str(e))
+
+    # the state is shared with `request_resync` on the main thread, parsing happens outside the lock
+    with self._lock:
+      synced, resyncs, old_chunks, old_graphs = state.synced, state.resyncs, state.chunks, state.graphs
+    chunks = split_chunks(src)
+    graphs: Dict[str, Graph] = {}
+    diagnostics: List[str] = []
+    parsed = 0
+    for i, chunk in enumerate(chunks):
+      graph = old_graphs.get(chunk) or graphs.get(chunk)
+      if graph is None:
+        parsed += 1
+        module = ast.Namespace.parse(ParseContext(chunk))
+        if isinstance(module, ParseError):
+          with self._lock: self.parsed_chunks += parsed
+          # keep the last good version until the file parses again
+          return Update(path, target, error=f'{path}: {module.name} in decl {i + 1}')
+        graph = plan(module, first_decl_index=i)
+        diagnostics += [f'{path}: {d}' for d in graph.diagnostics]
+      graphs[chunk] = graph
+
+    if not synced:
+      full = Graph()
+      for chunk in chunks: full.update(graphs[chunk])
+      ops = sync_ops(full)
+    else:
+      old_counts, new_counts = Counter(old_chunks), Counter(chunks)
+      old, new = Graph(), Graph()
+      for chunk in (old_counts - new_counts).elements(): old.update(old_graphs[chunk])
+      for chunk in (new_counts - old_counts).elements(): new.update(graphs[chunk])
+      def all_links() -> Set[LinkSpec]:
+        return {l for chunk in chunks for l in graphs[chunk].links}
+      ops = diff(old, new, all_links)
+    with self._lock:
+      self.parsed_chunks += parsed
+      state.chunks, state.graphs = chunks, graphs
+      # a resync requested meanwhile still needs the whole file synced
+      state.synced = state.resyncs == resyncs
+    if not ops and not diagnostics: return None
+    return Update(path, target, ops, diagnostics=diagnostics, parsed_at=time.perf_counter())
+
+  def _run(self) -> None:
+    while not self._stop.wait(self.poll_interval):
+      self.scan()
+
+  def start(self) -> None:
+    self._stop.clear()
+    self._thread = threading.Thread(target=self._run, name='nodelang-watcher', daemon=True)
+    self._thread.start()
+
+  def stop(self) -> None:
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+
+class LiveSync:
+  """
+  applies a `Watcher`'s updates to node trees from a `bpy.app.timers` timer, a frame budget at a
+  time. `resolve` finds the tree of a target, by default the material's.
+  `on_update(update, latency)` is called once an update is fully applied, `on_error(message)` on errors
+  """
+
+  def __init__(self, paths: Iterable[str], resolve: Callable[[str], Any] = material_tree, timers: Any = None,
+               debounce: float = 0.05, poll_interval: float = 0.02, frame_budget: float = 0.008,
+               on_update: Optional[Callable[[Update, float], None]] = None,
+               on_error: Optional[Callable[[str], None]] = None):
+    self.watcher = Watcher(paths, debounce, poll_interval)
+    self.resolve = resolve
+    self.timers = timers if timers is not None else bpy.app.timers
+    self.poll_interval = poll_interval
+    self.frame_budget = frame_budget
+    self.on_update = on_update
+    self.on_error = on_error
+    # updates being applied, in order, with the context of their tree once started
+    self.pending: Deque[Tuple[Update, Deque[Op], Optional[ApplyContext]]] = deque()
+    self._tick_callback = self._tick
+
+  def start(self) -> None:
+    self.watcher.start()
+    self.timers.register(self._tick_callback, first_interval=self.poll_interval)
+
+  def stop(self) -> None:
+    self.watcher.stop()
+    if self.timers.is_registered(self._tick_callback):
+      self.timers.unregister(self._tick_callback)
+
+  def _error(self, message: str) -> None:
+    if self.on_error is not None: self.on_error(message)
+    else: print(f'nodelang live sync: {message}')
+
+  def _tick(self) -> Optional[float]:
+    """the timer, runs on the main thread"""
+    try:
+      while True:
+        update = self.watcher.updates.get_nowait()
+        for diagnostic in update.diagnostics: self._error(diagnostic)
+        if update.error is not None: self._error(update.error)
+        else: self.pending.append((update, deque(update.ops), None))
+    except queue.Empty:
+      pass
+
+    deadline = time.perf_counter() + self.frame_budget
+    while self.pending and time.perf_counter() < deadline:
+      update, ops, ctx = self.pending[0]
+      if ctx is None:
+        tree = self.resolve(update.target)
+        if tree is None:
+          self._error(f"{update.path}: there is no material '{update.target}' to sync to")
+          self.pending.popleft()
+          continue
+        ctx = ApplyContext(tree)
+        self.pending[0] = (update, ops, ctx)
+      try:
+        done = apply_ops(ctx, ops, deadline - time.perf_counter())
+      except Exception as e:
+        self._error(f'{update.path}: failed to apply changes, {type(e).__name__}: {e}')
+        self.pending.popleft()
+        self.watcher.request_resync(update.path)
+        continue
+      if done:
+        self.pending.popleft()
+        if self.on_update is not None: self.on_update(update, time.perf_counter() - update.parsed_at)
+    # come back right away while there's more to apply
+    return 0.0 if self.pending else self.poll_interval
+
+
+class _TestLiveSync(unittest.TestCase):
+  def setUp(self):
+    import tempfile
+    self.dir = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.dir.name, 'M.nlang')
+    self.material = bpy.types.Material('M')
+    self.updates: List[Tuple[Update, float]] = []
+    self.errors: List[str] = []
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def write(self, src: str) -> None:
+    with open(self.path, 'w') as f:
+      f.write(src)
+
+  def live_sync(self) -> LiveSync:
+    return LiveSync([self.dir.name], {'M': self.material.node_tree}.get, bpy.app.timers, debounce=0.05,
+                    poll_interval=0.005, on_update=lambda u, latency: self.updates.append((u, latency)),
+                    on_error=self.errors.append)
+
+  def wait_for(self, count: int) -> None:
+    self.assertTrue(bpy.app.timers.run(until=lambda: len(self.updates) >= count or bool(self.errors), timeout=20))
+    self.assertEqual([], self.errors)
+
+  def test_split_chunks(self):
+    src = "/// doc; with a ;\nconst a = 1;\nconst 'b;' = a; fn f(x) { const y = x; return y }\nconst c = 2"
+    self.assertEqual(["/// doc; with a ;\nconst a = 1;", "\nconst 'b;' = a;",
+                      " fn f(x) { const y = x; return y }", "\nconst c = 2"], split_chunks(src))
+
+  def test_serialized(self):
+    from .addon import _TestGroupFunctions, analyze_material
+    group = _TestGroupFunctions.make_group('Double')
+    src = analyze_material(_TestGroupFunctions.make_material('Source', group)).serialize()
+    # the serializer ends decls with newlines rather than `;`
+    self.assertEqual(5, len(split_chunks(src)))
+    self.write(src)
+    sync = self.live_sync()
+    sync.start()
+    try:
+      self.assertTrue(bpy.app.timers.run(until=lambda: len(self.updates) >= 1, timeout=20))
+      # the group and its calls are skipped, the rest is synced
+      self.assertEqual([f"{self.path}: skipped 'Double', fns don't become node groups yet",
+                        f"{self.path}: skipped 'Group', there is no node for function 'Double'",
+                        f"{self.path}: skipped 'Group.001', there is no node for function 'Double'"], self.errors)
+      self.assertEqual({'BsdfPrincipled', 'OutputMaterial'}, {n.name for n in self.material.node_tree.nodes})
+      parsed = sync.watcher.parsed_chunks
+      self.write(src.replace('.Metallic=0.0', '.Metallic=0.5'))
+      self.assertTrue(bpy.app.timers.run(until=lambda: len(self.updates) >= 2, timeout=20))
+    finally:
+      sync.stop()
+    self.assertEqual(1, sync.watcher.parsed_chunks - parsed)
+    self.assertEqual(0.5, self.material.node_tree.nodes['BsdfPrincipled'].inputs['Metallic'].default_value)
+
+  def test_resync_during_sync(self):
+    from unittest import mock
+    watcher = Watcher([self.path], debounce=0)
+    self.write('const A = 1 * 2;')
+    watcher.scan()
+    self.assertTrue(watcher.files[self.path].synced)
+    # of another size, so the change is seen even if the mtime isn't fine grained
+    self.write('const A = 1 * 30;')
+    original_plan = plan
+    def resync_then_plan(module: ast.Namespace, first_decl_index: int = 0) -> Graph:
+      # like applying the last update failing on the main thread while this one is parsed
+      watcher.request_resync(self.path)
+      return original_plan(module, first_decl_index)
+    with mock.patch(f'{__name__}.plan', resync_then_plan):
+      watcher.scan()
+    self.assertFalse(watcher.files[self.path].synced)
+    watcher.scan()
+    self.assertTrue(watcher.files[self.path].synced)
+
+  def test_debounce(self):
+    sync = self.live_sync()
+    sync.start()
+    try:
+      # rapid saves are synced once
+      for i in range(5):
+        self.write(f'const A = {i} * 2;')
+        time.sleep(0.005)
+      self.wait_for(1)
+      time.sleep(0.1)
+      bpy.app.timers.step()
+    finally:
+      sync.stop()
+    self.assertEqual(1, len(self.updates))
+    self.assertEqual(4, self.material.node_tree.nodes['A'].inputs[0].default_value)
+
+  def test_latency(self):
+    n = 3000
+    decls = [f'const v{i} = (v{i - 1} * 0.5) + {i};' for i in range(1, n)]
+    self.write('\n'.join(['const v0 = 1 + 1;', *decls]))
+    sync = self.live_sync()
+    ticks = 0
+    original_tick = sync._tick
+    def counting_tick() -> Optional[float]:
+      nonlocal ticks
+      ticks += 1
+      return original_tick()
+    sync._tick_callback = counting_tick
+    sync.start()
+    try:
+      self.wait_for(1)
+      tree = self.material.node_tree
+      self.assertEqual(2 * n - 1, len(tree.nodes))
+      # the initial sync was spread over many frames
+      self.assertGreater(ticks, 2)
+
+      decls[1000] = 'const v1001 = (v1000 * 0.25) + 1;'
+      parsed = sync.watcher.parsed_chunks
+      self.write('\n'.join(['const v0 = 1 + 1;', *decls]))
+      self.wait_for(2)
+    finally:
+      sync.stop()
+    update, latency = self.updates[1]
+    self.assertEqual(1, sync.watcher.parsed_chunks - parsed)
+    self.assertEqual(2, len(update.ops))
+    self.assertEqual(0.25, tree.nodes['v1001:1'].inputs[1].default_value)
+    self.assertLess(latency, 0.1)
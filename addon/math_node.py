@@ -0,0 +1,149 @@
+"""
+blender's math node for python floats, the one scalar implementation of its operations, used where
+values are computed one at a time (`to_python`). `evaluate` has the vectorized versions and is
+tested against these.
+
+Like numpy, overflows give infinities and functions of infinities give nan instead of raising.
+"""
+
+from __future__ import annotations
+import math
+import operator
+from typing import Callable, Mapping
+
+
+## python's math raises where numpy and blender give infinities or nan
+
+def _floor(a: float) -> float:
+  return float(math.floor(a)) if math.isfinite(a) else a
+
+def _ceil(a: float) -> float:
+  return float(math.ceil(a)) if math.isfinite(a) else a
+
+def _trunc(a: float) -> float:
+  return float(math.trunc(a)) if math.isfinite(a) else a
+
+def _periodic(fn: Callable[[float], float]) -> Callable[[float], float]:
+  return lambda a: fn(a) if math.isfinite(a) else math.nan
+
+def _exp(a: float) -> float:
+  try: return math.exp(a)
+  except OverflowError: return math.inf
+
+def _sinh(a: float) -> float:
+  try: return math.sinh(a)
+  except OverflowError: return math.copysign(math.inf, a)
+
+def _cosh(a: float) -> float:
+  try: return math.cosh(a)
+  except OverflowError: return math.inf
+
+def _is_odd_integer(a: float) -> bool:
+  return math.isfinite(a) and a % 2 == 1
+
+
+## blender's "safe" math, see blender's `node_math` functions
+
+def safe_divide(a: float, b: float) -> float:
+  return a / b if b != 0 else 0.0
+
+def safe_pow(a: float, b: float) -> float:
+  # a negative base only has a real power for integer exponents
+  if a < 0 and _trunc(b) != b: return 0.0
+  try:
+    return math.pow(a, b)
+  except (OverflowError, ValueError):
+    # an overflow, or a zero base with a negative exponent, keeping the sign of odd powers
+    return math.copysign(math.inf, a) if _is_odd_integer(b) else math.inf
+
+def safe_root(a: float, b: float) -> float:
+  return safe_pow(a, safe_divide(1.0, b))
+
+def safe_log(a: float, b: float) -> float:
+  if not (a > 0 and b > 0): return 0.0
+  return safe_divide(math.log(a), math.log(b))
+
+def safe_sqrt(a: float) -> float:
+  return math.sqrt(a) if a > 0 else 0.0
+
+def safe_inverse_sqrt(a: float) -> float:
+  return 1 / math.sqrt(a) if a > 0 else 0.0
+
+def safe_modulo(a: float, b: float) -> float:
+  if b == 0: return 0.0
+  return math.fmod(a, b) if math.isfinite(a) else math.nan
+
+def floored_modulo(a: float, b: float) -> float:
+  return a - _floor(safe_divide(a, b)) * b if b != 0 else 0.0
+
+def wrap(a: float, max_: float, min_: float) -> float:
+  span = max_ - min_
+  return a - span * _floor(safe_divide(a - min_, span)) if span != 0 else min_
+
+def snap(a: float, b: float) -> float:
+  return _floor(safe_divide(a, b)) * b
+
+def pingpong(a: float, b: float) -> float:
+  return abs(floored_modulo(a - b, b * 2) - b) if b != 0 else 0.0
+
+def compare(a: float, b: float, epsilon: float) -> float:
+  return float(abs(a - b) <= max(epsilon, 1e-5))
+
+
+## the bitwise operators `&`, `|` and `^`, on the operands truncated to (and clamped into) 32 bit ints
+
+_int32_min, _int32_max = -2 ** 31, 2 ** 31 - 1
+
+def _int32(a: float) -> int:
+  return min(max(int(a), _int32_min), _int32_max)
+
+def _bitwise(op: Callable[[int, int], int]) -> Callable[[float, float], float]:
+  # infinities and nan have no integer value, so like other functions of them they give nan
+  return lambda a, b: float(op(_int32(a), _int32(b))) if math.isfinite(a) and math.isfinite(b) else math.nan
+
+bitwise_and = _bitwise(operator.and_)
+bitwise_or = _bitwise(operator.or_)
+bitwise_xor = _bitwise(operator.xor)
+
+# functions callable by name, with the arity blender's math node gives them
+call_functions: Mapping[str, Callable[..., float]] = {
+  'add': lambda a, b: a + b,
+  'subtract': lambda a, b: a - b,
+  'multiply': lambda a, b: a * b,
+  'divide': safe_divide,
+  'multiply_add': lambda a, b, c: a * b + c,
+  'pow': safe_pow,
+  'log': safe_log,
+  'sqrt': safe_sqrt,
+  'inverse_sqrt': safe_inverse_sqrt,
+  'abs': abs,
+  'exp': _exp,
+  'min': min,
+  'max': max,
+  'less_than': lambda a, b: float(a < b),
+  'greater_than': lambda a, b: float(a > b),
+  'sign': lambda a: float((a > 0) - (a < 0)),
+  'compare': compare,
+  'round': lambda a: _floor(a + 0.5),
+  'floor': _floor,
+  'ceil': _ceil,
+  'trunc': _trunc,
+  'fract': lambda a: a - _floor(a),
+  'mod': safe_modulo,
+  'floored_mod': floored_modulo,
+  'wrap': wrap,
+  'snap': snap,
+  'pingpong': pingpong,
+  'sin': _periodic(math.sin),
+  'cos': _periodic(math.cos),
+  'tan': _periodic(math.tan),
+  'asin': lambda a: math.asin(min(max(a, -1.0), 1.0)),
+  'acos': lambda a: math.acos(min(max(a, -1.0), 1.0)),
+  'atan': math.atan,
+  'atan2': math.atan2,
+  'sinh': _sinh,
+  'cosh': _cosh,
+  'tanh': math.tanh,
+  'radians': math.radians,
+  'degrees': math.degrees,
+}
@@ -0,0 +1,268 @@
+"""
+converting a single huge material on several processes
+
+The snapshot of the material (see `snapshot`) is partitioned into regions: the nodes only one output
+socket depends on, grouped by the frame they are in, and the nodes several outputs share, which are
+converted once. Each decl is converted together with the nodes inlined into it, reading other decls
+by name, so any set of decls can be converted independently. Regions are split into tasks of
+similar size for the workers, and merging sorts the decls back into the order of the sequential
+analysis, so the result is exactly `analyze_material`'s however the material was split.
+"""
+
+from __future__ import annotations
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import gc
+import math
+import os
+from typing import Any, Dict, List, Optional, Set, Tuple
+import unittest
+
+from . import ast, ast_cache
+from .addon import Decl, GroupFunctions, _linked_from, analyze_material, is_inlined, iter_node_decls, \
+  material_end_nodes, plan_nodes
+from .bpy_wrap import bpy
+from .snapshot import MaterialSnapshot, NodeSnapshot, TreeSnapshot, snapshot_material
+
+
+@dataclass
+class Region:
+  # the output socket (`node.socket`) all of the region's nodes feed into, None for shared nodes
+  output: Optional[str]
+  # the outermost frame the region's nodes are in
+  frame: Optional[str]
+  # decl nodes, by their index in the analysis order
+  decls: List[int] = field(default_factory=list)
+  # nodes, including the ones inlined into the decls
+  size: int = 0
+
+
+@dataclass
+class Partition:
+  order: List[NodeSnapshot]
+  fan_out: Dict[NodeSnapshot, int]
+  # for each node, the index of the decl it is converted as part of
+  decl_of: List[int]
+  regions: List[Region] = field(default_factory=list)
+
+  def tasks(self, max_size: int) -> List[List[int]]:
+    """the regions' decls, with regions bigger than `max_size` nodes split in topological order"""
+    sizes = Counter(self.decl_of)
+    tasks: List[List[int]] = []
+    for region in self.regions:
+      task: List[int] = []
+      size = 0
+      for i in region.decls:
+        if task and size + sizes[i] > max_size:
+          tasks.append(task)
+          task, size = [], 0
+        task.append(i)
+        size += sizes[i]
+      tasks.append(task)
+    return tasks
+
+
+def _outermost_frame(node: NodeSnapshot) -> Optional[str]:
+  frame = None
+  while node.parent is not None:
+    frame = node = node.parent
+  return frame.name if frame is not None else None
+
+def partition(tree: TreeSnapshot) -> Partition:
+  """split a material's nodes into regions by the output sockets depending on them and by frame"""
+  end_nodes = material_end_nodes(tree)
+  order, fan_out = plan_nodes(end_nodes)
+  index = {node: i for i, node in enumerate(order)}
+  ends = set(end_nodes)
+  # the output sockets depending on each node, as a bit mask. Readers come after their inputs,
+  # so walking backwards visits a node's readers before it
+  outputs = [0] * len(order)
+  sockets: List[str] = []
+  for i in range(len(order) - 1, -1, -1):
+    node = order[i]
+    for socket in node.inputs:
+      if not (socket.enabled and socket.is_linked): continue
+      j = index[socket.links[0].from_node]
+      if node in ends:
+        sockets.append(f'{node.name}.{socket.name}')
+        outputs[i] |= 1 << (len(sockets) - 1)
+        outputs[j] |= 1 << (len(sockets) - 1)
+      else:
+        outputs[j] |= outputs[i]
+
+  decl_of = list(range(len(order)))
+  for i in range(len(order) - 1, -1, -1):
+    for from_node in _linked_from(order[i]):
+      if is_inlined(from_node, fan_out): decl_of[index[from_node]] = decl_of[i]
+
+  regions: Dict[Tuple[Optional[str], Optional[str]], Region] = {}
+  sizes = Counter(decl_of)
+  for i, node in enumerate(order):
+    if decl_of[i] != i: continue
+    mask = outputs[i]
+    # a single bit, unless several outputs depend on it. Dangling nodes have none
+    output = sockets[mask.bit_length() - 1] if mask and mask & (mask - 1) == 0 else None
+    key = output, _outermost_frame(node)
+    region = regions.get(key)
+    if region is None: region = regions[key] = Region(*key)
+    region.decls.append(i)
+    region.size += sizes[i]
+  return Partition(order, fan_out, decl_of, list(regions.values()))
+
+
+# the material being converted by this worker process, see `_init_worker`
+_worker: Optional[Tuple[List[NodeSnapshot], Dict[NodeSnapshot, int], GroupFunctions]] = None
+
+def _init_worker(snapshot: MaterialSnapshot, groups: GroupFunctions, order: List[int], fan_out: List[int]) -> None:
+  global _worker
+  # forked workers share the parent's objects until they are written to, and a full collection
+  # writes to all of them (and takes long on a huge snapshot), so leave the inherited ones alone
+  gc.freeze()
+  # the pre-pass comes as node indices, since the nodes can only be pickled as part of their tree
+  nodes = snapshot.node_tree.nodes
+  _worker = [nodes[i] for i in order], {nodes[i]: count for i, count in zip(order, fan_out) if count}, groups
+
+def _convert_task(task: List[int]) -> Tuple[List[int], bytes]:
+  assert _worker is not None, 'the worker was not initialized'
+  order, fan_out, groups = _worker
+  decl_nodes = [order[i] for i in task]
+  in_task: Set[NodeSnapshot] = set(decl_nodes)
+  # decls of other tasks are read by name
+  is_external = lambda node: node not in in_task and not is_inlined(node, fan_out)
+  decls = iter_node_decls(decl_nodes, groups, fan_out=fan_out, is_external=is_external)
+  by_name = {node.name: i for node, i in zip(decl_nodes, task)}
+  # the decls go back encoded like the ast cache, pickling them would recurse once per nesting level
+  namespace = ast.Namespace()
+  positions: List[int] = []
+  for decl in decls:
+    positions.append(by_name[decl.name.name])
+    namespace.append_decl(decl)
+  return positions, ast_cache.encode(namespace, bytes(32))
+
+def _decode_task(result: Tuple[List[int], bytes]) -> List[Tuple[int, Decl]]:
+  positions, encoded = result
+  return list(zip(positions, ast_cache.CachedModule(encoded).iter_decls()))
+
+
+def analyze_material_parallel(material: bpy.types.Material | MaterialSnapshot, workers: Optional[int] = None,
+                              groups: Optional[GroupFunctions] = None, task_size: Optional[int] = None,
+                              mp_context: Any = None) -> ast.Module:
+  """
+  like `analyze_material`, with the regions of the material (see `partition`) converted by a pool of
+  `workers` processes. Tasks have about `task_size` nodes, by default enough for a few tasks per worker.
+  Materials too small to split are converted on the calling thread
+  """
+  snapshot = material if isinstance(material, MaterialSnapshot) else snapshot_material(material)
+  workers = workers or os.cpu_count() or 1
+  parts = partition(snapshot.node_tree)
+  if task_size is None: task_size = max(500, math.ceil(len(parts.order) / (workers * 4)))
+  tasks = parts.tasks(task_size)
+  if workers == 1 or len(tasks) == 1: return analyze_material(snapshot, groups)  # type: ignore[arg-type]
+
+  # groups are converted up front, so that the fn names workers call are the same as sequentially
+  emit_groups = groups is None
+  if groups is None: groups = GroupFunctions()
+  fns_before: Dict[int, List[ast.FnDecl]] = {}
+  for i, node in enumerate(parts.order):
+    if node.type != 'GROUP': continue
+    known = len(groups.namespace.decls)
+    groups.get(node.node_tree)  # type: ignore[arg-type]
+    if emit_groups and len(groups.namespace.decls) > known:
+      fns_before[i] = groups.namespace.decls[known:]  # type: ignore[assignment]
+
+  node_index = {node: i for i, node in enumerate(snapshot.node_tree.nodes)}
+  order = [node_index[node] for node in parts.order]
+  fan_out = [parts.fan_out.get(node, 0) for node in parts.order]
+  initargs = snapshot, groups, order, fan_out
+  with ProcessPoolExecutor(min(workers, len(tasks)), mp_context, _init_worker, initargs) as executor:
+    converted = [decl for result in executor.map(_convert_task, tasks) for decl in _decode_task(result)]
+  converted.sort(key=lambda entry: entry[0])
+
+  module = ast.Module()
+  for i, decl in converted:
+    for fn in fns_before.get(i, ()):
+      module.append_decl(fn)
+    module.append_decl(decl)
+  return module
+
+
+class _TestParallel(unittest.TestCase):
+  @staticmethod
+  def make_material(length: int = 20) -> bpy.types.Material:
+    """two chains into the surface and the displacement, reading a shared group call"""
+    material = bpy.types.Material('M')
+    tree = material.node_tree
+    group = bpy.types.ShaderNodeTree('Double')
+    group.inputs.new('NodeSocketFloat', 'Fac').default_value = 0.5
+    group.outputs.new('NodeSocketFloat', 'Result')
+    group_in, group_out = group.nodes.new('NodeGroupInput'), group.nodes.new('NodeGroupOutput')
+    double = group.nodes.new('ShaderNodeMath', operation='MULTIPLY')
+    group.links.new(group_in.outputs['Fac'], double.inputs[0])
+    group.links.new(double.outputs[0], group_out.inputs['Result'])
+
+    shared = tree.nodes.new('ShaderNodeGroup', node_tree=group)
+    frame = tree.nodes.new('NodeFrame')
+    ends = []
+    for chain in range(2):
+      prev = shared
+      for i in range(length):
+        node = tree.nodes.new('ShaderNodeMath', operation='ADD')
+        tree.links.new(prev.outputs[0], node.inputs[0])
+        # some decls along the chain, read twice
+        if i % 5 == 0: tree.links.new(prev.outputs[0], node.inputs[1])
+        if chain == 1 and i >= length // 2: node.parent = frame
+        prev = node
+      ends.append(prev)
+    bsdf = tree.nodes.new('ShaderNodeBsdfPrincipled')
+    out = tree.nodes.new('ShaderNodeOutputMaterial')
+    tree.links.new(ends[0].outputs[0], bsdf.inputs['Roughness'])
+    tree.links.new(bsdf.outputs[0], out.inputs['Surface'])
+    tree.links.new(ends[1].outputs[0], out.inputs['Displacement'])
+    return material
+
+  def test_partition(self):
+    parts = partition(snapshot_material(self.make_material()).node_tree)
+    regions = {(r.output, r.frame): r for r in parts.regions}
+    self.assertEqual({
+      (None, None),
+      ('OutputMaterial.Surface', None),
+      ('OutputMaterial.Displacement', None),
+      ('OutputMaterial.Displacement', 'Frame'),
+    }, set(regions))
+    self.assertEqual(['Group', 'OutputMaterial'], [parts.order[i].name for i in regions[None, None].decls])
+    self.assertEqual(len(parts.order), sum(r.size for r in parts.regions))
+    # every node is converted exactly once
+    tasks = parts.tasks(3)
+    self.assertEqual(sorted(i for r in parts.regions for i in r.decls), sorted(i for t in tasks for i in t))
+
+  def test_same_as_sequential(self):
+    material = self.make_material()
+    expected = analyze_material(material).serialize()
+    self.assertIn('fn Double', expected)
+    for task_size in (1, 7, 1000):
+      module = analyze_material_parallel(material, workers=2, task_size=task_size)
+      self.assertEqual(expected, module.serialize())
+
+  def test_shared_groups(self):
+    material = self.make_material()
+    groups = GroupFunctions()
+    module = analyze_material_parallel(snapshot_material(material), workers=2, groups=groups, task_size=5)
+    self.assertEqual(analyze_material(material, GroupFunctions()).serialize(), module.serialize())
+    self.assertEqual(['Double'], [fn.name.name for fn in groups.namespace.decls])
+
+  def test_deep(self):
+    # a chain inlined into a single decl, deep enough that pickling it back from a worker would overflow
+    material = bpy.types.Material('M')
+    tree = material.node_tree
+    prev = tree.nodes.new('ShaderNodeMath')
+    for _ in range(5000):
+      node = tree.nodes.new('ShaderNodeMath', operation='ADD')
+      tree.links.new(prev.outputs[0], node.inputs[0])
+      prev = node
+    bsdf = tree.nodes.new('ShaderNodeBsdfPrincipled')
+    out = tree.nodes.new('ShaderNodeOutputMaterial')
+    tree.links.new(prev.outputs[0], bsdf.inputs['Roughness'])
+    tree.links.new(bsdf.outputs[0], out.inputs['Surface'])
+    module = analyze_material_parallel(material, workers=2, task_size=1)
+    self.assertEqual(analyze_material(material).serialize(), module.serialize())
@@ -3,7 +3,7 @@
 #XXX: this is a lexer, parsing methods are in the ast...
 
 from dataclasses import dataclass
-from typing import Sequence, TypeVar, Union, Optional
+from typing import Mapping, Sequence, Tuple, TypeVar, Union, Optional
 from enum import Enum
 from . import token
 from .token import Token
@@ -21,9 +21,50 @@ class ParseNonLexError(Enum):
 
 ParseError = TokenizeErr | ParseNonLexError
 
+# bump whenever the ast produced for the same source changes, invalidates on-disk ast caches
+parser_version = 3
+
 T = TypeVar('T')
 MaybeParsed = ParseError | Optional[T]
 
+keywords: Mapping[str, token.Type] = {
+  'const': token.Type.const,
+  'fn': token.Type.fn,
+  'return': token.Type.return_,
+}
+
+# longest first so that e.g. `^^` is not tokenized as two `^`
+punctuation: Sequence[Tuple[str, token.Type]] = (
+  ('^^', token.Type.caretCaret),
+  ('^/', token.Type.caretFSlash),
+  ('**', token.Type.starStar),
+  ('&&', token.Type.ampAmp),
+  ('||', token.Type.pipePipe),
+  ('^', token.Type.caret),
+  ('*', token.Type.star),
+  ('&', token.Type.amp),
+  ('|', token.Type.pipe),
+  ('+', token.Type.plus),
+  ('-', token.Type.minus),
+  ('/', token.Type.fSlash),
+  (':', token.Type.colon),
+  ('=', token.Type.eq),
+  ('(', token.Type.lPar),
+  (')', token.Type.rPar),
+  ('[', token.Type.lBrack),
+  (']', token.Type.rBrack),
+  ('{', token.Type.lBrace),
+  ('}', token.Type.rBrace),
+  (',', token.Type.comma),
+  (';', token.Type.semicolon),
+  ('.', token.Type.dot),
+)
+
+# the punctuation candidates by their first character, still longest first
+_punctuation_by_char: Mapping[str, Sequence[Tuple[str, token.Type]]] = {
+  c: tuple(p for p in punctuation if p[0][0] == c) for c in {text[0] for text, _ in punctuation}
+}
+
 @dataclass
 class ParseContext:
   source: str
@@ -39,27 +80,28 @@ class ParseContext:
     """indexing but with optionals"""
     return self.remaining_src()[n] if n < len(self.remaining_src()) else None
 
-  # TODO: allow starting and ending single quotes with escapes
+  # TODO: allow escapes in single quoted identifiers
   def try_next_tok_keyword_or_ident(self) -> ErrUnion[TokenizeErr, token.Token]:
     """
     try to get the next token as if it's an identifier, assume unknown token if we fail
     - assumes whitespace has been skipped
     """
-    i = 1
-    src = ""
+    src = self.source
+    if src[self.index] == "'":
+      close = src.find("'", self.index + 1)
+      if close == -1: return TokenizeErr.UnknownTok
+      return Token(token.Ident(src[self.index+1:close], quoted=True), src[self.index:close+1])
+
     # skip first char since it is assumed to be an identifier start
-    while True:
-      c = self.remaining_src()[i]
-      if c.isalnum() or c == '_':
-        i += 1
-      else:
-        src = self.remaining_src()[0:i]
-        break
+    i = self.index + 1
+    while i < len(src) and (src[i].isalnum() or src[i] == '_'):
+      i += 1
+    name = src[self.index:i]
 
-    if src == "const":
-      return Token(token.Type.const, self.remaining_src()[:i])
+    if name in keywords:
+      return Token(keywords[name], name)
     else:
-      return Token(token.Ident(src), self.remaining_src()[:i])
+      return Token(token.Ident(name), name)
 
   def try_next_tok_number(self) -> ErrUnion[TokenizeErr, Token]:
       """
@@ -67,63 +109,78 @@ class ParseContext:
        - assumes whitespace has been skipped
        - assumes context starts with a digit
       """
-      # FIXME: this is bad
       # TODO: roll my own parser to not have redundant logic
-      has_prefix_char = self.remaining_src()[1:2].isalpha() and self.remaining_src()[2:3].isdigit()
+      src = self.source
+      start = self.index
+      has_prefix_char = src[start+1:start+2].isalpha() and src[start+2:start+3].isdigit()
       had_point = False
-      tok_end = 0
-      for i, c in enumerate(self.remaining_src()): 
-        if c == '.':
+      i = start
+      while i < len(src):
+        c = src[i]
+        is_prefix_char = i == start + 1 and has_prefix_char
+        # a point only belongs to the number if a digit follows, e.g. not in `1.x`
+        if c == '.' and not had_point and not has_prefix_char and src[i+1:i+2].isdigit():
           had_point = True
-          continue
-        if c == '_': continue
-        is_prefix_char = i == 1 and has_prefix_char
-        if not c.isdigit() and not is_prefix_char:
-          tok_end = i
+        # after a prefix like `0x`, letters can be digits too
+        elif not (c.isdigit() or c == '_' or is_prefix_char or (has_prefix_char and c.isalnum())):
           break
-      
-      src = self.remaining_src()[0:tok_end+1]
-      parser = float if had_point else int
+        i += 1
+
+      tok_src = src[start:i]
       try:
-        val = parser(src)
-        return Token(val, src)
-      except:
+        val = float(tok_src) if had_point else int(tok_src, 0 if has_prefix_char else 10)
+        return Token(val, tok_src)
+      except ValueError:
         return TokenizeErr.UnknownTok
 
 
   # TODO: return ?enum{.eof}
   def skipAvailable(self) -> bool:
-    """returns false if hit Eof"""
-    while self.remaining_src() != '':
-      c = self.remaining_src()[0]
-      match c:
-        case ' ' | '\t' | '\n':
+    """skip whitespace and comments, returns false if hit Eof"""
+    src = self.source
+    while self.index < len(src):
+      match src[self.index]:
+        case ' ' | '\t' | '\n' | '\r':
           self.index += 1
+        case '/' if src.startswith('//', self.index):
+          self._skip_line()
         case _:
           return True
     return False
 
+  def _skip_line(self) -> None:
+    line_end = self.source.find('\n', self.index)
+    self.index = len(self.source) if line_end == -1 else line_end + 1
+
+  def try_consume_doc_comment(self) -> Optional[str]:
+    """consume any whitespace and comments, returning the text of the `///` doc comment lines among them"""
+    src = self.source
+    lines: list[str] = []
+    while self.index < len(src):
+      if src[self.index] in ' \t\n\r':
+        self.index += 1
+      elif src.startswith('///', self.index):
+        start = self.index + 3
+        self._skip_line()
+        lines.append(src[start:self.index].strip())
+      elif src.startswith('//', self.index):
+        self._skip_line()
+      else:
+        break
+    return '\n'.join(lines) if lines else None
+
   def consume_tok(self) -> ErrUnion[TokenizeErr, Optional[token.Token]]:
     if not self.skipAvailable(): return None
-    _1 = self.remaining_src()[0:1]
-    _2 = self.remaining_src()[0:2]
-    maybeToken: ErrUnion[TokenizeErr, Optional[Token]] = (
-      (
-        Token(token.Type.caretCaret, _2)
-          if self.remaining_src().startswith("^^")
-        else Token(token.Type.caretFSlash, _2)
-          if self.remaining_src().startswith("^/") 
-        else Token(token.Type.caret, _1)
-      ) if self.remaining_src().startswith("^")
-      else Token(token.Type.plus, _1) if self.remaining_src().startswith("+")
-      else Token(token.Type.colon, _1) if self.remaining_src().startswith(":")
-      else Token(token.Type.eq, _1) if self.remaining_src().startswith("=")
-      else Token(token.Type.minus, _1) if self.remaining_src().startswith("-")
-      else self.try_next_tok_keyword_or_ident() if _1 == '_' or _1.isalpha()
+    _1 = self.source[self.index]
+    maybeToken: ErrUnion[TokenizeErr, Token] = (
+      self.try_next_tok_keyword_or_ident() if _1 == '_' or _1 == "'" or _1.isalpha()
       else self.try_next_tok_number() if _1.isdigit()
-      else None
+      else next((Token(tok_type, text)
+                 for text, tok_type in _punctuation_by_char.get(_1, ())
+                 if self.source.startswith(text, self.index)),
+                TokenizeErr.UnknownTok)
     )
-    if not isinstance(maybeToken, TokenizeErr) and maybeToken is not None:
+    if not isinstance(maybeToken, TokenizeErr):
       self.index += len(maybeToken.slice)
     return maybeToken
 
@@ -0,0 +1,425 @@
+"""
+a demand-driven, memoized query engine for incremental semantic analysis, e.g. for the language
+server: parse(file) → decls(file) → resolve(name) → type_of(decl)
+
+The inputs are the sources of the files. Each query result is memoized with the queries it read,
+the revision it was last verified at and the revision its value last changed at. Setting a source
+starts a new revision. Reading a query in a later revision first verifies its memo: if none of the
+queries it read changed after it was verified it is reused, otherwise it's recomputed. A
+recomputed value equal to the previous one keeps its old changed revision, so the queries that
+read it don't need recomputing either (e.g. an edit to a comment reparses the file, but its decls
+compare equal, so nothing that reads them reruns).
+
+Queries are generators that `yield` the key of each query they read and are sent its value, so
+that the engine walks dependencies with its own stack, as converted decls can form very deep
+chains.
+"""
+
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Any, Dict, Generator, List, Optional, Set, Tuple, cast
+import unittest
+
+from . import ast
+from .parser import ParseContext, ParseError
+
+# a query name followed by its arguments, e.g. `('decl', 'a.nlang', 'x')`
+Key = Tuple[Any, ...]
+Query = Generator[Key, Any, Any]
+
+# result types of functions provided by the language rather than declared in a file
+builtin_types: Dict[str, Optional[ast.Type]] = {'sin': 'f32', 'atan2': 'f32', 'pbr_shader': 'bsdf', 'output': None}
+
+
+class QueryCycle(Exception):
+  """thrown into a query that (indirectly) reads itself, at the point where it does so"""
+  def __init__(self, key: Key):
+    super().__init__(f'query {key} depends on itself')
+    self.key = key
+
+@dataclass(frozen=True)
+class DeclRef:
+  """a top level decl, by the file declaring it and its name"""
+  path: str
+  name: str
+
+@dataclass
+class Memo:
+  value: Any
+  changed_at: int
+  verified_at: int
+  # None for inputs
+  deps: Optional[List[Key]] = None
+
+
+@dataclass
+class _Frame:
+  """a query being brought up to date, either by verifying its memo or by executing it"""
+  key: Key
+  memo: Optional[Memo] = None
+  dep_index: int = 0
+  query: Optional[Query] = None
+  deps: Optional[List[Key]] = None
+
+class Database:
+  """
+  the memoized queries over a set of files. Queries can also be read through `get` with their key.
+  Memos are reused as long as they're equal, so e.g. the decl nodes of an edited file may be those
+  of an earlier parse, with the spans of then
+  """
+
+  def __init__(self) -> None:
+    self.revision = 0
+    self.memos: Dict[Key, Memo] = {}
+    # the keys of the queries executed, rather than reused, in order of completion. Clear it at will
+    self.executed: List[Key] = []
+    self._set_input(('files',), ())
+
+  ## inputs
+
+  def _set_input(self, key: Key, value: Any) -> None:
+    self.memos[key] = Memo(value, self.revision, self.revision)
+
+  def set_source(self, path: str, src: str) -> None:
+    memo = self.memos.get(('source', path))
+    if memo is not None and memo.value == src: return
+    self.revision += 1
+    self._set_input(('source', path), src)
+    files = self.memos[('files',)].value
+    if path not in files: self._set_input(('files',), tuple(sorted(files + (path,))))
+
+  def remove_source(self, path: str) -> None:
+    files = self.memos[('files',)].value
+    if path not in files: return
+    self.revision += 1
+    self._set_input(('source', path), None)
+    self._set_input(('files',), tuple(p for p in files if p != path))
+
+  ## the engine
+
+  def get(self, key: Key) -> Any:
+    """the up to date value of a query"""
+    return self._run(key).value
+
+  def _bring_up_to_date(self, stack: List[_Frame], key: Key) -> Optional[Memo]:
+    """the memo of `key` if it can be used as is, otherwise pushes the frame that updates it"""
+    memo = self.memos.get(key)
+    if memo is not None and (memo.deps is None or memo.verified_at == self.revision): return memo
+    if key[0] in ('source', 'files'): return self.memos.setdefault(key, Memo(None, 0, 0))
+    stack.append(_Frame(key, memo=memo) if memo is not None else self._execute(key))
+    return None
+
+  def _execute(self, key: Key) -> _Frame:
+    return _Frame(key, query=getattr(self, f'_{key[0]}')(*key[1:]), deps=[])
+
+  def _finish(self, frame: _Frame, value: Any) -> Memo:
+    old = self.memos.get(frame.key)
+    if old is not None and old.value == value:
+      memo = Memo(old.value, old.changed_at, self.revision, frame.deps)
+    else:
+      memo = Memo(value, self.revision, self.revision, frame.deps)
+    self.memos[frame.key] = memo
+    self.executed.append(frame.key)
+    return memo
+
+  def _run(self, key: Key) -> Memo:
+    stack: List[_Frame] = []
+    memo = self._bring_up_to_date(stack, key)
+    if memo is not None: return memo
+    active: Set[Key] = {key}
+    # what the top frame is resumed with: the memo of the dep it read, or the error updating it raised
+    result: Optional[Memo] = None
+    error: Optional[BaseException] = None
+    while True:
+      depth = len(stack)
+      top = stack[-1].key
+      try:
+        if stack[-1].query is None: result = self._verify(stack, active, result, error)
+        else: result = self._resume(stack, active, result, error)
+        error = None
+      except BaseException as e:
+        result, error = None, e
+      if len(stack) > depth:
+        # a dep is brought up to date first
+        active.add(stack[-1].key)
+        continue
+      stack.pop()
+      active.discard(top)
+      if not stack:
+        if error is not None: raise error
+        return cast(Memo, result)
+
+  def _verify(self, stack: List[_Frame], active: Set[Key], result: Optional[Memo],
+              error: Optional[BaseException]) -> Optional[Memo]:
+    """
+    checks that the deps of the memo of the top frame haven't changed since it was verified, in the
+    order they were read, the memo if so. None if a dep was pushed to be brought up to date first
+    """
+    frame = stack[-1]
+    memo = cast(Memo, frame.memo)
+    deps = cast(List[Key], memo.deps)
+    if error is None and (result is None or result.changed_at <= memo.verified_at):
+      if result is not None: frame.dep_index += 1
+      while frame.dep_index < len(deps):
+        dep = deps[frame.dep_index]
+        # part of a cycle, which recomputing reports
+        if dep in active: break
+        dep_memo = self._bring_up_to_date(stack, dep)
+        if dep_memo is None: return None
+        if dep_memo.changed_at > memo.verified_at: break
+        frame.dep_index += 1
+      else:
+        memo.verified_at = self.revision
+        return memo
+    # a dep changed or failed to update, later deps may no longer be read at all
+    stack[-1] = self._execute(frame.key)
+    return self._resume(stack, active, None, None)
+
+  def _resume(self, stack: List[_Frame], active: Set[Key], result: Optional[Memo],
+              error: Optional[BaseException]) -> Optional[Memo]:
+    """
+    runs the query of the top frame until it returns, its memo then. None if a dep it read was
+    pushed to be brought up to date first
+    """
+    frame = stack[-1]
+    query = cast(Query, frame.query)
+    value = None if result is None else result.value
+    while True:
+      try:
+        dep = query.send(value) if error is None else query.throw(error)
+      except StopIteration as stop:
+        return self._finish(frame, stop.value)
+      error = None
+      cast(List[Key], frame.deps).append(dep)
+      if dep in active:
+        value, error = None, QueryCycle(dep)
+        continue
+      dep_memo = self._bring_up_to_date(stack, dep)
+      if dep_memo is None: return None
+      value = dep_memo.value
+
+  ## queries, see `Database.get` for their keys
+
+  def parse(self, path: str) -> ast.Module | ParseError | None:
+    """None if there is no such file"""
+    return self.get(('parse', path))
+
+  def _parse(self, path: str) -> Query:
+    src = yield ('source', path)
+    if src is None: return None
+    return ast.Namespace.parse(ParseContext(src))
+
+  def decls(self, path: str) -> Dict[str, ast.Node]:
+    """the top level decls of a file by name, the last of the same name. Empty if it doesn't parse"""
+    return self.get(('decls', path))
+
+  def _decls(self, path: str) -> Query:
+    module = yield ('parse', path)
+    if not isinstance(module, ast.Namespace): return {}
+    return {d.name.name: d for d in module.decls if isinstance(d, (ast.ConstDecl, ast.FnDecl))}
+
+  def decl(self, ref: DeclRef) -> Optional[ast.Node]:
+    return self.get(('decl', ref))
+
+  def _decl(self, ref: DeclRef) -> Query:
+    # separate from `decls` so that what reads a decl doesn't rerun for edits to the others
+    decls = yield ('decls', ref.path)
+    return decls.get(ref.name)
+
+  def file_names(self, path: str) -> Tuple[str, ...]:
+    return self.get(('file_names', path))
+
+  def _file_names(self, path: str) -> Query:
+    # names only change when decls are added, removed or renamed, rather than with every edit
+    return tuple(sorted((yield ('decls', path))))
+
+  def name_index(self) -> Dict[str, str]:
+    """the file declaring each name, the first by path if several do"""
+    return self.get(('name_index',))
+
+  def _name_index(self) -> Query:
+    index: Dict[str, str] = {}
+    for path in (yield ('files',)):
+      for name in (yield ('file_names', path)):
+        index.setdefault(name, path)
+    return index
+
+  def resolve(self, name: str) -> Optional[DeclRef]:
+    return self.get(('resolve', name))
+
+  def _resolve(self, name: str) -> Query:
+    path = (yield ('name_index',)).get(name)
+    return None if path is None else DeclRef(path, name)
+
+  def type_of(self, ref: DeclRef) -> Optional[ast.Type]:
+    """the declared or inferred type of a decl (of the result for fns), None if unknown"""
+    return self.get(('type_of', ref))
+
+  def _type_of(self, ref: DeclRef) -> Query:
+    decl = yield ('decl', ref)
+    match decl:
+      case ast.ConstDecl(type=type_) if type_ is not None:
+        return type_
+      case ast.ConstDecl():
+        return (yield from self._expr_type(decl.value, {}))
+      case ast.FnDecl(type=type_) if type_ is not None:
+        return type_
+      case ast.FnDecl():
+        if decl.result is None: return None
+        scope: Dict[str, Optional[ast.Type]] = {p.name.name: p.type for p in decl.params}
+        for local in decl.body.decls:
+          local = cast(ast.ConstDecl, local)
+          scope[local.name.name] = local.type or (yield from self._expr_type(local.value, scope))
+        return (yield from self._expr_type(decl.result, scope))
+    return None
+
+  def _ref_type(self, name: str, scope: Dict[str, Optional[ast.Type]]) -> Query:
+    if name in scope: return scope[name]
+    ref = yield ('resolve', name)
+    if ref is None: return None
+    try:
+      return (yield ('type_of', ref))
+    except QueryCycle:
+      return None
+
+  def _expr_type(self, expr: ast.Node, scope: Dict[str, Optional[ast.Type]]) -> Query:
+    match expr:
+      case ast.Literal(val):
+        return literal_type(val)
+      case ast.ParenGroup(inner):
+        return (yield from self._expr_type(inner, scope))
+      case ast.VarRef(name, derefs):
+        type_ = yield from self._ref_type(name.name, scope)
+        for deref in derefs:
+          type_ = member_type(type_, deref)
+        return type_
+      case ast.BinOp(_, left, right):
+        left_type = yield from self._expr_type(left, scope)
+        right_type = yield from self._expr_type(right, scope)
+        return binop_type(left_type, right_type)
+      case ast.Call(name, args):
+        for arg in args:
+          # not needed for the type, but an error in an argument shouldn't go unnoticed later on
+          yield from self._expr_type(arg.val if isinstance(arg, ast.NamedArg) else arg, scope)
+        if name.name in builtin_types: return builtin_types[name.name]
+        return (yield from self._ref_type(name.name, scope))
+    return None
+
+
+## typing rules
+
+def literal_type(val: ast.PrimitiveValue) -> Optional[ast.Type]:
+  match val:
+    case bool(): return 'b8'
+    case int(): return 'i32'
+    case float(): return 'f32'
+  if isinstance(val, (list, ast.array)):
+    elem_types = {literal_type(v) for v in val}
+    if len(elem_types) == 1 and len(val) > 0:
+      elem_type = elem_types.pop()
+      if isinstance(elem_type, str) and '[' not in elem_type: return cast(ast.Type, f'{elem_type}[{len(val)}]')
+  return None
+
+def _array_type(type_: Optional[ast.Type]) -> Optional[Tuple[str, int]]:
+  """the element type and size of an array type like `f32[4]`"""
+  if not isinstance(type_, str) or not type_.endswith(']'): return None
+  elem, _, size = type_[:-1].partition('[')
+  return elem, int(size)
+
+def member_type(type_: Optional[ast.Type], deref: str) -> Optional[ast.Type]:
+  """the type of a swizzle member, e.g. `.x` or `.rgb`. Unknown for other members"""
+  array_type = _array_type(type_)
+  indices = ast.swizzle_indices(deref)
+  if array_type is None or indices is None: return None
+  elem, size = array_type
+  if size > ast.max_swizzle_size or max(indices) >= size: return None
+  return cast(ast.Type, elem if len(indices) == 1 else f'{elem}[{len(indices)}]')
+
+def binop_type(left: Optional[ast.Type], right: Optional[ast.Type]) -> Optional[ast.Type]:
+  """operands of the same type, or scalars broadcast over arrays of their type"""
+  if left is None or right is None: return None
+  if left == right: return left
+  for scalar, other in ((left, right), (right, left)):
+    array_type = _array_type(other)
+    if array_type is not None and array_type[0] == scalar: return other
+  return None
+
+
+class _TestQueries(unittest.TestCase):
+  def test_types(self):
+    db = Database()
+    db.set_source('a.nlang', """
+      const scale = 2.0;
+      const color = [0.5, 0.25, 1.0, 1.0];
+      const tint = color.rgb * scale;
+      const count: i32 = 3;
+      const mask = atan2(b_val, scale) + 1.0;
+      const bsdf = pbr_shader(.Roughness=mask);
+      fn Brighten(x: f32[3], by) { const k = by * 2.0; return x * k; }
+      fn Typed(x) f32[4] { return x; }
+      const cycle = loop + 1.0;
+      const loop = cycle;
+      const mixed = count + scale;
+    """)
+    db.set_source('b.nlang', "const b_val = 1.0 / 3.0; const other = nope * 2.0;")
+    types = {name: db.type_of(cast(DeclRef, db.resolve(name))) for name in db.name_index()}
+    self.assertEqual({
+      'scale': 'f32', 'color': 'f32[4]', 'tint': 'f32[3]', 'count': 'i32', 'mask': 'f32', 'bsdf': 'bsdf',
+      # params without types are unknown, so is their product
+      'Brighten': None, 'Typed': 'f32[4]', 'cycle': None, 'loop': None, 'mixed': None,
+      'b_val': 'f32', 'other': None,
+    }, types)
+    self.assertIsNone(db.resolve('nope'))
+    self.assertEqual(DeclRef('b.nlang', 'b_val'), db.resolve('b_val'))
+
+  def test_incremental(self):
+    db = Database()
+    src_a = "const x = 1.0;\n// about y\nconst y = x * 2.0;\nconst z = [0.5, 1.0];"
+    db.set_source('a.nlang', src_a)
+    db.set_source('b.nlang', "const w = y + 1.0;\nconst v = w;")
+    refs = {name: cast(DeclRef, db.resolve(name)) for name in 'xyzwv'}
+    def types():
+      return {name: db.type_of(ref) for name, ref in refs.items()}
+    self.assertEqual({'x': 'f32', 'y': 'f32', 'z': 'f32[2]', 'w': 'f32', 'v': 'f32'}, types())
+
+    def rerun(src: str, path: str = 'a.nlang') -> List[Key]:
+      db.executed.clear()
+      db.set_source(path, src)
+      types()
+      return db.executed
+
+    # nothing changed
+    self.assertEqual([], rerun(src_a))
+    # comments and whitespace parse to equal decls
+    self.assertEqual([('parse', 'a.nlang')], rerun(src_a.replace('about', 'all about').replace(' * ', '*')))
+    # a new value of the same type, so w and v aren't affected
+    self.assertEqual({('parse', 'a.nlang'), ('decls', 'a.nlang'), ('file_names', 'a.nlang'),
+                      ('decl', refs['x']), ('decl', refs['y']), ('decl', refs['z']), ('type_of', refs['y'])},
+                     set(rerun(src_a.replace('x * 2.0', 'x / 4.0'))))
+    # a new type reaches the decls reading it in the other file
+    executed = rerun(src_a.replace('x * 2.0', '[2.0, 2.0] * x'))
+    self.assertIn(('type_of', refs['w']), executed)
+    self.assertIn(('type_of', refs['v']), executed)
+    self.assertNotIn(('type_of', refs['x']), executed)
+    self.assertNotIn(('parse', 'b.nlang'), executed)
+    self.assertEqual({'x': 'f32', 'y': 'f32[2]', 'z': 'f32[2]', 'w': 'f32[2]', 'v': 'f32[2]'}, types())
+
+    # a file declaring nothing that's read changes the index, but not what the names resolve to
+    executed = rerun("const u = 1;", 'c.nlang')
+    self.assertIn(('name_index',), executed)
+    self.assertNotIn(('type_of', refs['w']), executed)
+    self.assertEqual(DeclRef('c.nlang', 'u'), db.resolve('u'))
+    # removing the file declaring y
+    db.remove_source('a.nlang')
+    self.assertIsNone(db.resolve('y'))
+    self.assertIsNone(db.type_of(refs['w']))
+
+  def test_deep(self):
+    db = Database()
+    n = 5000
+    db.set_source('chain.nlang', " ".join(f"const v{i} = v{i+1} + 1.0;" for i in range(n)) + f" const v{n} = 0.5;")
+    self.assertEqual('f32', db.type_of(DeclRef('chain.nlang', 'v0')))
+    db.executed.clear()
+    db.set_source('chain.nlang', " ".join(f"const v{i} = v{i+1} + 1.0;" for i in range(n)) + f" const v{n} = 1;")
+    self.assertIsNone(db.type_of(DeclRef('chain.nlang', 'v0')))
+    self.assertEqual(n + 1, sum(key[0] == 'type_of' for key in db.executed))
@@ -0,0 +1,241 @@
+"""
+plain python copies of node trees, taken on blender's main thread so that everything after can
+run on another thread or process without touching bpy
+
+A snapshot has the same attributes the analysis reads from bpy (`node.type`, `node.inputs`,
+`socket.links`, `link.from_socket`, ...), node settings like `operation` are read through `props`.
+Datablocks referenced from settings (images, objects, ...) are kept by name.
+
+Copying reads bpy once per property and item, which for huge trees is mostly time spent crossing
+into blender's RNA. So what can be is read per collection through `foreach_get`: node locations and
+colors, socket `enabled` flags and defaults, and link validity.
+"""
+
+from __future__ import annotations
+from array import array
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+import unittest
+
+from .blender_util import node_props, plain_value
+from .bpy_wrap import in_blender
+from .fake_bpy import bpy_prop_array, bpy_prop_collection
+from . import fake_bpy
+
+
+@dataclass(eq=False)
+class LinkSnapshot:
+  from_node: "NodeSnapshot"
+  from_socket: "SocketSnapshot"
+  to_node: "NodeSnapshot"
+  to_socket: "SocketSnapshot"
+  is_valid: bool = True
+
+
+@dataclass(eq=False)
+class SocketSnapshot:
+  name: str
+  node: "NodeSnapshot"
+  identifier: str
+  type: str
+  is_output: bool = False
+  enabled: bool = True
+  default_value: Any = None
+  links: List[LinkSnapshot] = field(default_factory=list)
+
+  @property
+  def is_linked(self) -> bool:
+    return bool(self.links)
+
+
+@dataclass(eq=False)
+class InterfaceSocketSnapshot:
+  name: str
+  type: str
+  default_value: Any = None
+
+
+@dataclass(eq=False)
+class NodeSnapshot:
+  name: str
+  type: str
+  bl_idname: str
+  label: str = ''
+  location: Tuple[float, float] = (0.0, 0.0)
+  color: Tuple[float, ...] = (0.6, 0.6, 0.6)
+  parent: Optional["NodeSnapshot"] = None
+  is_active_output: bool = False
+  node_tree: Optional["TreeSnapshot"] = None
+  props: Dict[str, Any] = field(default_factory=dict)
+  inputs: bpy_prop_collection[SocketSnapshot] = field(default_factory=bpy_prop_collection)
+  outputs: bpy_prop_collection[SocketSnapshot] = field(default_factory=bpy_prop_collection)
+
+  def __getattr__(self, name: str) -> Any:
+    # only called for missing attributes, `__dict__` may not be filled in yet while unpickling
+    props = self.__dict__.get('props')
+    if props is None or name not in props: raise AttributeError(name)
+    return props[name]
+
+
+@dataclass(eq=False)
+class TreeSnapshot:
+  name: str
+  nodes: bpy_prop_collection[NodeSnapshot] = field(default_factory=bpy_prop_collection)
+  links: bpy_prop_collection[LinkSnapshot] = field(default_factory=bpy_prop_collection)
+  inputs: bpy_prop_collection[InterfaceSocketSnapshot] = field(default_factory=bpy_prop_collection)
+  outputs: bpy_prop_collection[InterfaceSocketSnapshot] = field(default_factory=bpy_prop_collection)
+
+  # pickled as flat tables referencing nodes and sockets by index, because pickling the linked
+  # objects directly recurses once per link and fails on long chains
+  def __getstate__(self) -> Dict[str, Any]:
+    node_index = {node: i for i, node in enumerate(self.nodes)}
+    def socket_key(socket: SocketSnapshot) -> Tuple[int, bool, int]:
+      sockets = socket.node.outputs if socket.is_output else socket.node.inputs
+      return node_index[socket.node], socket.is_output, next(i for i, s in enumerate(sockets) if s is socket)
+    nodes = [
+      (n.name, n.type, n.bl_idname, n.label, n.location, n.color,
+       None if n.parent is None else node_index[n.parent], n.is_active_output, n.node_tree, n.props,
+       [(s.name, s.identifier, s.type, s.enabled, s.default_value) for s in n.inputs],
+       [(s.name, s.identifier, s.type, s.enabled, s.default_value) for s in n.outputs])
+      for n in self.nodes
+    ]
+    links = [(socket_key(l.from_socket), socket_key(l.to_socket), l.is_valid) for l in self.links]
+    return {'name': self.name, 'inputs': list(self.inputs), 'outputs': list(self.outputs), 'nodes': nodes, 'links': links}
+
+  def __setstate__(self, state: Dict[str, Any]) -> None:
+    self.__init__(state['name'])  # type: ignore[misc]
+    self.inputs.extend(state['inputs'])
+    self.outputs.extend(state['outputs'])
+    for (name, type_, bl_idname, label, location, color, _, is_active_output, node_tree, props,
+         inputs, outputs) in state['nodes']:
+      node = NodeSnapshot(name, type_, bl_idname, label, location, color, None, is_active_output, node_tree, props)
+      for specs, sockets, is_output in ((inputs, node.inputs, False), (outputs, node.outputs, True)):
+        sockets.extend(SocketSnapshot(s_name, node, identifier, s_type, is_output, enabled, default)
+                       for s_name, identifier, s_type, enabled, default in specs)
+      self.nodes.append(node)
+    for node, entry in zip(self.nodes, state['nodes']):
+      parent = entry[6]
+      if parent is not None: node.parent = self.nodes[parent]
+    def socket(key: Tuple[int, bool, int]) -> SocketSnapshot:
+      node = self.nodes[key[0]]
+      return (node.outputs if key[1] else node.inputs)[key[2]]
+    for from_key, to_key, is_valid in state['links']:
+      from_socket, to_socket = socket(from_key), socket(to_key)
+      link = LinkSnapshot(from_socket.node, from_socket, to_socket.node, to_socket, is_valid)
+      from_socket.links.append(link)
+      to_socket.links.append(link)
+      self.links.append(link)
+
+
+@dataclass(eq=False)
+class MaterialSnapshot:
+  name: str
+  node_tree: TreeSnapshot
+
+
+# blender stores float properties in single precision, the headless stand-in in python floats.
+# Buffers matching the storage are copied into without converting each element
+_float_typecode = 'f' if in_blender else 'd'
+# the number of floats in the default of sockets with float defaults
+_default_widths = {'VALUE': 1, 'VECTOR': 3, 'RGBA': 4}
+
+def bulk_get(collection: Any, attr: str, count: int, typecode: str = _float_typecode) -> array:
+  """`attr` of every item of a collection (flattened, `count` values in total) in a single `foreach_get`"""
+  buffer = array(typecode, bytes(array(typecode).itemsize * count))
+  collection.foreach_get(attr, buffer)
+  return buffer
+
+def _sockets(collection: Any, node: NodeSnapshot, is_output: bool) -> List[SocketSnapshot]:
+  count = len(collection)
+  if count == 0: return []
+  enabled = bulk_get(collection, 'enabled', count, 'b')
+  sockets = [SocketSnapshot(s.name, node, s.identifier, s.type, is_output, bool(enabled[i]))
+             for i, s in enumerate(collection)]
+  # defaults are read in one go if all the sockets have the same float type, like a math node's
+  width = _default_widths.get(sockets[0].type, 0)
+  if width and all(s.type == sockets[0].type for s in sockets):
+    try:
+      values = bulk_get(collection, 'default_value', count * width)
+    except (TypeError, RuntimeError):
+      # e.g. vectors of some other size
+      pass
+    else:
+      for i, socket in enumerate(sockets):
+        socket.default_value = values[i] if width == 1 else bpy_prop_array(values[i * width:(i + 1) * width])
+      return sockets
+  for socket, original in zip(sockets, collection):
+    socket.default_value = plain_value(getattr(original, 'default_value', None))
+  return sockets
+
+def snapshot_tree(tree: Any, memo: Optional[Dict[Any, TreeSnapshot]] = None) -> TreeSnapshot:
+  """
+  copy a node tree, and the groups it uses. `memo` maps already copied trees to their snapshot,
+  so a group shared by several trees is only copied once and stays shared in the snapshots
+  """
+  if memo is None: memo = {}
+  if tree in memo: return memo[tree]
+  result = memo[tree] = TreeSnapshot(tree.name)
+  # TODO: blender 4 moved the group interface to `tree.interface`
+  result.inputs.extend(InterfaceSocketSnapshot(s.name, s.type, plain_value(getattr(s, 'default_value', None)))
+                       for s in tree.inputs)
+  result.outputs.extend(InterfaceSocketSnapshot(s.name, s.type) for s in tree.outputs)
+
+  by_node: Dict[Any, NodeSnapshot] = {}
+  sockets: Dict[Any, SocketSnapshot] = {}
+  nodes = tree.nodes
+  locations = bulk_get(nodes, 'location', 2 * len(nodes))
+  colors = bulk_get(nodes, 'color', 3 * len(nodes))
+  for i, node in enumerate(nodes):
+    copied = by_node[node] = NodeSnapshot(
+      node.name, node.type, node.bl_idname, node.label, (locations[2 * i], locations[2 * i + 1]),
+      tuple(colors[3 * i:3 * i + 3]), is_active_output=bool(getattr(node, 'is_active_output', False)),
+      props=node_props(node))
+    group = getattr(node, 'node_tree', None)
+    if node.type == 'GROUP' and group is not None:
+      copied.node_tree = snapshot_tree(group, memo)
+    for originals, copies, is_output in ((node.inputs, copied.inputs, False), (node.outputs, copied.outputs, True)):
+      copies.extend(_sockets(originals, copied, is_output))
+      sockets.update(zip(originals, copies))
+    result.nodes.append(copied)
+  for node, copied in by_node.items():
+    if node.parent is not None: copied.parent = by_node[node.parent]
+
+  valid = bulk_get(tree.links, 'is_valid', len(tree.links), 'b')
+  for link, is_valid in zip(tree.links, valid):
+    from_socket, to_socket = sockets[link.from_socket], sockets[link.to_socket]
+    copied_link = LinkSnapshot(from_socket.node, from_socket, to_socket.node, to_socket, bool(is_valid))
+    from_socket.links.append(copied_link)
+    to_socket.links.append(copied_link)
+    result.links.append(copied_link)
+  return result
+
+def snapshot_material(material: Any, memo: Optional[Dict[Any, TreeSnapshot]] = None) -> MaterialSnapshot:
+  return MaterialSnapshot(material.name, snapshot_tree(material.node_tree, memo))
+
+
+class _TestSnapshot(unittest.TestCase):
+  def test_bulk_copy(self):
+    material = fake_bpy.types.Material('M')
+    tree = material.node_tree
+    math = tree.nodes.new('ShaderNodeMath', operation='SUB', location=(10.0, -20.0), color=(0.1, 0.2, 0.3))
+    math.inputs[1].default_value = 0.25
+    bsdf = tree.nodes.new('ShaderNodeBsdfPrincipled')
+    out = tree.nodes.new('ShaderNodeOutputMaterial')
+    tree.links.new(math.outputs[0], bsdf.inputs['Roughness'])
+    tree.links.new(bsdf.outputs[0], out.inputs['Surface'])
+
+    copied = snapshot_material(material).node_tree
+    for node, node_copy in zip(tree.nodes, copied.nodes):
+      self.assertEqual((tuple(node.location), tuple(node.color)), (node_copy.location, node_copy.color))
+      for socket, socket_copy in zip([*node.inputs, *node.outputs], [*node_copy.inputs, *node_copy.outputs]):
+        expected = (socket.identifier, socket.is_output, socket.enabled, socket.default_value, socket.is_linked)
+        actual = (socket_copy.identifier, socket_copy.is_output, socket_copy.enabled, socket_copy.default_value,
+                  socket_copy.is_linked)
+        self.assertEqual(expected, actual)
+    self.assertEqual([True, True], [l.is_valid for l in copied.links])
+
+  def test_foreach_get(self):
+    nodes = fake_bpy.types.Material('M').node_tree.nodes
+    nodes.new('ShaderNodeValue', location=(1.0, 2.0))
+    with self.assertRaises(TypeError):
+      nodes.foreach_get('location', array('d', bytes(8 * 3)))
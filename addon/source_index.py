@@ -0,0 +1,323 @@
+"""
+where things are in a nodelang source, for editors: the innermost ast node at an offset (hover),
+the decl a name refers to (goto definition), and the blender node an ast node becomes (see
+`to_nodes.plan_decl`) and back, to select the node under the cursor in the node editor
+
+The index is kept per top-level decl. Each decl's node spans (see `ast.spanned`) are flattened into
+sorted segments belonging to the innermost node covering them, so lookups are binary searches. An
+edit only reparses the decls it touches, the decls after it keep their index and are only moved.
+"""
+
+from __future__ import annotations
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass, field
+import random
+import re
+from typing import Dict, List, Optional, Tuple
+import unittest
+
+from . import ast
+from .parser import ParseContext, ParseError, ParseNonLexError
+from .to_nodes import plan_decl
+
+# where parsing resumes after a decl that doesn't parse
+_decl_keyword = re.compile(r'^[ \t]*(?=(?:const|fn)\b)', re.MULTILINE)
+
+
+@dataclass
+class DeclEntry:
+  # None for source that didn't parse, up to where parsing resumes
+  decl: Optional[ast.Node]
+  # the source of the entry, including the comments before the decl
+  start: int
+  end: int
+  error: Optional[ParseError] = None
+  # how far the entry moved since it was parsed, its nodes' spans are from when it was parsed
+  shift: int = 0
+  # the segments of the decl as parsed, each starting at a bound and belonging to its innermost node
+  bounds: List[int] = field(default_factory=list)
+  innermost: List[Optional[ast.Node]] = field(default_factory=list)
+  # the decl's nodes in pre-order, and their parents by id (since equal idents are different nodes)
+  nodes: List[ast.Node] = field(default_factory=list)
+  parents: Dict[int, ast.Node] = field(default_factory=dict)
+  # the name of the blender node planned from an ast node, by the ast node's id
+  node_names: Dict[int, str] = field(default_factory=dict)
+
+  def node_at(self, offset: int) -> Optional[ast.Node]:
+    i = bisect_right(self.bounds, offset - self.shift) - 1
+    # the doc comment before the decl is part of it
+    return self.decl if i < 0 else self.innermost[i]
+
+
+def _index_decl(decl: ast.Node, start: int) -> DeclEntry:
+  entry = DeclEntry(decl, start, decl.end)
+  bounds, innermost = entry.bounds, entry.innermost
+
+  def mark(pos: int, node: Optional[ast.Node]) -> None:
+    if bounds and bounds[-1] == pos: innermost[-1] = node
+    else:
+      bounds.append(pos)
+      innermost.append(node)
+
+  # spans nest, so sweeping the nodes in pre-order with a stack of the ones still open gives the
+  # innermost node at each point where it changes
+  open_nodes: List[ast.Node] = []
+  stack: List[ast.Node] = [decl]
+  while stack:
+    node = stack.pop()
+    entry.nodes.append(node)
+    kids = ast.children(node)
+    for kid in kids: entry.parents[id(kid)] = node
+    stack.extend(reversed(kids))
+    if node.start < 0: continue  # e.g. the body namespace of a fn
+    while open_nodes and open_nodes[-1].end <= node.start:
+      closed = open_nodes.pop()
+      mark(closed.end, open_nodes[-1] if open_nodes else None)
+    mark(node.start, node)
+    open_nodes.append(node)
+  while open_nodes:
+    closed = open_nodes.pop()
+    mark(closed.end, open_nodes[-1] if open_nodes else None)
+
+  # fn decls and decls calling them get no nodes yet, see `to_nodes.plan_decl`
+  for spec in plan_decl(decl).nodes.values():
+    if spec.expr is not None: entry.node_names[id(spec.expr)] = spec.name
+  return entry
+
+
+class SourceIndex:
+  def __init__(self, src: str) -> None:
+    self.src = src
+    self.entries: List[DeclEntry] = []
+    # the entries' starts, to bisect
+    self._starts: List[int] = []
+    # by name, with several for names declared more than once, of which the last one counts (like
+    # in `ast.Namespace` and `to_nodes.plan`)
+    self._decls: Dict[str, List[DeclEntry]] = {}
+    self._blender_nodes: Dict[str, List[Tuple[DeclEntry, ast.Node]]] = {}
+    # the entry of every indexed node, by id
+    self._entry_of: Dict[int, DeclEntry] = {}
+    self._reindex(0, 0, 0, 0)
+
+  def edit(self, start: int, end: int, text: str) -> None:
+    """replace the source from `start` to `end` with `text`, reparsing only the decls it touches"""
+    self.src = self.src[:start] + text + self.src[end:]
+    delta = len(text) - (end - start)
+    # entries ending before the edit are kept, entries starting after it are moved
+    first = bisect_left(self.entries, start, key=lambda e: e.end)
+    # a decl without a `;` goes on with whatever follows it
+    if first and (self.entries[first - 1].decl is None or self.src[self.entries[first - 1].end - 1] not in ';}'):
+      first -= 1
+    last = bisect_right(self._starts, end)
+    for entry in self.entries[last:]:
+      entry.start += delta
+      entry.end += delta
+      entry.shift += delta
+    self._starts[last:] = [s + delta for s in self._starts[last:]]
+    parse_from = self.entries[first - 1].end if first else 0
+    self._reindex(first, last, parse_from, start + len(text))
+
+  def _reindex(self, first: int, last: int, parse_from: int, parse_to: int) -> None:
+    """
+    replace the entries from `first` up to `last` by parsing from `parse_from`. Parsing goes on past
+    `parse_to` until it is back at the start of a kept entry, replacing the ones it runs into
+    """
+    src = self.src
+    kept = last
+    new: List[DeclEntry] = []
+    pctx = ParseContext(src, parse_from)
+    while True:
+      while pctx.index < len(src) and src[pctx.index] in ' \t\n\r': pctx.index += 1
+      pos = pctx.index
+      while kept < len(self.entries) and self._starts[kept] < pos: kept += 1
+      if kept < len(self.entries) and self._starts[kept] == pos and pos >= parse_to: break
+      comment = pctx.try_consume_doc_comment()
+      if not pctx.skipAvailable(): break
+      decl = ast.ConstDecl.parse(pctx) or ast.FnDecl.parse(pctx)
+      if decl is None or isinstance(decl, ParseError):
+        # skip to the next decl keyword, the source up to it isn't indexed
+        keyword = _decl_keyword.search(src, pos + 1)
+        resume = keyword.end() if keyword is not None else len(src)
+        new.append(DeclEntry(None, pos, resume, decl or ParseNonLexError.UnexpectedToken))
+        pctx.reset(resume)
+        continue
+      decl.comment = comment
+      new.append(_index_decl(decl, pos))
+
+    for entry in self.entries[first:kept]: self._forget(entry)
+    self.entries[first:kept] = new
+    self._starts[first:kept] = [entry.start for entry in new]
+    for entry in new: self._remember(entry)
+
+  def _remember(self, entry: DeclEntry) -> None:
+    if entry.decl is None: return
+    for node in entry.nodes:
+      self._entry_of[id(node)] = entry
+      name = entry.node_names.get(id(node))
+      if name is not None: self._blender_nodes.setdefault(name, []).append((entry, node))
+    if isinstance(entry.decl, (ast.ConstDecl, ast.FnDecl)):
+      self._decls.setdefault(entry.decl.name.name, []).append(entry)
+
+  def _forget(self, entry: DeclEntry) -> None:
+    if entry.decl is None: return
+    for node in entry.nodes:
+      self._entry_of.pop(id(node), None)
+      name = entry.node_names.get(id(node))
+      if name is None: continue
+      found = self._blender_nodes[name]
+      found.remove((entry, node))
+      if not found: del self._blender_nodes[name]
+    if isinstance(entry.decl, (ast.ConstDecl, ast.FnDecl)):
+      entries = self._decls[entry.decl.name.name]
+      entries.remove(entry)
+      if not entries: del self._decls[entry.decl.name.name]
+
+  def decl(self, name: str) -> Optional[ast.Node]:
+    """the top-level decl of a name"""
+    entries = self._decls.get(name)
+    return max(entries, key=lambda e: e.start).decl if entries else None
+
+  def entry_at(self, offset: int) -> Optional[DeclEntry]:
+    i = bisect_right(self._starts, offset) - 1
+    if i < 0 or offset >= self.entries[i].end: return None
+    return self.entries[i]
+
+  def node_at(self, offset: int) -> Optional[ast.Node]:
+    """the innermost ast node at an offset"""
+    entry = self.entry_at(offset)
+    return entry.node_at(offset) if entry is not None else None
+
+  def span(self, node: ast.Node) -> Optional[Tuple[int, int]]:
+    """
+    where a node is in the current source. Nodes that were moved by edits keep the spans they were
+    parsed with (and `Node.slice` still works on the source they were parsed from)
+    """
+    entry = self._entry_of.get(id(node))
+    if entry is None: return None
+    return node.start + entry.shift, node.end + entry.shift
+
+  def parent(self, node: ast.Node) -> Optional[ast.Node]:
+    entry = self._entry_of.get(id(node))
+    return entry.parents.get(id(node)) if entry is not None else None
+
+  def definition(self, offset: int) -> Optional[ast.Node]:
+    """the decl or fn param that the name at an offset refers to"""
+    node = self.node_at(offset)
+    if isinstance(node, ast.Ident): node = self.parent(node)
+    if not isinstance(node, (ast.VarRef, ast.Call)): return None
+    name = node.name
+    # names in a fn body can be the fn's params and decls
+    scope = self.parent(node)
+    while scope is not None and not isinstance(scope, ast.FnDecl): scope = self.parent(scope)
+    if scope is not None:
+      local = scope.body.decl_by_name.get(name) or next((p for p in scope.params if p.name == name), None)
+      if local is not None: return local
+    return self.decl(name.name)
+
+  def blender_node_at(self, offset: int) -> Optional[str]:
+    """the name of the blender node planned from the innermost expression at an offset that has one"""
+    entry = self.entry_at(offset)
+    node = entry.node_at(offset) if entry is not None else None
+    while node is not None:
+      name = entry.node_names.get(id(node))  # type: ignore[union-attr]
+      if name is not None: return name
+      node = entry.parents.get(id(node))  # type: ignore[union-attr]
+    return None
+
+  def blender_node_source(self, name: str) -> Optional[ast.Node]:
+    """the ast node a blender node is planned from, see `span` for where it is"""
+    found = self._blender_nodes.get(name)
+    return max(found, key=lambda f: f[0].start)[1] if found else None
+
+
+class _TestSourceIndex(unittest.TestCase):
+  src = (
+    "/// doc\n"
+    "const a = (b + 1.5) * sin(.x=c.x, 2);\n"
+    "fn F(p: f32) { const z = p; return z + b; }\n"
+    "const b = 4;\n"
+  )
+
+  def test_lookup(self):
+    index = SourceIndex(self.src)
+    self.assertEqual(['a', 'F', 'b'], [e.decl.name.name for e in index.entries])
+    node = index.node_at(self.src.index('sin'))
+    self.assertIsInstance(node, ast.Ident)
+    self.assertIsInstance(index.parent(node), ast.Call)
+    literal = index.node_at(self.src.index('1.5') + 1)
+    self.assertEqual(ast.Literal(1.5), literal)
+    self.assertEqual('1.5', self.src[slice(*index.span(literal))])
+    self.assertEqual(index.entries[0].decl, index.node_at(self.src.index('doc')))
+    self.assertIsNone(index.node_at(self.src.index('\nfn')))
+
+  def test_blender_nodes(self):
+    index = SourceIndex(self.src)
+    # the node of the decl, of the nested math node (from its operand), and of the call
+    self.assertEqual('a', index.blender_node_at(self.src.index('a =')))
+    self.assertEqual('a:1', index.blender_node_at(self.src.index('1.5')))
+    self.assertEqual('a:2', index.blender_node_at(self.src.index('.x')))
+    self.assertEqual('sin(.x=c.x, 2)', index.blender_node_source('a:2').slice())
+    self.assertEqual('b', index.blender_node_at(self.src.index('4')))
+    self.assertIsNone(index.blender_node_at(self.src.index('return')))
+
+  def test_definition(self):
+    index = SourceIndex(self.src)
+    self.assertIs(index.entries[2].decl, index.definition(self.src.index('b +')))
+    self.assertIs(index.entries[2].decl, index.definition(self.src.index('b;')))
+    self.assertIsInstance(index.definition(self.src.index('p;')), ast.Param)
+    self.assertEqual('const z = p;', index.definition(self.src.index('z +')).slice())
+    self.assertIsNone(index.definition(self.src.index('c.x')))
+
+  def assertSameAsReindexed(self, index: SourceIndex):
+    fresh = SourceIndex(index.src)
+    # (which error a decl has can depend on the source after it, e.g. with an unclosed quote)
+    self.assertEqual([(e.start, e.end, e.error is None) for e in fresh.entries],
+                     [(e.start, e.end, e.error is None) for e in index.entries])
+    for offset in range(len(index.src) + 1):
+      node, fresh_node = index.node_at(offset), fresh.node_at(offset)
+      self.assertEqual(fresh_node, node, offset)
+      if node is not None: self.assertEqual(fresh.span(fresh_node), index.span(node))
+      self.assertEqual(fresh.blender_node_at(offset), index.blender_node_at(offset))
+    for name in fresh._blender_nodes.keys() | index._blender_nodes.keys():
+      self.assertEqual(fresh.span(fresh.blender_node_source(name)), index.span(index.blender_node_source(name)))
+    for name in fresh._decls.keys() | index._decls.keys():
+      self.assertEqual(fresh.span(fresh.decl(name)), index.span(index.decl(name)))
+
+  def test_edit(self):
+    index = SourceIndex(self.src)
+    fn, b = index.entries[1].decl, index.entries[2].decl
+    at = self.src.index('2)')
+    index.edit(at, at + 1, '20 * a2')
+    self.assertIs(fn, index.entries[1].decl)
+    self.assertIs(b, index.entries[2].decl)
+    self.assertEqual('const b = 4;', index.src[slice(*index.span(b))])
+    self.assertEqual('a:3', index.blender_node_at(index.src.index('a2')))
+    self.assertSameAsReindexed(index)
+
+    # a decl that doesn't parse is skipped until it's fixed
+    at = index.src.index('\nconst b')
+    index.edit(at, at, '\nconst broken = (;')
+    self.assertIsNotNone(index.entries[2].error)
+    self.assertIs(b, index.entries[3].decl)
+    self.assertSameAsReindexed(index)
+    at = index.src.index('(;')
+    index.edit(at, at + 2, '1;')
+    self.assertEqual(['a', 'F', 'broken', 'b'], [e.decl.name.name for e in index.entries])
+    self.assertSameAsReindexed(index)
+
+    # merging decls and splitting them again
+    at = index.src.index('}')
+    index.edit(at, at + 1, '')
+    self.assertSameAsReindexed(index)
+    index.edit(at, at, '}')
+    self.assertSameAsReindexed(index)
+
+  def test_random_edits(self):
+    rng = random.Random(38)
+    index = SourceIndex(self.src * 3)
+    snippets = ['', ' ', '\n', '1', 'x', ';', '(', ')', '}', '+ d', 'const q = 1;\n', '/// c\n', '// c\n']
+    for _ in range(200):
+      start = rng.randrange(len(index.src) + 1)
+      end = min(len(index.src), start + rng.choice((0, 0, 1, 3, 12)))
+      index.edit(start, end, rng.choice(snippets))
+      self.assertSameAsReindexed(index)
@@ -0,0 +1,360 @@
+"""
+finding subgraphs repeated across (and within) materials, and extracting them into shared groups,
+so that each is converted and emitted once as a fn decl instead of once per copy
+
+Nodes are compared by structural signatures refined like Weisfeiler-Lehman labels, along input
+links only: the signature of a node at depth d is its own settings and sockets together with the
+depth d-1 signatures of the nodes it reads. Only nodes read by nothing else are followed (nodes
+read more than once stay outside and become parameters), so a signature stands for a tree of
+nodes that a single group node can replace. Since sockets are ordered, the refinement is exact:
+signatures are interned into ids and equal ids are isomorphic subgraphs, without hash collisions.
+
+Literal defaults aren't part of the signatures, those that differ between the copies of a
+subgraph become parameters of its group, like its inputs from outside of it.
+"""
+
+from __future__ import annotations
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+import unittest
+
+from . import ast
+from .addon import analyze_library, material_end_nodes, plan_nodes
+from .blender_util import node_tree_hash
+from .bpy_wrap import bpy
+from .snapshot import InterfaceSocketSnapshot, LinkSnapshot, MaterialSnapshot, NodeSnapshot, SocketSnapshot, \
+  TreeSnapshot, snapshot_material
+
+# nodes left out of extracted subgraphs: literals are cheaper inlined where they're read, and
+# interface nodes and frames aren't computations
+_kept_node_types = {'VALUE', 'RGB', 'GROUP_INPUT', 'GROUP_OUTPUT', 'FRAME', 'REROUTE'}
+# socket types whose defaults the analysis reads (see `addon.get_default_value`)
+_default_types = {'VALUE', 'BOOLEAN', 'RGBA'}
+# signature parts of inputs read from outside of the subgraph, and unlinked inputs
+_PARAM, _DEFAULT = -1, -2
+
+
+def _hashable(value: Any) -> Any:
+  if isinstance(value, (list, tuple)): return tuple(_hashable(v) for v in value)
+  if isinstance(value, dict): return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+  return value
+
+def _extractable(node: NodeSnapshot) -> bool:
+  return node.type not in _kept_node_types and not node.type.startswith('OUTPUT') and len(node.outputs) > 0
+
+
+@dataclass
+class Instance:
+  tree: TreeSnapshot
+  # the subgraph's nodes from its root in pre-order, which corresponds between instances
+  nodes: List[NodeSnapshot]
+
+  @property
+  def root(self) -> NodeSnapshot:
+    return self.nodes[0]
+
+
+@dataclass
+class Param:
+  name: str
+  type: str
+  # the input the parameter is for, as an index into `Instance.nodes` and into that node's inputs
+  node: int
+  input: int
+
+
+@dataclass
+class Pattern:
+  size: int
+  instances: List[Instance]
+  params: List[Param] = field(default_factory=list)
+  # the indices of the root's outputs that are read, which the group outputs
+  outputs: List[int] = field(default_factory=list)
+  group: Optional[TreeSnapshot] = None
+
+
+def _subgraph(root: NodeSnapshot, depth: int, inner: Dict[NodeSnapshot, List[Tuple[NodeSnapshot, str] | int]],
+              *excluded: Set[NodeSnapshot]) -> Optional[List[NodeSnapshot]]:
+  """the nodes of the signature of `root` at `depth` (see `find_repeated`), None if any are excluded"""
+  nodes: List[NodeSnapshot] = []
+  stack = [(root, depth)]
+  while stack:
+    node, left = stack.pop()
+    if any(node in nodes_ for nodes_ in excluded): return None
+    nodes.append(node)
+    if left == 1: continue
+    stack.extend((part[0], left - 1) for part in reversed(inner[node]) if not isinstance(part, int))
+  return nodes
+
+def find_repeated(trees: Sequence[TreeSnapshot], min_size: int = 8, max_depth: int = 16,
+                  min_count: int = 2) -> List[Pattern]:
+  """
+  the subgraphs of at least `min_size` nodes (and at most `max_depth` deep) that occur `min_count`
+  times or more. Subgraphs don't overlap, they're picked greedily by how many nodes extracting
+  them saves
+  """
+  labels: Dict[Any, int] = {}
+  ids: Dict[Tuple[Any, ...], int] = {}
+  sizes: List[int] = []
+  depths: List[int] = []
+  occurrences: Dict[int, List[Tuple[int, NodeSnapshot]]] = defaultdict(list)
+  group_hashes: Dict[Any, str] = {}
+
+  labels_of: Dict[NodeSnapshot, int] = {}
+  # the inputs of each node that are in its subgraph once deep enough, with the socket read
+  inner: Dict[NodeSnapshot, List[Tuple[NodeSnapshot, str] | int]] = {}
+  readers: Dict[NodeSnapshot, NodeSnapshot] = {}
+  tree_of: Dict[NodeSnapshot, int] = {}
+  changed: List[NodeSnapshot] = []
+  for t, tree in enumerate(trees):
+    order, fan_out = plan_nodes(material_end_nodes(tree))
+    for node in order:
+      if not _extractable(node): continue
+      label = (node.bl_idname, _hashable(node.props),
+               node_tree_hash(node.node_tree, group_hashes) if node.node_tree is not None else None,
+               tuple((s.identifier, s.type) for s in node.inputs if s.enabled),
+               tuple(s.identifier for s in node.outputs))
+      labels_of[node] = labels.setdefault(label, len(labels))
+      parts: List[Tuple[NodeSnapshot, str] | int] = []
+      for s in node.inputs:
+        if not s.enabled: continue
+        if not s.is_linked:
+          parts.append(_DEFAULT)
+          continue
+        from_node = s.links[0].from_node
+        if _extractable(from_node) and fan_out.get(from_node) == 1:
+          parts.append((from_node, s.links[0].from_socket.identifier))
+          readers[from_node] = node
+        else:
+          parts.append(_PARAM)
+      inner[node] = parts
+      tree_of[node] = t
+      changed.append(node)
+
+  # a signature only changes with a deeper one of an input in the subgraph, so each round only
+  # looks at the readers of the nodes whose signature changed in the one before. A signature is
+  # first reached in the round of its depth, by every node that has it, so after that round the
+  # ones only a single node has are known, and so are their readers: they're left alone from then
+  signatures: Dict[NodeSnapshot, int] = {}
+  for depth in range(1, max_depth + 1):
+    updated: Dict[NodeSnapshot, int] = {}
+    for node in changed:
+      parts: List[Any] = [labels_of[node]]
+      size = 1
+      for part in inner[node]:
+        if isinstance(part, int):
+          parts.append(part)
+        elif depth == 1:
+          parts.append(_PARAM)
+        else:
+          sig = signatures[part[0]]
+          parts.append((sig, part[1]))
+          size += sizes[sig]
+      key = tuple(parts)
+      sig = ids.get(key)
+      if sig is None:
+        sig = ids[key] = len(sizes)
+        sizes.append(size)
+        depths.append(depth)
+      if signatures.get(node) != sig:
+        updated[node] = sig
+        occurrences[sig].append((tree_of[node], node))
+    if not updated: break
+    signatures.update(updated)
+    # in topological order, like the nodes of each tree
+    changed = list({readers[node]: None for node, sig in updated.items()
+                    if node in readers and len(occurrences[sig]) > 1})
+
+  # the most nodes saved first: each copy becomes a single group node and the group keeps one
+  candidates = sorted((sig for sig, found in occurrences.items() if len(found) >= min_count and sizes[sig] >= min_size),
+                      key=lambda sig: (-(len(occurrences[sig]) * (sizes[sig] - 1) - sizes[sig]), sig))
+  claimed: Set[NodeSnapshot] = set()
+  patterns: List[Pattern] = []
+  for sig in candidates:
+    instances: List[Instance] = []
+    taken: Set[NodeSnapshot] = set()
+    for t, root in occurrences[sig]:
+      nodes = _subgraph(root, depths[sig], inner, claimed, taken)
+      if nodes is None: continue
+      instances.append(Instance(trees[t], nodes))
+      taken.update(nodes)
+    if len(instances) < min_count: continue
+    claimed |= taken
+    patterns.append(_plan_pattern(sizes[sig], instances))
+  return patterns
+
+def _plan_pattern(size: int, instances: List[Instance]) -> Pattern:
+  pattern = Pattern(size, instances)
+  first = instances[0].nodes
+  inside = set(first)
+  names: Dict[str, int] = {}
+  for i, node in enumerate(first):
+    for j, socket in enumerate(node.inputs):
+      if not socket.enabled: continue
+      if socket.is_linked:
+        if socket.links[0].from_node in inside: continue
+      elif socket.type not in _default_types or all(
+          _hashable(other.nodes[i].inputs[j].default_value) == _hashable(socket.default_value) for other in instances[1:]):
+        continue
+      # named like blender names duplicates
+      count = names.get(socket.name, 0)
+      names[socket.name] = count + 1
+      name = socket.name if count == 0 else f'{socket.name}.{count:03}'
+      pattern.params.append(Param(name, socket.type, i, j))
+  pattern.outputs = [k for k in range(len(first[0].outputs)) if any(inst.root.outputs[k].links for inst in instances)]
+  return pattern
+
+
+def _link(tree: TreeSnapshot, from_socket: SocketSnapshot, to_socket: SocketSnapshot) -> None:
+  link = LinkSnapshot(from_socket.node, from_socket, to_socket.node, to_socket)
+  from_socket.links.append(link)
+  to_socket.links.append(link)
+  tree.links.append(link)
+
+def _copy_node(node: NodeSnapshot) -> NodeSnapshot:
+  copy = NodeSnapshot(node.name, node.type, node.bl_idname, node.label, node.location, node.color,
+                      is_active_output=node.is_active_output, node_tree=node.node_tree, props=dict(node.props))
+  for sockets, copies in ((node.inputs, copy.inputs), (node.outputs, copy.outputs)):
+    copies.extend(SocketSnapshot(s.name, copy, s.identifier, s.type, s.is_output, s.enabled, s.default_value)
+                  for s in sockets)
+  return copy
+
+def _build_group(pattern: Pattern, name: str) -> TreeSnapshot:
+  """the group of a pattern, made from its first instance"""
+  first = pattern.instances[0].nodes
+  root = first[0]
+  group = TreeSnapshot(name)
+  group.inputs.extend(InterfaceSocketSnapshot(p.name, p.type, first[p.node].inputs[p.input].default_value)
+                      for p in pattern.params)
+  group.outputs.extend(InterfaceSocketSnapshot(root.outputs[k].name, root.outputs[k].type) for k in pattern.outputs)
+  group_in = NodeSnapshot('Group Input', 'GROUP_INPUT', 'NodeGroupInput')
+  group_in.outputs.extend(SocketSnapshot(p.name, group_in, p.name, p.type, True) for p in pattern.params)
+  group_out = NodeSnapshot('Group Output', 'GROUP_OUTPUT', 'NodeGroupOutput', is_active_output=True)
+  group_out.inputs.extend(SocketSnapshot(s.name, group_out, s.identifier, s.type)
+                          for s in (root.outputs[k] for k in pattern.outputs))
+
+  copies = {node: _copy_node(node) for node in first}
+  group.nodes.extend([group_in, *copies.values(), group_out])
+  for node, copy in copies.items():
+    for socket, copied in zip(node.inputs, copy.inputs):
+      if not (socket.enabled and socket.is_linked): continue
+      link = socket.links[0]
+      if link.from_node in copies:
+        from_copy = copies[link.from_node]
+        _link(group, from_copy.outputs[list(link.from_node.outputs).index(link.from_socket)], copied)
+  for param, socket in zip(pattern.params, group_in.outputs):
+    _link(group, socket, copies[first[param.node]].inputs[param.input])
+  for k, socket in zip(pattern.outputs, group_out.inputs):
+    _link(group, copies[root].outputs[k], socket)
+  return group
+
+def _replace(pattern: Pattern, instance: Instance) -> NodeSnapshot:
+  """a group node to replace an instance with, taking over the links into and out of it"""
+  assert pattern.group is not None
+  root = instance.root
+  node = NodeSnapshot(root.name, 'GROUP', 'ShaderNodeGroup', root.label, root.location, root.color, root.parent,
+                      node_tree=pattern.group)
+  for param in pattern.params:
+    socket = instance.nodes[param.node].inputs[param.input]
+    new = SocketSnapshot(param.name, node, param.name, param.type, False, True, socket.default_value)
+    if socket.is_linked:
+      link = socket.links[0]
+      link.to_node, link.to_socket = node, new
+      new.links.append(link)
+    node.inputs.append(new)
+  for k in pattern.outputs:
+    output = root.outputs[k]
+    new = SocketSnapshot(output.name, node, output.identifier, output.type, True)
+    for link in output.links:
+      link.from_node, link.from_socket = node, new
+      new.links.append(link)
+    node.outputs.append(new)
+  return node
+
+def extract_repeated(trees: Sequence[TreeSnapshot], min_size: int = 8, max_depth: int = 16,
+                     min_count: int = 2) -> List[Pattern]:
+  """
+  find repeated subgraphs (see `find_repeated`) and replace each of their instances in the trees
+  by a group node of a group shared by all of them
+  """
+  patterns = find_repeated(trees, min_size, max_depth, min_count)
+  names: Dict[str, int] = {}
+  replaced: Dict[TreeSnapshot, Dict[NodeSnapshot, Optional[NodeSnapshot]]] = defaultdict(dict)
+  for pattern in patterns:
+    base = 'Shared' + pattern.instances[0].root.bl_idname.removeprefix('ShaderNode').removeprefix('Node')
+    count = names.get(base, 0)
+    names[base] = count + 1
+    pattern.group = _build_group(pattern, base if count == 0 else f'{base}.{count:03}')
+    for instance in pattern.instances:
+      replacements = replaced[instance.tree]
+      replacements.update((node, None) for node in instance.nodes)
+      replacements[instance.root] = _replace(pattern, instance)
+
+  for tree, replacements in replaced.items():
+    # links inside the instances, the others were moved to the group nodes
+    tree.links[:] = [l for l in tree.links if l.from_node not in replacements and l.to_node not in replacements]
+    nodes = [replacements.get(node, node) for node in tree.nodes]
+    tree.nodes[:] = [node for node in nodes if node is not None]
+  return patterns
+
+def analyze_library_shared(materials: Iterable[bpy.types.Material | MaterialSnapshot], min_size: int = 8,
+                           max_depth: int = 16) -> Tuple[ast.Module, Dict[str, ast.Module]]:
+  """
+  like `addon.analyze_library`, with the subgraphs repeated across the materials extracted into
+  fn decls in the shared module. Materials are snapshotted (see `snapshot`) to be rewritten
+  """
+  memo: Dict[Any, TreeSnapshot] = {}
+  snapshots = [m if isinstance(m, MaterialSnapshot) else snapshot_material(m, memo) for m in materials]
+  extract_repeated([s.node_tree for s in snapshots], min_size, max_depth)
+  return analyze_library(snapshots)  # type: ignore[arg-type]
+
+
+class _TestSubgraphs(unittest.TestCase):
+  @staticmethod
+  def make_material(name: str, scale: float = 2.0, metallic_op: str = 'ADD') -> bpy.types.Material:
+    """a pasted "wear mask" into the roughness, and some math of its own into the metallic"""
+    material = bpy.types.Material(name)
+    tree = material.node_tree
+    value = tree.nodes.new('ShaderNodeValue')
+    mask = []
+    for op, default in (('MULTIPLY', scale), ('ADD', 0.25), ('DIV', 2.0), ('SUB', 0.1), ('ATAN2', 1.0)):
+      node = tree.nodes.new('ShaderNodeMath', operation=op)
+      tree.links.new((mask[-1] if mask else value).outputs[0], node.inputs[0])
+      node.inputs[1].default_value = default
+      mask.append(node)
+    own = tree.nodes.new('ShaderNodeMath', operation=metallic_op)
+    bsdf = tree.nodes.new('ShaderNodeBsdfPrincipled')
+    out = tree.nodes.new('ShaderNodeOutputMaterial')
+    tree.links.new(mask[-1].outputs[0], bsdf.inputs['Roughness'])
+    tree.links.new(own.outputs[0], bsdf.inputs['Metallic'])
+    tree.links.new(bsdf.outputs[0], out.inputs['Surface'])
+    return material
+
+  def test_find(self):
+    trees = [snapshot_material(self.make_material(f'M{i}', metallic_op=op)).node_tree
+             for i, op in enumerate(('ADD', 'SUB', 'ADD'))]
+    patterns = find_repeated(trees, min_size=4)
+    # the mask, rather than the bigger bsdf with the mask that only two materials have
+    self.assertEqual([(5, 3)], [(p.size, len(p.instances)) for p in patterns])
+    self.assertEqual(['Math.004', 'Math.003', 'Math.002', 'Math.001', 'Math'], [n.name for n in patterns[0].instances[1].nodes])
+    # the value node is read from outside, the defaults are the same in every copy
+    self.assertEqual([Param('Value', 'VALUE', 4, 0)], patterns[0].params)
+    self.assertEqual([(7, 2)], [(p.size, len(p.instances)) for p in find_repeated(trees, min_size=6)])
+    self.assertEqual([], find_repeated(trees[:2], min_size=6))
+
+  def test_extract(self):
+    materials = [self.make_material(f'M{i}', scale=1.0 + i % 2, metallic_op=('ADD', 'SUB')[i % 2]) for i in range(6)]
+    library, modules = analyze_library_shared(materials, min_size=3)
+    self.assertEqual(library.serialize().split('\n'), [
+      "fn SharedMath(Value: f32, 'Value.001': f32) {",
+      "  return output(.Value=atan2(((((Value * 'Value.001') + 0.25) / 2.0) - 0.1), 1.0))",
+      "}",
+    ])
+    self.assertEqual(modules['M1'].serialize().split('\n'), [
+      "const 'Math.004': f32 = SharedMath(.Value=0.5, .'Value.001'=2.0)",
+      "const BsdfPrincipled: bsdf = pbr_shader(.'Base Color'=[0.8, 0.8, 0.8, 1.0], .Metallic=(0.5 - 0.5), .Roughness='Math.004'.Value)",
+      "const OutputMaterial = output(.Surface=BsdfPrincipled.BSDF)",
+    ])
+    # the materials themselves are left alone
+    self.assertEqual(9, len(materials[0].node_tree.nodes))
@@ -1,30 +1,24 @@
 """
-blender addon for seamlessly integrating nodelang into your material workflow
+sync nodelang source read from stdin into a material's nodes, once
 
-hopefully...
+for syncing whenever files are saved see `live_sync`
 """
 
-import sys
-
 from __future__ import annotations
-from dataclasses import dataclass, field
-from typing import Callable, Dict, Optional, TypedDict, cast
+import sys
+from typing import Any
 
-from addon.blender_util import isinstance_bpy_prop_array
 from . import ast
-from .types import blender_material_node_to_operation, blender_material_type_to_primitive
 from .bpy_wrap import bpy, in_blender
-from .util import Ansi
+from .parser import ParseContext
+from .to_nodes import apply, plan, sync_ops
 
-def analyze_module(mod: ast.Module, targetGraph: bpy.types.Material) -> None:
-  for decl in mod.decls:
-    nodes = decl.to_blender_node()
-    
-  bpy.ops.node.add_node(type="ShaderNodeTexChecker", use_transform=True)
+def text_to_nodes(src: str, tree: Any) -> None:
+  module = ast.Namespace.parse(ParseContext(src))
+  if not isinstance(module, ast.Namespace): raise RuntimeError(f'parse error {module}')
+  graph = plan(module)
+  for diagnostic in graph.diagnostics: print(f'nodelang: {diagnostic}', file=sys.stderr)
+  apply(tree, sync_ops(graph))
 
 if in_blender:
-  input_file = sys.stdin
-  analyze_module(bpy.data.materials["Test"])
-
-
-# functions = bpy.data.node_groups['NodeGroup'].nodes['Group Input']
+  text_to_nodes(sys.stdin.read(), bpy.data.materials["Test"].node_tree)
@@ -1,3 +1,393 @@
 """
 the part of the addon that converts codes to nodes
-"""
\ No newline at end of file
+
+A module is first planned into a `Graph` of node and link specs, which needs no bpy and so can
+be done off the main thread. Two graphs (or a graph and an unknown tree) are diffed into small
+ops, which are applied to the node tree on the main thread, a time-limited batch at a time.
+
+Each decl becomes a node named after it, nested expressions become nodes named `<decl>:<n>`.
+Inputs are referenced by name for named args and by index (among enabled inputs) for positional
+ones, like the analysis produces them, outputs by name or index 0 when there's no member access.
+Fn decls and calls to fns without a node are skipped, with a diagnostic in `Graph.diagnostics`.
+"""
+
+from __future__ import annotations
+from array import array
+from collections import deque
+from dataclasses import dataclass, field
+import time
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set, Tuple, cast
+import unittest
+
+from . import ast
+from .types import generic_node_types
+
+SocketKey = int | str
+
+# the node type (as in `node.type`) to bl_idname of the nodes that decls can become
+bl_idnames: Dict[str, str] = {
+  'MATH': 'ShaderNodeMath',
+  'BSDF_PRINCIPLED': 'ShaderNodeBsdfPrincipled',
+  'OUTPUT_MATERIAL': 'ShaderNodeOutputMaterial',
+  'GROUP_OUTPUT': 'NodeGroupOutput',
+}
+
+def _node_makers() -> Tuple[Dict[str, Tuple[str, Dict[str, Any]]], Dict[str, Tuple[str, Dict[str, Any]]]]:
+  """invert the analysis' node → operation table, so both directions agree"""
+  calls: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+  binops: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+  placeholder = ast.Literal(0)
+  for (node_type, props), op_maker in generic_node_types.items():
+    made = op_maker([('a', placeholder), ('b', placeholder)])
+    node = (bl_idnames[node_type], dict(props))
+    if isinstance(made, ast.BinOp): binops.setdefault(made.op, node)
+    elif isinstance(made, ast.Call): calls.setdefault(made.name.name, node)
+  # operators the analysis doesn't produce yet
+  for op, operation in ast.BinOp.operations.items():
+    binops.setdefault(op, ('ShaderNodeMath', {'operation': operation}))
+  return calls, binops
+
+call_nodes, binop_nodes = _node_makers()
+
+
+@dataclass
+class NodeSpec:
+  name: str
+  bl_idname: str
+  label: str = ''
+  props: Dict[str, Any] = field(default_factory=dict)
+  # values of unlinked inputs
+  defaults: Dict[SocketKey, Any] = field(default_factory=dict)
+  # values of outputs, e.g. of value and rgb nodes
+  outputs: Dict[SocketKey, Any] = field(default_factory=dict)
+  # where to put the node if it is created, see `Graph.location`
+  decl_index: int = 0
+  depth: int = 0
+  # the expression the node is planned from (the decl for the decl's own node), see `source_index`
+  expr: Optional[ast.Node] = field(default=None, compare=False, repr=False)
+
+@dataclass(frozen=True)
+class LinkSpec:
+  from_node: str
+  from_socket: SocketKey
+  to_node: str
+  to_socket: SocketKey
+
+@dataclass
+class Graph:
+  nodes: Dict[str, NodeSpec] = field(default_factory=dict)
+  links: Set[LinkSpec] = field(default_factory=set)
+  # why decls were skipped, they get no nodes
+  diagnostics: List[str] = field(default_factory=list)
+
+  def update(self, other: "Graph") -> None:
+    self.nodes.update(other.nodes)
+    self.links |= other.links
+    self.diagnostics += other.diagnostics
+
+  @staticmethod
+  def location(spec: NodeSpec) -> Tuple[float, float]:
+    # TODO: a real graph layout, this puts decls in columns left to right and nested nodes below them
+    return (spec.decl_index * 300.0, spec.depth * -200.0)
+
+
+def _plain(val: ast.PrimitiveValue) -> Any:
+  return tuple(val) if isinstance(val, (list, array)) else val
+
+def plan_decl(decl: ast.Node, decl_index: int = 0) -> Graph:
+  """the nodes and links of a single decl, or none and a diagnostic if it can't become nodes"""
+  if not isinstance(decl, ast.ConstDecl):
+    # TODO: create node groups from fn decls
+    name = decl.name.name if isinstance(decl, ast.FnDecl) else type(decl).__name__
+    return Graph(diagnostics=[f"skipped '{name}', fns don't become node groups yet"])
+  graph = Graph()
+  name = decl.name.name
+  value: ast.Node = decl.value
+  while isinstance(value, ast.ParenGroup): value = value.inner
+
+  match value:
+    case ast.Literal(val) if isinstance(val, (list, array)):
+      graph.nodes[name] = NodeSpec(name, 'ShaderNodeRGB', decl.comment or '', outputs={0: _plain(val)}, decl_index=decl_index, expr=decl)
+      return graph
+    case ast.Literal(val):
+      graph.nodes[name] = NodeSpec(name, 'ShaderNodeValue', decl.comment or '', outputs={0: val}, decl_index=decl_index, expr=decl)
+      return graph
+    case ast.VarRef():
+      # an alias is a reroute
+      graph.nodes[name] = NodeSpec(name, 'NodeReroute', decl.comment or '', decl_index=decl_index, expr=decl)
+      graph.links.add(LinkSpec(value.name.name, value.derefs[0] if value.derefs else 0, name, 0))
+      return graph
+
+  count = 0
+  # (expression, name of its node, depth), walked without recursion since math chains nest deeply
+  stack: List[Tuple[ast.Node, str, int]] = [(value, name, 0)]
+  while stack:
+    expr, node_name, depth = stack.pop()
+    match expr:
+      case ast.BinOp(op, left, right):
+        bl_idname, props = binop_nodes[op]
+        args: List[Tuple[SocketKey, ast.Node]] = [(0, left), (1, right)]
+      case ast.Call(fn_name, call_args):
+        if fn_name.name not in call_nodes:
+          return Graph(diagnostics=[f"skipped '{name}', there is no node for function '{fn_name.name}'"])
+        bl_idname, props = call_nodes[fn_name.name]
+        args = [(a.name.name, a.val) if isinstance(a, ast.NamedArg) else (i, a) for i, a in enumerate(call_args)]
+      case _:
+        return Graph(diagnostics=[f"skipped '{name}', there is no node for a {type(expr).__name__}"])
+
+    spec = graph.nodes[node_name] = NodeSpec(node_name, bl_idname, decl.comment or '' if node_name == name else '',
+                                             dict(props), decl_index=decl_index, depth=depth,
+                                             expr=decl if node_name == name else expr)
+    for key, arg in args:
+      while isinstance(arg, ast.ParenGroup): arg = arg.inner
+      match arg:
+        case ast.Literal(val):
+          spec.defaults[key] = _plain(val)
+        case ast.VarRef():
+          graph.links.add(LinkSpec(arg.name.name, arg.derefs[0] if arg.derefs else 0, node_name, key))
+        case _:
+          count += 1
+          child = f'{name}:{count}'
+          graph.links.add(LinkSpec(child, 0, node_name, key))
+          stack.append((arg, child, depth + 1))
+  return graph
+
+def plan(module: ast.Namespace, first_decl_index: int = 0) -> Graph:
+  graph = Graph()
+  for i, decl in enumerate(module.decls, first_decl_index):
+    graph.update(plan_decl(decl, i))
+  return graph
+
+
+## ops, applied on the main thread
+
+@dataclass
+class ApplyContext:
+  tree: Any
+  # nodes by name, since looking nodes up by name in blender is a linear search
+  nodes: Dict[str, Any] = field(default_factory=dict)
+
+  def __post_init__(self) -> None:
+    self.nodes = {n.name: n for n in self.tree.nodes}
+
+  def remove_node(self, name: str) -> None:
+    node = self.nodes.pop(name, None)
+    if node is not None: self.tree.nodes.remove(node)
+
+def input_socket(node: Any, key: SocketKey) -> Any:
+  enabled = [s for s in node.inputs if s.enabled]
+  if isinstance(key, int): return enabled[key]
+  return next((s for s in enabled if s.name == key), None) or node.inputs[key]
+
+def output_socket(node: Any, key: SocketKey) -> Any:
+  return node.outputs[key]
+
+def _find_link(ctx: ApplyContext, link: LinkSpec) -> Any:
+  to_node = ctx.nodes.get(link.to_node)
+  from_node = ctx.nodes.get(link.from_node)
+  if to_node is None or from_node is None: return None
+  to_socket = input_socket(to_node, link.to_socket)
+  from_socket = output_socket(from_node, link.from_socket)
+  return next((l for l in to_socket.links if l.from_socket == from_socket), None)
+
+@dataclass
+class EnsureNode:
+  """create a node, replacing a node of the same name but another type, and set all of its values"""
+  spec: NodeSpec
+
+  def apply(self, ctx: ApplyContext) -> None:
+    spec = self.spec
+    node = ctx.nodes.get(spec.name)
+    if node is not None and node.bl_idname != spec.bl_idname:
+      ctx.remove_node(spec.name)
+      node = None
+    if node is None:
+      node = ctx.nodes[spec.name] = ctx.tree.nodes.new(spec.bl_idname)
+      node.name = spec.name
+      node.location = Graph.location(spec)
+    node.label = spec.label
+    # props first, since e.g. a math node's operation changes which inputs are enabled
+    for prop, value in spec.props.items():
+      setattr(node, prop, value)
+    for key, value in spec.defaults.items():
+      input_socket(node, key).default_value = value
+    for key, value in spec.outputs.items():
+      output_socket(node, key).default_value = value
+
+@dataclass
+class RemoveNode:
+  name: str
+
+  def apply(self, ctx: ApplyContext) -> None:
+    ctx.remove_node(self.name)
+
+@dataclass
+class RemoveNodesExcept:
+  names: Set[str]
+
+  def apply(self, ctx: ApplyContext) -> None:
+    for name in [n for n in ctx.nodes if n not in self.names]:
+      ctx.remove_node(name)
+
+@dataclass
+class SetProp:
+  node: str
+  prop: str
+  value: Any
+
+  def apply(self, ctx: ApplyContext) -> None:
+    setattr(ctx.nodes[self.node], self.prop, self.value)
+
+@dataclass
+class SetLabel:
+  node: str
+  label: str
+
+  def apply(self, ctx: ApplyContext) -> None:
+    ctx.nodes[self.node].label = self.label
+
+@dataclass
+class SetDefault:
+  node: str
+  socket: SocketKey
+  value: Any
+  is_output: bool = False
+
+  def apply(self, ctx: ApplyContext) -> None:
+    node = ctx.nodes[self.node]
+    (output_socket if self.is_output else input_socket)(node, self.socket).default_value = self.value
+
+@dataclass
+class ClearLinks:
+  def apply(self, ctx: ApplyContext) -> None:
+    ctx.tree.links.clear()
+
+@dataclass
+class AddLink:
+  link: LinkSpec
+
+  def apply(self, ctx: ApplyContext) -> None:
+    link = self.link
+    from_node, to_node = ctx.nodes.get(link.from_node), ctx.nodes.get(link.to_node)
+    # references to names that aren't declared (yet) are left unlinked
+    if from_node is None or to_node is None: return
+    ctx.tree.links.new(output_socket(from_node, link.from_socket), input_socket(to_node, link.to_socket))
+
+@dataclass
+class RemoveLink:
+  link: LinkSpec
+
+  def apply(self, ctx: ApplyContext) -> None:
+    # the link is already gone if one of its nodes was removed
+    existing = _find_link(ctx, self.link)
+    if existing is not None: ctx.tree.links.remove(existing)
+
+Op = EnsureNode | RemoveNode | RemoveNodesExcept | SetProp | SetLabel | SetDefault | ClearLinks | AddLink | RemoveLink
+
+
+def sync_ops(graph: Graph) -> List[Op]:
+  """ops making any tree match the graph, for when what's in the tree isn't known"""
+  ops: List[Op] = [ClearLinks()]
+  ops += [EnsureNode(spec) for spec in graph.nodes.values()]
+  ops.append(RemoveNodesExcept(set(graph.nodes)))
+  ops += [AddLink(link) for link in graph.links]
+  return ops
+
+def diff(old: Graph, new: Graph, all_links: Optional[Callable[[], Set[LinkSpec]]] = None) -> List[Op]:
+  """
+  ops turning a tree that matches `old` into one that matches `new`. When only parts of graphs are
+  diffed, `all_links` gives the links of the whole new graph, since creating or replacing a node
+  needs the links of other parts to it (re)made
+  """
+  removed_links: List[Op] = [RemoveLink(l) for l in old.links - new.links]
+  added_links = new.links - old.links
+  removed_nodes: List[Op] = []
+  ensured: List[Op] = []
+  changes: List[Op] = []
+  created: Set[str] = set()
+
+  for name in old.nodes.keys() - new.nodes.keys():
+    removed_nodes.append(RemoveNode(name))
+  for name, spec in new.nodes.items():
+    prev = old.nodes.get(name)
+    if prev is None or prev.bl_idname != spec.bl_idname:
+      ensured.append(EnsureNode(spec))
+      created.add(name)
+      continue
+    if prev.label != spec.label: changes.append(SetLabel(name, spec.label))
+    changes += [SetProp(name, k, v) for k, v in spec.props.items() if prev.props.get(k, object()) != v]
+    changes += [SetDefault(name, k, v) for k, v in spec.defaults.items() if prev.defaults.get(k, object()) != v]
+    changes += [SetDefault(name, k, v, True) for k, v in spec.outputs.items() if prev.outputs.get(k, object()) != v]
+
+  if created:
+    links = all_links() if all_links is not None else new.links
+    added_links |= {l for l in links if l.from_node in created or l.to_node in created}
+  # links go after the nodes they connect exist, and props before values since they can enable sockets
+  changes.sort(key=lambda op: not isinstance(op, SetProp))
+  return removed_links + removed_nodes + ensured + changes + [AddLink(l) for l in added_links]
+
+def apply_ops(ctx: ApplyContext, ops: Deque[Op], budget: Optional[float] = None) -> bool:
+  """apply ops from the front of the queue, for at most `budget` seconds. Returns whether all were applied."""
+  deadline = None if budget is None else time.perf_counter() + budget
+  while ops:
+    ops.popleft().apply(ctx)
+    if deadline is not None and time.perf_counter() >= deadline: break
+  return not ops
+
+def apply(tree: Any, ops: Iterable[Op]) -> None:
+  apply_ops(ApplyContext(tree), deque(ops))
+
+
+class _TestToNodes(unittest.TestCase):
+  src = """
+  /// roughness
+  const Rough = (0.5 * 0.5) + 0.25;
+  const BsdfPrincipled: bsdf = pbr_shader(.'Base Color'=[0.8, 0.8, 0.8, 1.0], .Metallic=0.0, .Roughness=Rough);
+  const OutputMaterial = output(.Surface=BsdfPrincipled.BSDF);
+  """
+
+  def parse(self, src: str) -> ast.Namespace:
+    from .parser import ParseContext
+    return cast(ast.Namespace, ast.Namespace.parse(ParseContext(src)))
+
+  def test_plan(self):
+    graph = plan(self.parse(self.src))
+    self.assertEqual(['Rough', 'Rough:1', 'BsdfPrincipled', 'OutputMaterial'], list(graph.nodes))
+    self.assertEqual('roughness', graph.nodes['Rough'].label)
+    self.assertEqual({'operation': 'MULTIPLY'}, graph.nodes['Rough:1'].props)
+    self.assertIn(LinkSpec('BsdfPrincipled', 'BSDF', 'OutputMaterial', 'Surface'), graph.links)
+
+  def test_skipped(self):
+    graph = plan(self.parse("fn f(x) { return x * 2 }\nconst A = f(1.0);\nconst B = A * 2;"))
+    self.assertEqual(['B'], list(graph.nodes))
+    self.assertEqual(["skipped 'f', fns don't become node groups yet",
+                      "skipped 'A', there is no node for function 'f'"], graph.diagnostics)
+
+  def test_roundtrip(self):
+    from .addon import analyze_material
+    from .bpy_wrap import bpy
+    material = bpy.types.Material('M')
+    apply(material.node_tree, sync_ops(plan(self.parse(self.src))))
+    self.assertEqual(4, len(material.node_tree.nodes))
+    # math nodes are inlined again by the analysis
+    self.assertEqual([
+      "const BsdfPrincipled: bsdf = pbr_shader(.'Base Color'=[0.8, 0.8, 0.8, 1.0], .Metallic=0.0, .Roughness=((0.5 * 0.5) + 0.25))",
+      "const OutputMaterial = output(.Surface=BsdfPrincipled.BSDF)",
+    ], analyze_material(material).serialize().split('\n'))
+
+  def test_diff(self):
+    from .bpy_wrap import bpy
+    material = bpy.types.Material('M')
+    old = plan(self.parse(self.src))
+    apply(material.node_tree, sync_ops(old))
+    math = material.node_tree.nodes['Rough']
+    new = plan(self.parse(self.src.replace('+ 0.25', '- 0.75').replace('.Metallic=0.0', '.Metallic=Rough')))
+    ops = diff(old, new)
+    self.assertEqual([SetProp('Rough', 'operation', 'SUB'), SetDefault('Rough', 1, 0.75),
+                      AddLink(LinkSpec('Rough', 0, 'BsdfPrincipled', 'Metallic'))], ops)
+    apply(material.node_tree, ops)
+    self.assertIs(math, material.node_tree.nodes['Rough'])
+    self.assertEqual('SUB', math.operation)
+    self.assertEqual(0.75, math.inputs[1].default_value)
+    self.assertTrue(material.node_tree.nodes['BsdfPrincipled'].inputs['Metallic'].is_linked)
+    self.assertEqual([], diff(new, new))
@@ -0,0 +1,307 @@
+"""
+compiles a module of const decls into a single python function, for evaluating small modules
+many times with scalar inputs (e.g. driver-like parameter sweeps) without walking the ast.
+
+decls become locals, binary operators are inlined and known calls reference their functions
+directly. Math follows blender's math node through `math_node`, the scalar versions of `evaluate`'s.
+"""
+
+from __future__ import annotations
+from array import array
+from dataclasses import dataclass, field
+import dataclasses
+import hashlib
+import math
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Set, Tuple, cast
+import unittest
+
+from . import ast
+from .math_node import bitwise_and, bitwise_or, bitwise_xor, call_functions, safe_divide, safe_pow, safe_root
+from .parser import ParseContext
+
+
+# templates of the inlined code for each blender operation in `ast.BinOp.operations`
+binop_templates: Mapping[str, str] = {
+  'ADD': '({} + {})',
+  'SUB': '({} - {})',
+  'MUL': '({} * {})',
+  'DIV': '_safe_divide({}, {})',
+  # `**` is exponentiation like python's
+  'EXP': '_safe_pow({}, {})',
+  'POW': '_safe_pow({}, {})',
+  'ROOT': '_safe_root({}, {})',
+  'BITWISEAND': '_bitwise_and({}, {})',
+  'BITWISEOR': '_bitwise_or({}, {})',
+  'BITWISEXOR': '_bitwise_xor({}, {})',
+  'AND': 'float(bool({}) and bool({}))',
+  'OR': 'float(bool({}) or bool({}))',
+}
+
+# python's parser gives up on deeply nested parentheses, so deeper subexpressions get a local
+max_expr_depth = 32
+
+def check_swizzle(value: Any, size: int, deref: str) -> None:
+  """that a value has swizzle members up to `size` components, for values whose size isn't known when compiling"""
+  if not isinstance(value, (tuple, list, array)) or len(value) > ast.max_swizzle_size:
+    raise TypeError(f"can't take member '.{deref}' of {value!r}")
+  if size > len(value):
+    raise ValueError(f"'.{deref}' is out of range for a {len(value)} component vector")
+
+
+@dataclass
+class CompiledModule:
+  """a module compiled to a python function taking the inputs positionally"""
+  fn: Callable[..., Any]
+  # the module's free variables, in the order `fn` takes them
+  inputs: Tuple[str, ...]
+  # the decls `fn` returns, a single value if there is one or else a tuple
+  outputs: Tuple[str, ...]
+  source: str
+
+  def __call__(self, **inputs: float) -> Any:
+    return self.fn(*(inputs[name] for name in self.inputs))
+
+
+@dataclass
+class _Codegen:
+  decls: Mapping[str, ast.ConstDecl]
+  locals: Dict[str, str] = field(default_factory=dict)
+  inputs: Dict[str, str] = field(default_factory=dict)
+  lines: List[str] = field(default_factory=list)
+  temp_count: int = 0
+  # the largest size each local was checked to have for its swizzle members
+  checked: Dict[str, int] = field(default_factory=dict)
+
+  def var(self, name: str) -> str:
+    local = self.locals.get(name)
+    if local is not None: return local
+    if name not in self.decls:
+      local = self.inputs.get(name)
+      if local is None: local = self.inputs[name] = f'_i{len(self.inputs)}'
+      return local
+    raise RuntimeError(f"'{name}' was used before it was computed")
+
+  def temp(self, code: str) -> str:
+    name = f'_t{self.temp_count}'
+    self.temp_count += 1
+    self.lines.append(f'  {name} = {code}')
+    return name
+
+  @staticmethod
+  def literal(val: ast.PrimitiveValue) -> str:
+    match val:
+      case bool(v): return repr(float(v))
+      case int(v) | float(v): return repr(float(v))
+      case list() | array(): return f'({", ".join(_Codegen.literal(i) for i in val)},)'
+      case _: raise RuntimeError(f"can't compile literal {val!r}")
+
+  def var_ref(self, node: ast.VarRef) -> str:
+    name = node.name.name
+    decl = self.decls.get(name)
+    value = decl.value if decl is not None else None
+    while isinstance(value, ast.ParenGroup): value = value.inner
+    if isinstance(value, ast.Literal) and node.derefs:
+      # members of array literals are known when compiling
+      literal = value
+      for deref in node.derefs: literal = literal.swizzle(deref)
+      return self.literal(literal.val)
+    return self.swizzle(self.var(name), node.derefs)
+
+  def swizzle(self, code: str, derefs: List[str]) -> str:
+    # the size of the value, None until it is checked when running
+    size: Optional[int] = None
+    for deref in derefs:
+      indices = ast.swizzle_indices(deref)
+      if indices is None: raise TypeError(f"can't compile member '.{deref}'")
+      if size is None:
+        if self.checked.get(code, 0) <= max(indices):
+          self.checked[code] = max(indices) + 1
+          self.lines.append(f'  _check_swizzle({code}, {max(indices) + 1}, {deref!r})')
+      elif size == 1 or size > ast.max_swizzle_size:
+        raise TypeError(f"can't take member '.{deref}' of a {size} component value")
+      elif max(indices) >= size:
+        raise ValueError(f"'.{deref}' is out of range for a {size} component vector")
+      code = f'{code}[{indices[0]}]' if len(indices) == 1 else f'({", ".join(f"{code}[{i}]" for i in indices)},)'
+      size = len(indices)
+    return code
+
+  def expr(self, root: ast.Node) -> str:
+    """python code of an expression, walked without recursion"""
+    # (code, nesting depth) of finished subexpressions
+    results: List[Tuple[str, int]] = []
+    stack: List[Tuple[ast.Node, bool]] = [(root, False)]
+    while stack:
+      node, expanded = stack.pop()
+      match node:
+        case ast.ParenGroup(inner):
+          stack.append((inner, False))
+        case ast.Literal(val):
+          results.append((self.literal(val), 0))
+        case ast.VarRef():
+          results.append((self.var_ref(node), 0))
+        case ast.BinOp(_, left, right) if not expanded:
+          stack.append((node, True))
+          stack.append((right, False))
+          stack.append((left, False))
+        case ast.BinOp(op):
+          (b, b_depth), (a, a_depth) = results.pop(), results.pop()
+          results.append((binop_templates[ast.BinOp.operations[op]].format(a, b), max(a_depth, b_depth) + 1))
+        case ast.Call(name, args) if not expanded:
+          if name.name not in call_functions: raise RuntimeError(f"unknown function '{name.name}'")
+          if any(isinstance(a, ast.NamedArg) for a in args):
+            raise RuntimeError(f"named arguments to '{name.name}' can't be compiled")
+          stack.append((node, True))
+          stack.extend((arg, False) for arg in reversed(args))
+        case ast.Call(name, args):
+          call_args = results[len(results) - len(args):]
+          del results[len(results) - len(args):]
+          depth = max((d for _, d in call_args), default=0) + 1
+          results.append((f'_{name.name}({", ".join(c for c, _ in call_args)})', depth))
+        case _:
+          raise TypeError(f"can't compile a {type(node).__name__}")
+      if results and results[-1][1] > max_expr_depth:
+        results[-1] = (self.temp(results[-1][0]), 0)
+    assert len(results) == 1
+    return results[0][0]
+
+
+def decl_order(decls: Mapping[str, ast.ConstDecl], outputs: Sequence[str]) -> List[str]:
+  """the decls needed for the outputs, each after the decls it references"""
+  order: List[str] = []
+  done: Set[str] = set()
+  in_progress: Set[str] = set()
+  stack: List[Tuple[str, bool]] = [(name, False) for name in reversed(outputs)]
+  while stack:
+    name, expanded = stack.pop()
+    if expanded:
+      in_progress.discard(name)
+      done.add(name)
+      order.append(name)
+      continue
+    if name in done: continue
+    if name in in_progress: raise RuntimeError(f"'{name}' depends on itself")
+    in_progress.add(name)
+    stack.append((name, True))
+    refs = [n.name.name for n in ast.walk(decls[name].value) if isinstance(n, ast.VarRef)]
+    stack.extend((ref, False) for ref in reversed(refs) if ref in decls and ref not in done)
+  return order
+
+def _has_nodes(value: Any) -> bool:
+  return isinstance(value, ast.Node) or isinstance(value, list) and any(isinstance(v, ast.Node) for v in value)
+
+def content_key(decls: Iterable[ast.Node]) -> str:
+  """a hash of what decls compute, walked without recursion unlike `serialize`"""
+  h = hashlib.sha256()
+  for decl in decls:
+    for node in ast.walk(decl):
+      # parentheses don't change the compiled code, and `serialize` adds them
+      if isinstance(node, ast.ParenGroup): continue
+      # the values of the node's own fields, its children follow it in the walk
+      fields = dataclasses.fields(node) if dataclasses.is_dataclass(node) else ()
+      own = [v for v in (getattr(node, f.name) for f in fields) if not _has_nodes(v)]
+      h.update(repr((type(node).__name__, len(ast.children(node)), own)).encode())
+  return h.hexdigest()
+
+def compile_module(module: ast.Namespace, outputs: Optional[Sequence[str]] = None) -> CompiledModule:
+  """
+  compile the decls needed for `outputs` (by default every decl) into one function,
+  cached by the content of those decls so recompiling an identical module is free
+  """
+  decls = {d.name.name: d for d in module.decls if isinstance(d, ast.ConstDecl)}
+  outputs = tuple(outputs if outputs is not None else decls)
+  for name in outputs:
+    if name not in decls: raise RuntimeError(f"'{name}' is not declared")
+  order = decl_order(decls, outputs)
+  key = (content_key(decls[name] for name in order), outputs)
+  compiled = _compile_cache.pop(key, None)
+  if compiled is None:
+    if len(_compile_cache) >= _compile_cache_size:
+      del _compile_cache[next(iter(_compile_cache))]
+    compiled = _compile(decls, order, outputs, key[0])
+  # dicts keep insertion order, so reinserting keeps the least recently used entry first
+  _compile_cache[key] = compiled
+  return compiled
+
+# keyed by the content of the compiled decls and the outputs, least recently used entries are evicted first
+_compile_cache: Dict[Tuple[str, Tuple[str, ...]], CompiledModule] = {}
+_compile_cache_size = 256
+
+def _compile(decls: Mapping[str, ast.ConstDecl], order: List[str], outputs: Tuple[str, ...], key: str) -> CompiledModule:
+  codegen = _Codegen(decls)
+  for name in order:
+    code = codegen.expr(decls[name].value)
+    local = codegen.locals[name] = f'_v{len(codegen.locals)}'
+    codegen.lines.append(f'  {local} = {code}  # {name}')
+
+  returned = [codegen.locals[name] for name in outputs]
+  inputs = tuple(codegen.inputs)
+  source = '\n'.join([
+    f'def _compiled({", ".join(codegen.inputs.values())}):',
+    *codegen.lines,
+    f'  return {returned[0] if len(returned) == 1 else "(" + ", ".join(returned) + ",)"}',
+  ])
+
+  env: Dict[str, Any] = {f'_{name}': fn for name, fn in call_functions.items()}
+  env.update(_safe_divide=safe_divide, _safe_pow=safe_pow, _safe_root=safe_root, _bitwise_and=bitwise_and,
+             _bitwise_or=bitwise_or, _bitwise_xor=bitwise_xor, _check_swizzle=check_swizzle)
+  exec(compile(source, f'<nodelang {key[:12]}>', 'exec'), env)
+  return CompiledModule(env['_compiled'], inputs, outputs, source)
+
+
+class _TestToPython(unittest.TestCase):
+  def module(self, src: str) -> ast.Namespace:
+    return cast(ast.Namespace, ast.Namespace.parse(ParseContext(src)))
+
+  def test_compile(self):
+    module = self.module("""
+      const unused = 1 / 0;
+      const wave = sin(t * 6.283185) * amplitude;
+      const 'the out': f32 = atan2(wave, pos.y) + wave ^^ 2 / 0;
+    """)
+    compiled = compile_module(module, ["the out"])
+    self.assertEqual(('t', 'amplitude', 'pos'), compiled.inputs)
+    self.assertNotIn('unused', compiled.source)
+    wave = math.sin(0.1 * 6.283185) * 2
+    self.assertAlmostEqual(math.atan2(wave, 3), compiled(t=0.1, amplitude=2, pos=(0, 3)))
+    self.assertIs(compiled, compile_module(self.module(module.serialize()), ["the out"]))
+
+  def test_cache(self):
+    compiled = compile_module(self.module("const a = x * 2; const b = a + 1;"), ["b"])
+    # only the decls the outputs need are part of the key
+    self.assertIs(compiled, compile_module(self.module("const b = a + 1; const a = x * 2; const c = 3;"), ["b"]))
+    self.assertIsNot(compiled, compile_module(self.module("const a = x * 3; const b = a + 1;"), ["b"]))
+    # a long sum, which `serialize` would recurse into
+    sum_module = self.module("const s = " + " + ".join(f"x{i}" for i in range(3000)) + ";")
+    self.assertEqual(3000.0, compile_module(sum_module).fn(*[1.0] * 3000))
+    # recently used entries outlive older ones
+    for i in range(_compile_cache_size - 1):
+      compile_module(self.module(f"const v = x + {i};"))
+      compile_module(self.module("const a = x * 2; const b = a + 1;"), ["b"])
+    self.assertIs(compiled, compile_module(self.module("const a = x * 2; const b = a + 1;"), ["b"]))
+
+  def test_errors(self):
+    with self.assertRaises(TypeError):
+      _Codegen({}).expr(ast.Namespace([]))
+
+  def test_swizzle(self):
+    compiled = compile_module(self.module("const offset = [1, 2, 3]; const out = offset.z + pos.y + pos.xy.x;"), ["out"])
+    self.assertIn('3.0 + ', compiled.source)
+    self.assertEqual(6.0, compiled(pos=(1, 2)))
+    with self.assertRaises(ValueError): compiled(pos=(1,))
+    # like `evaluate`, vectors of more than `ast.max_swizzle_size` components have no swizzle members
+    with self.assertRaises(TypeError): compiled(pos=(1, 2, 3, 4, 5))
+    with self.assertRaises(TypeError): compile_module(self.module("const offset = [1, 2, 3]; const out = offset.w;"))
+    with self.assertRaises(ValueError): compile_module(self.module("const out = pos.xy.z;"))
+
+  def test_bitwise(self):
+    compiled = compile_module(self.module("const out = (a & b) + (a | 1) + (a ^ b);"), ["out"])
+    self.assertEqual(2 + 7 + 5, compiled(a=6.5, b=3))
+    # like `evaluate`, infinities and nan have no integer value and give nan, too large values are clamped
+    self.assertTrue(math.isnan(compiled(a=math.inf, b=3)))
+    self.assertTrue(math.isnan(compiled(a=6, b=math.nan)))
+    self.assertEqual(2 * (2 ** 31 - 1), compiled(a=1e300, b=0))
+
+  def test_deep(self):
+    module = self.module(" ".join(f"const v{i} = v{i+1} + 1;" for i in range(2000))
+                         + " const v2000 = " + " * ".join(["x"] * 200) + ";")
+    self.assertEqual(2001.0, compile_module(module, ["v0"]).fn(1.0))
@@ -29,6 +29,11 @@ class Type(Enum):
   ampAmp = 20
   pipePipe = 21
   comma = 22
+  semicolon = 23
+  fn = 24
+  return_ = 25
+  lBrace = 26
+  rBrace = 27
   ident = type[Ident]
   int = type[int]
   float = type[float]
@@ -37,9 +42,12 @@ class Type(Enum):
 
   @staticmethod
   def isinstance(token: "Token", type_: "Type" | Sequence["Type"]) -> "bool":
-    if not isinstance(type_, Sequence):
+    if isinstance(type_, Type):
       type_ = (type_,)
-    return any(token.tok == t or type[type(token.tok)] == t.value for t in type_)
+    if isinstance(token.tok, Type):
+      return token.tok in type_
+    payload_type = type[type(token.tok)]
+    return any(payload_type == t.value for t in type_)
 
 
 # this is really a type-tagged union, will probably need to extend with class types later once there is some overlap
@@ -71,6 +71,8 @@ generic_node_types: Dict[Tuple[BlenderNodeTypeEnum, FrozenDict[str, Any]],
   ('MATH', freezeDict({'operation': 'SIN'})):   lambda args: ast.Call(ast.Ident('sin'), ignore_name(args)),
   # TODO: need a better way to output this...?
   ('OUTPUT_MATERIAL', freezeDict({})):          lambda args: ast.Call(ast.Ident('output'), from_named(args)),
+  # the result of a node group's fn
+  ('GROUP_OUTPUT', freezeDict({})):             lambda args: ast.Call(ast.Ident('output'), from_named(args)),
 }
 
 def blender_material_node_to_operation(node: bpy.types.ShaderNode) -> Callable[[List[ast.Node]], ast.Node]:
@@ -0,0 +1,397 @@
+"""
+a compiler driver for a workspace of many .nlang files
+
+Changed files are parsed in parallel processes, files are ordered by the declarations they
+reference from each other, and only files whose source or dependencies changed since the last
+build are recompiled. What a build learned is kept in a state file so a no-op rebuild only
+needs to stat the sources.
+
+run with `python -m addon.workspace --help`
+"""
+
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+import hashlib
+import heapq
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Set, Tuple, cast
+import argparse
+import unittest
+
+from . import ast, ast_cache
+from .parser import ParseContext, ParseError
+
+source_ext = '.nlang'
+state_version = 1
+
+# functions provided by the language rather than declared in a file
+builtin_names: Set[str] = {'pbr_shader', 'output', 'sin', 'atan2'}
+
+
+@dataclass
+class Diagnostic:
+  path: str
+  message: str
+
+  def __str__(self) -> str:
+    return f'{self.path}: {self.message}'
+
+
+@dataclass
+class FileSummary:
+  """what a build remembers about a file, enough to relink it without reparsing"""
+  path: str
+  mtime_ns: int
+  size: int
+  hash: str
+  # names declared in the file
+  exports: List[str] = field(default_factory=list)
+  # hash of the declared names and their types, dependents only need relinking when this changes
+  interface: str = ''
+  # names referenced but not declared in the file
+  refs: List[str] = field(default_factory=list)
+  # files that declare the refs, filled in when linking
+  deps: List[str] = field(default_factory=list)
+  error: Optional[str] = None
+  # why the ast cache couldn't be written, the file itself is fine
+  cache_error: Optional[str] = None
+
+
+def line_col(src: str, index: int) -> Tuple[int, int]:
+  line = src.count('\n', 0, index) + 1
+  return line, index - (src.rfind('\n', 0, index) + 1) + 1
+
+def summarize(path: str, src: str, module: ast.Module | ParseError, stat: os.stat_result) -> FileSummary:
+  summary = FileSummary(path, stat.st_mtime_ns, stat.st_size, hashlib.sha256(src.encode()).hexdigest())
+  if not isinstance(module, ast.Namespace):
+    summary.error = f'parse error {module}'
+    return summary
+
+  exports: Dict[str, str] = {}
+  refs: Set[str] = set()
+  c = ast.SerializeCtx()
+  for decl in module.decls:
+    match decl:
+      case ast.ConstDecl():
+        exports[decl.name.name] = decl.serialize_type(c)
+        refs |= {n.name.name for n in ast.walk(decl) if isinstance(n, (ast.VarRef, ast.Call))}
+      case ast.FnDecl():
+        exports[decl.name.name] = f'fn({", ".join(p.serialize(c) for p in decl.params)}) {ast.serialize_type(decl.type, c)}'
+        fn_locals = {p.name.name for p in decl.params} | {d.name.name for d in decl.body.decls}
+        refs |= {n.name.name for n in ast.walk(decl) if isinstance(n, (ast.VarRef, ast.Call))} - fn_locals
+
+  summary.exports = sorted(exports)
+  summary.interface = hashlib.sha256(json.dumps(sorted(exports.items())).encode()).hexdigest()
+  summary.refs = sorted(refs - exports.keys())
+  return summary
+
+def parse_file(root: str, path: str, prev_hash: Optional[str] = None) -> Tuple[FileSummary, bool]:
+  """
+  read and parse a file (relative to root) and write its ast cache, this runs in worker processes.
+  Returns the summary and whether the file was parsed, it isn't if the content hash is still `prev_hash`.
+  Modules aren't returned since pickling a deep one back from a worker would overflow the stack,
+  they are loaded from the cache when needed.
+  """
+  full_path = os.path.join(root, path)
+  with open(full_path, encoding='utf-8') as f:
+    src = f.read()
+  stat = os.stat(full_path)
+  content_hash = hashlib.sha256(src.encode()).hexdigest()
+  if content_hash == prev_hash:
+    return FileSummary(path, stat.st_mtime_ns, stat.st_size, content_hash), False
+
+  pctx = ParseContext(src)
+  module = ast.Namespace.parse(pctx)
+  summary = summarize(path, src, module, stat)
+  if summary.error is not None:
+    line, col = line_col(src, pctx.index)
+    summary.error += f' at {line}:{col}'
+    return summary, True
+  try:
+    ast_cache.write(full_path, cast(ast.Namespace, module), src)
+  except (OSError, TypeError, ValueError, RecursionError) as e:
+    summary.cache_error = f'ast cache not written: {type(e).__name__}: {e}'
+  return summary, True
+
+def _parse_file_star(args: Tuple[str, str, Optional[str]]) -> Tuple[FileSummary, bool]:
+  return parse_file(*args)
+
+
+def topological_order(deps: Mapping[str, Iterable[str]]) -> Tuple[List[str], List[str]]:
+  """
+  order files so dependencies come before their dependents, ties broken by path.
+  Returns the order and the files that are part of (or depend on) a cycle, which are appended last.
+  """
+  dependents: Dict[str, List[str]] = {path: [] for path in deps}
+  remaining = {path: 0 for path in deps}
+  for path, path_deps in deps.items():
+    for dep in path_deps:
+      dependents[dep].append(path)
+      remaining[path] += 1
+  ready = [path for path, count in remaining.items() if count == 0]
+  heapq.heapify(ready)
+  order: List[str] = []
+  while ready:
+    path = heapq.heappop(ready)
+    order.append(path)
+    for dependent in dependents[path]:
+      remaining[dependent] -= 1
+      if remaining[dependent] == 0:
+        heapq.heappush(ready, dependent)
+  cyclic = sorted(path for path, count in remaining.items() if count > 0)
+  return order + cyclic, cyclic
+
+
+@dataclass
+class BuildResult:
+  # every file, dependencies first
+  order: List[str] = field(default_factory=list)
+  # files that were read and parsed
+  parsed: List[str] = field(default_factory=list)
+  # files whose compiled result may have changed, parsed or relinked against changed dependencies
+  compiled: List[str] = field(default_factory=list)
+  diagnostics: List[Diagnostic] = field(default_factory=list)
+  seconds: float = 0.0
+
+
+@dataclass
+class Workspace:
+  root: str
+  state_path: Optional[str] = None
+  files: Dict[str, FileSummary] = field(default_factory=dict)
+
+  def __post_init__(self) -> None:
+    if self.state_path is None:
+      self.state_path = os.path.join(self.root, '.nlang-build.json')
+    self.load_state()
+
+  def load_state(self) -> None:
+    assert self.state_path is not None
+    try:
+      with open(self.state_path) as f:
+        state = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+      return
+    if state.get('version') != state_version: return
+    self.files = {path: FileSummary(**summary) for path, summary in state['files'].items()}
+
+  def save_state(self) -> None:
+    assert self.state_path is not None
+    with open(self.state_path, 'w') as f:
+      json.dump({'version': state_version,
+                 'files': {path: asdict(summary) for path, summary in self.files.items()}}, f)
+
+  def module(self, path: str) -> ast.Namespace | ast_cache.CachedModule | None:
+    """the module of a file, loaded lazily from its cache, or parsed again"""
+    full_path = os.path.join(self.root, path)
+    try:
+      return ast_cache.parse_file(full_path)
+    except (OSError, TypeError, ValueError, struct.error, RecursionError):
+      # an unreadable or unwritable cache, the build reported why
+      with open(full_path, encoding='utf-8') as f:
+        parsed = ast.Namespace.parse(ParseContext(f.read()))
+      return parsed if isinstance(parsed, ast.Namespace) else None
+
+  def discover(self) -> List[str]:
+    """paths of all source files under the root, relative to it"""
+    paths: List[str] = []
+    for dirpath, dirnames, filenames in os.walk(self.root):
+      dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+      paths.extend(os.path.relpath(os.path.join(dirpath, name), self.root)
+                   for name in filenames if name.endswith(source_ext))
+    return sorted(paths)
+
+  def build(self, jobs: Optional[int] = None, force: bool = False) -> BuildResult:
+    start = time.perf_counter()
+    result = BuildResult()
+    prev = self.files
+    paths = self.discover()
+
+    # a file whose stat didn't change is assumed unchanged, like make
+    to_read: List[Tuple[str, str, Optional[str]]] = []
+    for path in paths:
+      old = prev.get(path)
+      stat = os.stat(os.path.join(self.root, path))
+      if force or old is None or (stat.st_mtime_ns, stat.st_size) != (old.mtime_ns, old.size):
+        to_read.append((self.root, path, None if force or old is None else old.hash))
+
+    workers = jobs or os.cpu_count() or 1
+    if len(to_read) > 1 and workers > 1:
+      with ProcessPoolExecutor(max_workers=workers) as pool:
+        read = list(pool.map(_parse_file_star, to_read, chunksize=max(1, len(to_read) // (workers * 4))))
+    else:
+      read = [_parse_file_star(args) for args in to_read]
+
+    files: Dict[str, FileSummary] = {path: prev[path] for path in paths if path in prev}
+    changed: Set[str] = set()
+    for summary, parsed in read:
+      if not parsed:
+        # content is unchanged, only the stat was
+        old = files[summary.path]
+        old.mtime_ns, old.size = summary.mtime_ns, summary.size
+        continue
+      files[summary.path] = summary
+      changed.add(summary.path)
+      result.parsed.append(summary.path)
+
+    # linking updates the summaries kept from the previous build in place
+    prev_deps = {path: list(summary.deps) for path, summary in prev.items()}
+    result.diagnostics, changed_interfaces = self.link(files, prev)
+    for path, summary in files.items():
+      if (path in changed
+          or summary.deps != prev_deps.get(path, [])
+          or any(dep in changed_interfaces for dep in summary.deps)):
+        result.compiled.append(path)
+
+    result.order, cyclic = topological_order({path: files[path].deps for path in paths})
+    result.diagnostics.extend(Diagnostic(path, 'is part of a dependency cycle') for path in cyclic)
+    position = {path: i for i, path in enumerate(result.order)}
+    result.compiled.sort(key=position.__getitem__)
+
+    self.files = files
+    self.save_state()
+    result.seconds = time.perf_counter() - start
+    return result
+
+  @staticmethod
+  def link(files: Mapping[str, FileSummary], prev: Mapping[str, FileSummary]) -> Tuple[List[Diagnostic], Set[str]]:
+    """resolve each file's references to the files declaring them, returns diagnostics and files whose interface changed"""
+    diagnostics: List[Diagnostic] = []
+    providers: Dict[str, str] = {}
+    for path in sorted(files):
+      summary = files[path]
+      if summary.error is not None:
+        diagnostics.append(Diagnostic(path, summary.error))
+      if summary.cache_error is not None:
+        diagnostics.append(Diagnostic(path, summary.cache_error))
+      for name in summary.exports:
+        if name in providers:
+          diagnostics.append(Diagnostic(path, f"'{name}' is already declared in {providers[name]}"))
+        else:
+          providers[name] = path
+
+    changed_interfaces = {path for path, summary in files.items()
+                          if path not in prev or prev[path].interface != summary.interface}
+    changed_interfaces |= prev.keys() - files.keys()
+
+    for path in sorted(files):
+      summary = files[path]
+      deps: Set[str] = set()
+      for name in summary.refs:
+        provider = providers.get(name)
+        if provider is not None:
+          deps.add(provider)
+        elif name not in builtin_names:
+          diagnostics.append(Diagnostic(path, f"'{name}' is not declared in the workspace"))
+      summary.deps = sorted(deps - {path})
+    return diagnostics, changed_interfaces
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+  arg_parser = argparse.ArgumentParser(prog='python -m addon.workspace', description=__doc__)
+  arg_parser.add_argument('root', nargs='?', default='.')
+  arg_parser.add_argument('--jobs', '-j', type=int, help='worker processes, defaults to the cpu count')
+  arg_parser.add_argument('--force', action='store_true', help='reparse every file')
+  arg_parser.add_argument('--state', help='build state file, defaults to <root>/.nlang-build.json')
+  arg_parser.add_argument('--verbose', '-v', action='store_true', help='list the compiled files')
+  args = arg_parser.parse_args(argv)
+
+  workspace = Workspace(args.root, args.state)
+  result = workspace.build(jobs=args.jobs, force=args.force)
+  if args.verbose:
+    for path in result.compiled:
+      print(f'compiled {path}')
+  for diagnostic in result.diagnostics:
+    print(diagnostic, file=sys.stderr)
+  print(f'{len(result.order)} files, parsed {len(result.parsed)}, compiled {len(result.compiled)} '
+        f'in {result.seconds:.3f}s')
+  return 1 if result.diagnostics else 0
+
+
+class _TestWorkspace(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.root = self.dir.name
+    self.write('a.nlang', 'const a = b + f(1);')
+    self.write('f.nlang', 'fn f(x) { const y = x * 2; return y + d; }')
+    self.write('lib/b.nlang', 'const b = sin(c);')
+    self.write('lib/c.nlang', 'const c = 2;')
+    self.write('d.nlang', 'const d = 5;')
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def write(self, path: str, src: str):
+    os.makedirs(os.path.dirname(os.path.join(self.root, path)), exist_ok=True)
+    with open(os.path.join(self.root, path), 'w') as f:
+      f.write(src)
+
+  def test_incremental(self):
+    result = Workspace(self.root).build(jobs=1)
+    self.assertEqual(result.diagnostics, [])
+    self.assertEqual(len(result.parsed), 5)
+    self.assertEqual(result.order, ['d.nlang', 'f.nlang', 'lib/c.nlang', 'lib/b.nlang', 'a.nlang'])
+
+    workspace = Workspace(self.root)
+    result = workspace.build(jobs=1)
+    self.assertEqual((result.parsed, result.compiled), ([], []))
+    self.assertIsInstance(workspace.module('lib/b.nlang'), ast_cache.CachedModule)
+
+    # same interface, so b doesn't need relinking
+    self.write('lib/c.nlang', 'const c = 20;')
+    result = Workspace(self.root).build(jobs=1)
+    self.assertEqual((result.parsed, result.compiled), (['lib/c.nlang'], ['lib/c.nlang']))
+
+    # renaming a decl changes the interface
+    self.write('lib/c.nlang', 'const e = 20;')
+    result = Workspace(self.root).build(jobs=1)
+    self.assertCountEqual(result.compiled, ['lib/c.nlang', 'lib/b.nlang'])
+    self.assertEqual([str(d) for d in result.diagnostics], ["lib/b.nlang: 'c' is not declared in the workspace"])
+
+  def test_errors(self):
+    self.write('bad.nlang', 'const x = ;')
+    self.write('cycle.nlang', 'const y = z; const z2 = 1;')
+    self.write('cycle2.nlang', 'const z = y;')
+    result = Workspace(self.root).build(jobs=1)
+    self.assertEqual([str(d) for d in result.diagnostics], [
+      'bad.nlang: parse error ParseNonLexError.UnexpectedToken at 1:12',
+      'cycle.nlang: is part of a dependency cycle',
+      'cycle2.nlang: is part of a dependency cycle',
+    ])
+
+  def test_deep(self):
+    # encoding the cache used to recurse once per binop
+    self.write('deep.nlang', 'const deep = ' + ' + '.join(f'a{i}' for i in range(3000)) + ';')
+    self.write('lib/a0.nlang', ''.join(f'const a{i} = {i};' for i in range(3000)))
+    result = Workspace(self.root).build(jobs=1)
+    self.assertEqual([], result.diagnostics)
+    with cast(ast_cache.CachedModule, Workspace(self.root).module('deep.nlang')) as cached:
+      self.assertEqual(['deep'], cached.decl_names())
+
+  def test_deep_jobs(self):
+    # modules used to be pickled back from the worker processes, which recursed once per binop
+    self.write('deep.nlang', 'const deep = ' + ' + '.join(f'a{i}' for i in range(5000)) + ';')
+    self.write('lib/a0.nlang', ''.join(f'const a{i} = {i};' for i in range(5000)))
+    result = Workspace(self.root).build(jobs=2)
+    self.assertEqual([], result.diagnostics)
+    self.assertEqual(7, len(result.parsed))
+    with cast(ast_cache.CachedModule, Workspace(self.root).module('deep.nlang')) as cached:
+      self.assertEqual(5000, sum(isinstance(n, ast.VarRef) for n in ast.walk(cached.get_decl('deep'))))
+
+  def test_cache_error(self):
+    # a directory where the cache file would go can't be replaced by it
+    os.mkdir(os.path.join(self.root, 'd.nlangc'))
+    result = Workspace(self.root).build(jobs=1)
+    self.assertEqual(['d.nlang'], [d.path for d in result.diagnostics])
+    self.assertIn('ast cache not written', result.diagnostics[0].message)
+    self.assertEqual(['d'], [decl.name.name for decl in Workspace(self.root).module('d.nlang').decls])
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,3 +1,3 @@
-python -m unittest addon/ast.py
+python -m unittest addon/ast.py addon/bench.py addon/workspace.py addon/ast_cache.py addon/evaluate.py addon/to_python.py addon/addon.py addon/background.py addon/to_nodes.py addon/live_sync.py addon/parallel.py addon/snapshot.py addon/source_index.py addon/subgraphs.py addon/queries.py addon/graph_export.py
 blender lsp-test.blend -b -P blender_entry.py
 